@@ -0,0 +1,298 @@
+"""
+一体机链路端到端性能基准
+针对正在运行的整套服务(建议用模拟器: docker compose -f compose.yaml -f compose.sim.yaml up)测量:
+- 指令延迟: HTTP请求 -> AMQP -> 串口写入 -> 设备回显 -> /ws 收到回显帧 的 p50/p99
+- 串流吞吐: 示波器打开时每个 /ws 客户端每秒收到的帧数
+- 扇出扩展: 1 到 100 个并发观看者时的吞吐变化
+- 每帧CPU: 通过 /proc/<pid>/stat 统计各服务进程在串流阶段的CPU时间
+
+结果以JSON输出，便于在CI中跟踪回归:
+    python bench_pipeline.py --url http://127.0.0.1:8000 \
+        --container web=ytjweb-service --container serial=serial-service --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import requests
+import websockets
+
+# 用于测延迟的LED编号及其操作码(LED1 = 0x10)
+LATENCY_LED = 1
+LATENCY_LED_OPCODE = 0x10
+# 基准客户端的标识，web 服务按它单独限速(X-Client-Id)
+CLIENT_ID = "bench_pipeline"
+
+
+def percentile(values, pct):
+    """最近秩法计算百分位"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "mean": statistics.fmean(values),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def frame_hex(message):
+    """/ws 上的原始帧: schema=1 是8个十六进制字符，schema=2 是4字节二进制消息；其他消息返回 None"""
+    if isinstance(message, bytes):
+        return message.hex() if len(message) == 4 else None
+    if len(message) == 8 and not message.startswith('{'):
+        return message
+    return None
+
+
+# --- CPU 采样 ---
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def resolve_container_pid(container: str) -> int:
+    output = subprocess.check_output(['docker', 'inspect', '-f', '{{.State.Pid}}', container], text=True)
+    return int(output.strip())
+
+
+def read_cpu_seconds(pid: int) -> float:
+    with open(f'/proc/{pid}/stat') as f:
+        # 进程名可能包含空格，从最后一个右括号之后开始解析
+        fields = f.read().rsplit(')', 1)[1].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime) / CLK_TCK
+
+
+class CpuSampler:
+    def __init__(self, pids: dict):
+        self.pids = pids
+        self.start = {}
+
+    def begin(self):
+        self.start = {name: read_cpu_seconds(pid) for name, pid in self.pids.items()}
+
+    def end(self, frames: int):
+        result = {}
+        for name, pid in self.pids.items():
+            cpu = read_cpu_seconds(pid) - self.start[name]
+            result[name] = {
+                "cpu_s": cpu,
+                "cpu_us_per_frame": cpu / frames * 1e6 if frames else None,
+            }
+        return result
+
+
+# --- 基准阶段 ---
+def http_get(base_url: str, path: str, **params):
+    """发送GET请求，非2xx响应抛出 requests.HTTPError"""
+    response = requests.get(f"{base_url}{path}", params=params, headers={"X-Client-Id": CLIENT_ID}, timeout=10)
+    response.raise_for_status()
+    return response
+
+
+def retry_after(error: requests.HTTPError) -> float:
+    """被准入控制拒绝(429)时返回建议的等待秒数，其他错误返回 None"""
+    response = error.response
+    if response is None or response.status_code != 429:
+        return None
+    return float(response.headers.get("Retry-After", 1))
+
+
+async def bench_command_latency(base_url: str, ws_url: str, samples: int, timeout: float, rate: float):
+    """
+    切换LED并等待设备回显帧，测量HTTP耗时和端到端耗时。
+    按 rate 个请求/秒发送，低于 web 服务的 COMMAND_RATE；仍被限流(429)的请求单独计数，不算作超时
+    """
+    await asyncio.to_thread(http_get, base_url, "/api/close_occ")
+    await asyncio.to_thread(http_get, base_url, "/api/close_multimeter")
+
+    http_ms, e2e_ms = [], []
+    timeouts = 0
+    rate_limited = 0
+    waiter = {"prefix": None, "future": None}
+
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        async def reader():
+            async for message in ws:
+                frame = frame_hex(message)
+                if frame is None:
+                    continue
+                future = waiter["future"]
+                if future is not None and not future.done() and frame.startswith(waiter["prefix"]):
+                    future.set_result(time.perf_counter())
+
+        reader_task = asyncio.create_task(reader())
+        # 等待连接时的状态恢复指令处理完
+        await asyncio.sleep(2)
+        loop = asyncio.get_running_loop()
+        try:
+            for i in range(samples):
+                on = i % 2 == 0
+                path = "/api/open_led" if on else "/api/close_led"
+                waiter["prefix"] = f"{LATENCY_LED_OPCODE:02x}00{1 if on else 0:02x}"
+                waiter["future"] = loop.create_future()
+                t0 = time.perf_counter()
+                try:
+                    await asyncio.to_thread(http_get, base_url, path, numbers=str(LATENCY_LED))
+                except requests.HTTPError as e:
+                    wait = retry_after(e)
+                    if wait is None:
+                        raise
+                    rate_limited += 1
+                    await asyncio.sleep(wait)
+                    continue
+                t_http = time.perf_counter()
+                http_ms.append((t_http - t0) * 1000)
+                try:
+                    t_echo = await asyncio.wait_for(waiter["future"], timeout)
+                    e2e_ms.append((t_echo - t0) * 1000)
+                except asyncio.TimeoutError:
+                    timeouts += 1
+                await asyncio.sleep(max(0.0, t0 + 1 / rate - time.perf_counter()))
+        finally:
+            reader_task.cancel()
+
+    return {
+        "http_ms": summarize(http_ms),
+        "end_to_end_ms": summarize(e2e_ms),
+        "timeouts": timeouts,
+        "rate_limited": rate_limited,
+    }
+
+
+async def ws_viewer(ws_url: str, counts: list, index: int, ready: asyncio.Event, stop: asyncio.Event):
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        ready.set()
+        while not stop.is_set():
+            try:
+                message = await asyncio.wait_for(ws.recv(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            if frame_hex(message) is not None:
+                counts[index] += 1
+
+
+async def bench_stream(base_url: str, ws_url: str, viewers: int, duration: float, warmup: float,
+                       cpu: CpuSampler):
+    """打开示波器，N个观看者同时接收数据，统计每个客户端的帧率"""
+    counts = [0] * viewers
+    stop = asyncio.Event()
+    readies = [asyncio.Event() for _ in range(viewers)]
+    tasks = [asyncio.create_task(ws_viewer(ws_url, counts, i, readies[i], stop)) for i in range(viewers)]
+    try:
+        await asyncio.wait_for(asyncio.gather(*(r.wait() for r in readies)), 30)
+        await asyncio.to_thread(http_get, base_url, "/api/open_occ")
+        await asyncio.sleep(warmup)
+
+        for i in range(viewers):
+            counts[i] = 0
+        cpu.begin()
+        started = time.perf_counter()
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - started
+        snapshot = list(counts)
+    finally:
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    total = sum(snapshot)
+    per_client = [c / elapsed for c in snapshot]
+    return {
+        "viewers": viewers,
+        "duration_s": elapsed,
+        "frames_total": total,
+        "frames_per_s_total": total / elapsed,
+        "frames_per_s_per_client": {
+            "min": min(per_client),
+            "mean": statistics.fmean(per_client),
+            "max": max(per_client),
+        },
+        "cpu": cpu.end(total),
+    }
+
+
+async def run(args):
+    base_url = args.url.rstrip('/')
+    ws_url = base_url.replace('http://', 'ws://').replace('https://', 'wss://') + f'/ws?schema={args.ws_schema}'
+
+    pids = {}
+    for item in args.pid:
+        name, pid = item.split('=', 1)
+        pids[name] = int(pid)
+    for item in args.container:
+        name, container = item.split('=', 1)
+        pids[name] = resolve_container_pid(container)
+    cpu = CpuSampler(pids)
+
+    result = {
+        "timestamp": datetime.now().isoformat(),
+        "config": {
+            "url": base_url,
+            "latency_samples": args.latency_samples,
+            "command_rate": args.command_rate,
+            "stream_duration_s": args.duration,
+            "viewers": args.viewers,
+            "ws_schema": args.ws_schema,
+            "processes": pids,
+        },
+    }
+
+    print("测量指令延迟...", file=sys.stderr)
+    result["command_latency"] = await bench_command_latency(base_url, ws_url, args.latency_samples, args.timeout,
+                                                       args.command_rate)
+
+    result["stream"] = []
+    for viewers in args.viewers:
+        print(f"测量串流吞吐: {viewers} 个观看者...", file=sys.stderr)
+        result["stream"].append(await bench_stream(base_url, ws_url, viewers, args.duration, args.warmup, cpu))
+    await asyncio.to_thread(http_get, base_url, "/api/close_occ")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="一体机链路端到端性能基准")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="ytj_web_service 地址")
+    parser.add_argument('--latency-samples', type=int, default=50, help="指令延迟采样次数")
+    parser.add_argument('--command-rate', type=float, default=5,
+                        help="指令延迟阶段每秒发送的请求数，需低于 web 服务的 COMMAND_RATE")
+    parser.add_argument('--timeout', type=float, default=10, help="等待设备回显的超时(秒)")
+    parser.add_argument('--duration', type=float, default=10, help="每个串流阶段的测量时长(秒)")
+    parser.add_argument('--warmup', type=float, default=2, help="每个串流阶段的预热时长(秒)")
+    parser.add_argument('--viewers', type=int, nargs='+', default=[1, 2, 5, 10, 25, 50, 100],
+                        help="依次测量的并发观看者数量")
+    parser.add_argument('--pid', action='append', default=[], metavar='NAME=PID',
+                        help="统计CPU的进程，可重复指定")
+    parser.add_argument('--container', action='append', default=[], metavar='NAME=CONTAINER',
+                        help="统计CPU的容器(通过 docker inspect 解析PID)，可重复指定")
+    parser.add_argument('--ws-schema', type=int, choices=(1, 2), default=1,
+                        help="WebSocket消息格式: 1 为详细格式，2 为精简格式(数据帧为二进制)")
+    parser.add_argument('--output', help="结果JSON文件路径，默认输出到标准输出")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+多设备路由
+每台一体机有一个设备ID，指令和数据的路由键、队列名都按设备ID区分:
+    to_serial_routing_key.<设备ID>、to_serial_queue.<设备ID>、serial.<设备ID> ...
+默认设备沿用原来不带后缀的路由键和队列名，单设备部署无需任何改动。
+
+注意: serial_service、ytj_web_service 各有一份相同的 devices.py，修改时需同步更新。
+"""
+import os
+import re
+
+DEFAULT_DEVICE = "default"
+
+# 设备ID会出现在路由键、队列名和文件名中，只允许字母、数字、下划线和短横线
+DEVICE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+
+def is_valid_device_id(device_id: str) -> bool:
+    return bool(DEVICE_ID_PATTERN.match(device_id))
+
+
+# 串口数据帧发布到 topic 交换机，路由键 serial.<设备ID>。
+# 每个消费者(WebSocket、历史采集、录制等)声明自己的队列并绑定，互不争抢数据
+SERIAL_DATA_EXCHANGE = 'serial_data_exchange'
+
+
+# 串口服务连续写入两条指令之间的最小间隔(秒)，指令可通过 dwell_ms 头部要求更长的停留。
+# 串口服务按它控制写入节奏，web 服务按它估算指令积压，两个服务需要配置相同的值
+COMMAND_INTERVAL = float(os.getenv('COMMAND_INTERVAL', 0.05))
+
+
+# 指令队列 to_serial_queue 的声明参数，两个服务声明时必须完全一致。
+# 串口服务每条指令之后至少停留 COMMAND_INTERVAL 秒(默认每秒约20条)，队列满时 broker 拒收新指令(reject-publish)，而不是无限堆积或丢弃已排队的指令；
+# 长度能容纳一整段最长的电压斜坡/扫频序列(protocol.MAX_SEQUENCE_STEPS)
+TO_SERIAL_QUEUE_ARGUMENTS = {
+    'x-max-length': 2000,
+    'x-overflow': 'reject-publish',
+}
+
+
+def data_routing_key(device_id: str) -> str:
+    return f"serial.{device_id}"
+
+
+def scoped(name: str, device_id: str) -> str:
+    """按设备ID区分的路由键或队列名"""
+    return name if device_id == DEFAULT_DEVICE else f"{name}.{device_id}"
+
+
+def parse_device_ids(value: str) -> list:
+    """解析逗号分隔的设备ID列表，例如 "default,ytj2,ytj3" """
+    device_ids = []
+    for item in value.split(','):
+        device_id = item.strip()
+        if not device_id:
+            continue
+        if not is_valid_device_id(device_id):
+            raise ValueError(f"无效的设备ID: {device_id}")
+        if device_id not in device_ids:
+            device_ids.append(device_id)
+    return device_ids or [DEFAULT_DEVICE]
+
+
+def parse_device_ports(value: str) -> dict:
+    """解析 设备ID=串口 列表，例如 "default=/dev/ttyACM0,ytj2=/dev/ttyACM1" """
+    ports = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError(f"串口配置应为 设备ID=串口: {item}")
+        device_id, port = (part.strip() for part in item.split('=', 1))
+        if not is_valid_device_id(device_id):
+            raise ValueError(f"无效的设备ID: {device_id}")
+        ports[device_id] = port
+    return ports
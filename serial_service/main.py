@@ -1,15 +1,31 @@
-import pika
-import serial
-import threading
+import asyncio
+import json
 import time
 import sys
 import os
 import logging
 
+import aio_pika
+from aio_pika.exceptions import ChannelPreconditionFailed
+import serial
+import serial_asyncio
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from devices import (COMMAND_INTERVAL, DEFAULT_DEVICE, SERIAL_DATA_EXCHANGE, TO_SERIAL_QUEUE_ARGUMENTS,
+                     data_routing_key, parse_device_ports, scoped)
+from logging_setup import setup_logging
+from protocol import CLOSE_FRAMES, FRAME_END, FRAME_SIZE, reply_opcode
+from recorder import open_recorder
+from spool import FrameSpool
+
 # 日志服务
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# 热路径日志的限速类别
+SERIAL_FRAME_LOG = {"category": "serial_frame"}
+SERIAL_COMMAND_LOG = {"category": "serial_command"}
+
 
 # RabbitMQ 配置
 MQ_HOST = os.getenv('MQ_HOST', 'rabbitmq-service')
@@ -17,181 +33,389 @@ MQ_HOST = os.getenv('MQ_HOST', 'rabbitmq-service')
 MQ_PORT = int(os.getenv('MQ_PORT', 5672))
 MQ_USER = os.getenv('RABBITMQ_DEFAULT_USER', 'user')
 MQ_PASS = os.getenv('RABBITMQ_DEFAULT_PASS', 'password')
+# 心跳间隔(秒)，断线能在一两个心跳内被发现并自动重连
+MQ_HEARTBEAT = int(os.getenv('MQ_HEARTBEAT', 30))
 
 EXCHANGE_NAME = 'aio_exchange'
 TO_SERIAL_ROUTING_KEY = 'to_serial_routing_key'
-TO_SERIAL_QUEUE = 'to_serial_queue' 
+TO_SERIAL_QUEUE = 'to_serial_queue'
 
-FROM_SERIAL_ROUTING_KEY = 'from_serial_routing_key'
-FROM_SERIAL_QUEUE = 'from_serial_queue' 
+# 指令追踪事件(取出/写入/应答时间)，由 ytj_web_service 消费
+TRACE_ROUTING_KEY = 'serial_trace_routing_key'
+# 写入指令后等待设备应答的最长时间(秒)，超时后不再关联
+TRACE_REPLY_TIMEOUT = 10
 
 # 串口配置
-SERIAL_PORT = "/dev/ttyACM0"  # 根据你的实际情况修改，Windows上可能是 "COM3"
+# 也可以是 pyserial 支持的URL，例如连接模拟器: socket://serial-simulator:7000
+SERIAL_PORT = os.getenv('SERIAL_PORT', "/dev/ttyACM0")  # 根据你的实际情况修改，Windows上可能是 "COM3"
+# 同时管理多台一体机时按 设备ID=串口 配置，例如 "default=/dev/ttyACM0,ytj2=/dev/ttyACM1"
+# 未配置时只管理 SERIAL_PORT 这一台默认设备
+SERIAL_PORTS = parse_device_ports(os.getenv('SERIAL_PORTS', '')) or {DEFAULT_DEVICE: SERIAL_PORT}
 SERIAL_BAUDRATE = 9600
-
-# 工作线程函数
-
-# 任务A: 负责从 RabbitMQ 消费消息，并写入串口
-def mq_to_serial_worker(serial_port):
-    """这个函数在一个独立的线程中运行"""
-    try:
-
-        retry_interval = 5
+# 串口断开后重新打开的间隔(秒)
+SERIAL_RETRY_INTERVAL = 3
+
+# 读到但还没发布到 RabbitMQ 的数据帧上限，超出后丢弃新帧
+FRAME_BACKLOG = int(os.getenv('FRAME_BACKLOG', 10000))
+# 落盘缓冲每批补发的帧数，以及补发失败后的重试间隔(秒)
+SPOOL_REPLAY_BATCH = 1000
+SPOOL_RETRY_INTERVAL = 3
+# 指令队列深度的采集间隔(秒)
+QUEUE_DEPTH_INTERVAL = 5
+
+# Prometheus 指标端口
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+
+# --- Prometheus 指标 ---
+FRAMES_IN = Counter('ytj_serial_frames_in_total', '从串口读到并发布到RabbitMQ的数据帧数', ['device'])
+FRAMES_OUT = Counter('ytj_serial_frames_out_total', '从RabbitMQ取出并写入串口的指令帧数', ['device'])
+BYTES_READ = Counter('ytj_serial_bytes_read_total', '从串口读取的字节数')
+BYTES_WRITTEN = Counter('ytj_serial_bytes_written_total', '写入串口的字节数')
+RESYNCS = Counter('ytj_serial_resyncs_total', '串口帧未对齐后重新同步的次数')
+BYTES_DROPPED = Counter('ytj_serial_bytes_dropped_total', '被丢弃的串口字节数', ['reason'])
+QUEUE_DEPTH = Gauge('ytj_serial_queue_depth', '指令队列中待写入串口的消息数', ['queue'])
+PUBLISH_LATENCY = Histogram(
+    'ytj_serial_publish_seconds', '发布一帧数据到RabbitMQ的耗时',
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+
+class SerialFrameProtocol(asyncio.Protocol):
+    """串口读取: 把收到的字节切成4字节帧放进发布队列，帧未对齐时丢弃到下一个结束字节"""
+
+    def __init__(self, device_id: str, frames: asyncio.Queue, recorder=None):
+        self.device_id = device_id
+        self.frames = frames
+        self.recorder = recorder
+        self.buffer = bytearray()
+        self.resyncing = False
+        self.lost = asyncio.get_running_loop().create_future()
+
+    def data_received(self, data):
+        t_read = time.time()
+        BYTES_READ.inc(len(data))
+        if self.recorder is not None:
+            self.recorder.rx(data, t_read)
+        buffer = self.buffer
+        buffer += data
         while True:
+            if self.resyncing:
+                end = buffer.find(FRAME_END)
+                if end < 0:
+                    BYTES_DROPPED.labels(reason="resync").inc(len(buffer))
+                    buffer.clear()
+                    return
+                BYTES_DROPPED.labels(reason="resync").inc(end + 1)
+                del buffer[:end + 1]
+                self.resyncing = False
+            if len(buffer) < FRAME_SIZE:
+                return
+            if buffer[FRAME_SIZE - 1] != FRAME_END:
+                # 帧未对齐: 丢弃这4个字节以及之后直到结束字节的内容，下一帧即从帧头开始
+                RESYNCS.inc()
+                BYTES_DROPPED.labels(reason="resync").inc(FRAME_SIZE)
+                del buffer[:FRAME_SIZE]
+                self.resyncing = True
+                continue
+            frame = bytes(buffer[:FRAME_SIZE])
+            del buffer[:FRAME_SIZE]
             try:
-                logger.info(f"正在尝试连接到 RabbitMQ at {MQ_HOST}:{MQ_PORT}...")
-                connection = pika.BlockingConnection(pika.ConnectionParameters(host=MQ_HOST, port=MQ_PORT, credentials=pika.PlainCredentials(MQ_USER, MQ_PASS), retry_delay=3, heartbeat=600))
-        
-                channel = connection.channel()
-
-                # 声明，确保存在
-                channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct', durable=True)
-                from_queue_args = {
-                    # 'x-message-ttl': 10000,
-                    # 'x-max-length': 100,
-                    # 'x-overflow': 'drop-head'
-                }
-                channel.queue_declare(queue=TO_SERIAL_QUEUE, durable=True, arguments=from_queue_args)
-                channel.queue_bind(queue=TO_SERIAL_QUEUE, exchange=EXCHANGE_NAME, routing_key=TO_SERIAL_ROUTING_KEY)
-
-                logger.info("✅ RabbitMQ 连接成功并完成设置!")
-                break
-            except pika.exceptions.AMQPConnectionError as e:
-                logger.error(f"RabbitMQ 连接失败: {e}. 将在 {retry_interval} 秒后重试...")
-                time.sleep(retry_interval)
-
-        logger.info(f'[MQ->SERIAL] 线程已启动，等待来自 {TO_SERIAL_QUEUE} 的消息...')
-
-        # 使用一个无限循环来持续轮询
+                self.frames.put_nowait((frame, t_read))
+            except asyncio.QueueFull:
+                BYTES_DROPPED.labels(reason="backlog").inc(FRAME_SIZE)
+
+    def flush(self, port: serial.SerialBase):
+        """清空接收缓冲区(包括操作系统里尚未读出的字节)，返回丢弃的字节数"""
+        flushed = len(self.buffer) + port.in_waiting
+        self.buffer.clear()
+        self.resyncing = False
+        port.reset_input_buffer()
+        return flushed
+
+    def connection_lost(self, exc):
+        if not self.lost.done():
+            self.lost.set_result(exc)
+
+
+class SerialDevice:
+    """一台一体机: 串口读写和它的指令队列、数据路由都在同一个事件循环里"""
+
+    def __init__(self, device_id: str, port: str):
+        self.device_id = device_id
+        self.port = port
+        self.to_serial_queue = scoped(TO_SERIAL_QUEUE, device_id)
+        self.to_serial_routing_key = scoped(TO_SERIAL_ROUTING_KEY, device_id)
+        self.routing_key = data_routing_key(device_id)
+        self.frames = asyncio.Queue(maxsize=FRAME_BACKLOG)
+        self.spool = FrameSpool(device_id)
+        self.spool_ready = asyncio.Event()
+        # 设置 RECORD_DIR 时记录串口收发的原始字节
+        self.recorder = open_recorder(device_id)
+        self.transport = None
+        self.protocol = None
+        self.connected = asyncio.Event()
+        # 等待应答的追踪指令: 应答操作码 -> (trace_id, 截止时间)
+        self.pending_replies = {}
+        self.frames_in = FRAMES_IN.labels(device=device_id)
+        self.frames_out = FRAMES_OUT.labels(device=device_id)
+
+    async def open(self):
+        self.transport, self.protocol = await serial_asyncio.create_serial_connection(
+            asyncio.get_running_loop(), lambda: SerialFrameProtocol(self.device_id, self.frames, self.recorder),
+            self.port, baudrate=SERIAL_BAUDRATE
+        )
+        self.connected.set()
+        logger.info(f"成功打开设备 {self.device_id} 的串口 {self.port}")
+
+    def close(self):
+        self.connected.clear()
+        if self.transport is not None:
+            self.transport.close()
+        self.spool.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    async def serial_keeper(self):
+        """串口断开后按间隔重新打开"""
         while True:
+            if self.protocol is not None:
+                exc = await self.protocol.lost
+                self.connected.clear()
+                logger.warning(f"[{self.device_id}] 串口 {self.port} 已断开: {exc}. 将在 {SERIAL_RETRY_INTERVAL} 秒后重新打开...")
+                self.transport = self.protocol = None
+            await asyncio.sleep(SERIAL_RETRY_INTERVAL)
             try:
-                # 尝试从队列中获取单条消息
-                # auto_ack=False 表示我们需要手动确认消息
-                method_frame, properties, body = channel.basic_get(queue=TO_SERIAL_QUEUE, auto_ack=False)
-
-                # 检查是否真的收到了消息
-                if method_frame:
-                    if serial_port and serial_port.is_open:
-                        logger.info(f" [✓] 消息 {body} 写到串口")
-                        ser.write(body)
-
-                        # 关闭示波器或万用表的时候，需要清除掉缓存区的内容
-                        if (body == bytes([0x07, 0x00, 0x00, 0xFE]) or body == bytes([0x01, 0x00, 0x00, 0xFE])):
-                            ser.read_all()
-
-                    # 手动确认消息，告诉 RabbitMQ 这条消息处理完了，可以删除了
-                    channel.basic_ack(method_frame.delivery_tag)
-                # 无论有没有消费到消息，都等待1秒
-                time.sleep(1)
-            except KeyboardInterrupt:
-                logger.error(" [!] Interrupted by user. Exiting.")
-                break
-            except pika.exceptions.ConnectionClosedByBroker:
-                # 如果连接因为长时间不活动而关闭，可以处理重连
-                logger.error(" [!] Connection closed by broker. Reconnecting...")
-                # (这里可以添加重连逻辑)
-                break
-            except Exception as e:
-                logger.error(f" [!] An error occurred: {e}")
-                break
-
-    except Exception as e:
-        logger.error(f"[MQ->SERIAL] 发生未知错误: {e}. 线程退出。")
-    finally:
-        if 'connection' in locals() and connection.is_open:
-            connection.close()
-
-
-# 任务B: 负责从串口读取数据，并发布到 RabbitMQ
-def serial_to_mq_worker(serial_port):
-    """这个函数在另一个独立的线程中运行"""
-    try:
-        retry_interval = 5
+                await self.open()
+            except (serial.SerialException, OSError) as e:
+                logger.error(f"[{self.device_id}] 无法打开串口 {self.port}: {e}")
+
+    async def on_command(self, message: aio_pika.abc.AbstractIncomingMessage, exchange: aio_pika.abc.AbstractExchange):
+        """写入一条指令; 确认消息前停留指令间隔，prefetch=1 保证同一设备的指令依次写入"""
+        # 串口未连接时先不确认，指令留在 RabbitMQ 里等串口恢复
+        if not self.connected.is_set():
+            logger.warning(f"[MQ->SERIAL][{self.device_id}] 串口未连接，指令等待串口恢复...")
+            await self.connected.wait()
+        async with message.process(requeue=True):
+            t_dequeue = time.time()
+            body = message.body
+            headers = message.headers or {}
+            interval = COMMAND_INTERVAL
+            if headers.get('dwell_ms'):
+                interval = max(interval, headers['dwell_ms'] / 1000)
+            trace_id = headers.get('trace_id')
+
+            logger.info(" [✓] [%s] 消息 %s 写到串口", self.device_id, body, extra=SERIAL_COMMAND_LOG)
+            if trace_id and body:
+                # 先登记再写入，避免应答先于登记到达
+                self.pending_replies[reply_opcode(body)] = (trace_id, t_dequeue + TRACE_REPLY_TIMEOUT)
+            self.transport.write(body)
+            t_write = time.time()
+            if self.recorder is not None:
+                self.recorder.tx(body, t_write)
+            self.frames_out.inc()
+            BYTES_WRITTEN.inc(len(body))
+            if trace_id:
+                await publish_trace(exchange, {"trace_id": trace_id, "device_id": self.device_id,
+                                               "t_dequeue": t_dequeue, "t_write": t_write})
+
+            # 关闭示波器或万用表的时候，需要清除掉缓存区的内容
+            if body in CLOSE_FRAMES:
+                BYTES_DROPPED.labels(reason="flush").inc(self.protocol.flush(self.transport.serial))
+
+            # 批量指令(斜坡/扫频)按间隔连续写入
+            await asyncio.sleep(interval)
+
+    def match_reply(self, frame: bytes):
+        """如果该帧是某条追踪指令的应答，取出并返回其 trace_id"""
+        pending = self.pending_replies.pop(frame[0], None)
+        if pending is None:
+            return None
+        trace_id, deadline = pending
+        return trace_id if time.time() <= deadline else None
+
+    def spool_frame(self, frame: bytes, t_read: float):
+        """RabbitMQ 不可用时把数据帧写入落盘缓冲，连接恢复后由 replayer 补发"""
+        if self.spool.append(frame, t_read):
+            self.spool_ready.set()
+        else:
+            BYTES_DROPPED.labels(reason="spool_full").inc(len(frame))
+
+    async def publisher(self, exchange: aio_pika.abc.AbstractExchange, data_exchange: aio_pika.abc.AbstractExchange,
+                        connection: aio_pika.abc.AbstractRobustConnection):
+        """把读到的数据帧发布到 topic 交换机"""
+        logger.info(f'[SERIAL->MQ][{self.device_id}] 正在转发串口 {self.port} 的数据到 {self.routing_key}...')
         while True:
+            frame, t_read = await self.frames.get()
+            # 缓冲中还有未补发的帧时新帧也先落盘，保证下游收到的顺序与读到的顺序一致
+            if self.spool.pending or not connection.connected.is_set():
+                self.spool_frame(frame, t_read)
+                continue
+            started = time.perf_counter()
             try:
-                logger.info(f"正在尝试连接到 RabbitMQ at {MQ_HOST}:{MQ_PORT}...")
-                connection = pika.BlockingConnection(pika.ConnectionParameters(host=MQ_HOST, port=MQ_PORT, credentials=pika.PlainCredentials(MQ_USER, MQ_PASS), retry_delay=3, heartbeat=600))
-                channel = connection.channel()
-
-                # 声明，确保存在
-                channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct', durable=True)
-                # 为from_serial_queue设置队列长度限制和丢弃策略
-                from_queue_args = {
-                    'x-max-length': 50,      # 队列最大长度50条消息
-                    'x-overflow': 'drop-head' # 当队列满时丢弃队头的旧消息
-                }
-                channel.queue_declare(queue=FROM_SERIAL_QUEUE, durable=True, arguments=from_queue_args)
-                channel.queue_bind(queue=FROM_SERIAL_QUEUE, exchange=EXCHANGE_NAME, routing_key=FROM_SERIAL_ROUTING_KEY)
-
-                logger.info("✅ RabbitMQ 连接成功并完成设置!")
-                break
-            except pika.exceptions.AMQPConnectionError as e:
-                logger.error(f"RabbitMQ 连接失败: {e}. 将在 {retry_interval} 秒后重试...")
-                time.sleep(retry_interval)
-
-        print(f'[SERIAL->MQ] 线程已启动，正在监听串口 {SERIAL_PORT}...')
-
+                await data_exchange.publish(
+                    # ts: 串口读到该帧的时间，供下游统计延迟
+                    aio_pika.Message(body=frame, headers={'ts': t_read}),
+                    routing_key=self.routing_key
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("[SERIAL->MQ][%s] 发布数据帧失败，写入落盘缓冲: %s", self.device_id, e,
+                               extra=SERIAL_FRAME_LOG)
+                self.spool_frame(frame, t_read)
+                continue
+            PUBLISH_LATENCY.observe(time.perf_counter() - started)
+            self.frames_in.inc()
+            if self.pending_replies:
+                trace_id = self.match_reply(frame)
+                if trace_id:
+                    await publish_trace(exchange, {"trace_id": trace_id, "device_id": self.device_id,
+                                                   "t_reply": t_read, "reply": frame.hex()})
+            logger.info("[SERIAL->MQ][%s] 数据 %s 已作为消息发布到 RabbitMQ", self.device_id, frame,
+                        extra=SERIAL_FRAME_LOG)
+
+    async def replayer(self, data_exchange: aio_pika.abc.AbstractExchange,
+                       connection: aio_pika.abc.AbstractRobustConnection):
+        """RabbitMQ 恢复后按顺序全速补发落盘缓冲中的数据帧"""
+        if self.spool.pending:
+            self.spool_ready.set()
         while True:
-            if serial_port and serial_port.is_open:
-                if (ser.in_waiting > 0):
-                    serial_data = serial_port.read(4)
-                    if len(serial_data) == 4:
-                        channel.basic_publish(
-                            exchange=EXCHANGE_NAME,
-                            routing_key=FROM_SERIAL_ROUTING_KEY,
-                            body=serial_data
-                        )
-                        print(f"[SERIAL->MQ] 数据 {serial_data} 已作为消息发布到 RabbitMQ")
-            else:
-                # 如果串口出问题了，可以等待一下再重试
-                print("[SERIAL->MQ] 警告: 串口未连接，等待3秒...")
-                time.sleep(3)
-
-    except serial.SerialException as e:
-        print(f"[SERIAL->MQ] 串口错误: {e}. 线程退出。")
+            await self.spool_ready.wait()
+            await connection.connected.wait()
+            records = self.spool.read(SPOOL_REPLAY_BATCH)
+            if not records:
+                self.spool_ready.clear()
+                continue
+            try:
+                for frame, t_read in records:
+                    await data_exchange.publish(
+                        aio_pika.Message(body=frame, headers={'ts': t_read, 'replayed': True}),
+                        routing_key=self.routing_key
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 本批从头重新补发，已发出的部分可能重复
+                logger.warning(f"[SERIAL->MQ][{self.device_id}] 补发落盘缓冲失败: {e}. 将在 {SPOOL_RETRY_INTERVAL} 秒后重试...")
+                await asyncio.sleep(SPOOL_RETRY_INTERVAL)
+                continue
+            self.spool.commit(len(records))
+            self.frames_in.inc(len(records))
+            if not self.spool.pending:
+                self.spool_ready.clear()
+                logger.info(f"[SERIAL->MQ][{self.device_id}] 落盘缓冲已全部补发")
+
+async def publish_trace(exchange: aio_pika.abc.AbstractExchange, event: dict):
+    """发布一条追踪事件，失败不影响指令和数据转发"""
+    try:
+        await exchange.publish(aio_pika.Message(body=json.dumps(event).encode()), routing_key=TRACE_ROUTING_KEY)
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        print(f"[SERIAL->MQ] 发生未知错误: {e}. 线程退出。")
-    finally:
-        if 'connection' in locals() and connection.is_open:
-            connection.close()
+        logger.warning(f"发布追踪事件失败: {e}")
 
 
-# 主程序入口
-if __name__ == "__main__":
-    # 初始化串口
-    ser = None
+async def declare_to_serial_queue(connection, channel, name: str):
+    """
+    声明有长度限制的指令队列。旧版本创建的同名队列没有长度参数，重新声明会失败并关闭通道，
+    所以先在临时通道上尝试；失败时沿用旧队列并提示删除
+    """
+    probe = await connection.channel()
     try:
-        ser = serial.Serial(SERIAL_PORT, SERIAL_BAUDRATE)
-        logger.info(f"成功打开串口 {SERIAL_PORT}")
-    except Exception as e:
-        logger.error(f"致命错误: 无法打开串口 {SERIAL_PORT}: {e}")
-        sys.exit(1)
-
+        await probe.declare_queue(name, durable=True, arguments=TO_SERIAL_QUEUE_ARGUMENTS)
+    except ChannelPreconditionFailed:
+        logger.warning(f"队列 '{name}' 已存在且没有长度限制，删除该队列并重启服务后生效")
+        return await channel.declare_queue(name, passive=True)
+    finally:
+        if not probe.is_closed:
+            await probe.close()
+    return await channel.declare_queue(name, durable=True, arguments=TO_SERIAL_QUEUE_ARGUMENTS)
 
-    # 创建线程
-    mq_consumer_thread = threading.Thread(target=mq_to_serial_worker, args=(ser,))
-    serial_reader_thread = threading.Thread(target=serial_to_mq_worker, args=(ser,))
 
-    # 设置为守护线程，这样主线程退出时它们也会被强制结束
-    mq_consumer_thread.daemon = True
-    serial_reader_thread.daemon = True
+async def queue_depth_worker(queues):
+    """定期采集各设备指令队列的积压消息数"""
+    while True:
+        for queue in queues:
+            try:
+                result = await queue.declare()
+                QUEUE_DEPTH.labels(queue=queue.name).set(result.message_count)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"获取队列 {queue.name} 深度失败: {e}")
+        await asyncio.sleep(QUEUE_DEPTH_INTERVAL)
+
+
+async def main():
+    # 初始化串口，每台设备一个
+    serial_devices = [SerialDevice(device_id, port) for device_id, port in SERIAL_PORTS.items()]
+    for device in serial_devices:
+        try:
+            await device.open()
+        except Exception as e:
+            logger.error(f"致命错误: 无法打开设备 {device.device_id} 的串口 {device.port}: {e}")
+            sys.exit(1)
+
+    # 一个自动重连的连接: 断线后 aio-pika 重新建立通道、声明交换机和队列并恢复消费，
+    # 未确认的指令由 RabbitMQ 重新投递，不会丢失
+    retry_interval = 5
+    while True:
+        try:
+            logger.info(f"正在尝试连接到 RabbitMQ at {MQ_HOST}:{MQ_PORT}...")
+            connection = await aio_pika.connect_robust(
+                host=MQ_HOST, port=MQ_PORT, login=MQ_USER, password=MQ_PASS, heartbeat=MQ_HEARTBEAT
+            )
+            break
+        except Exception as e:
+            logger.error(f"RabbitMQ 连接失败: {e}. 将在 {retry_interval} 秒后重试...")
+            await asyncio.sleep(retry_interval)
+    connection.reconnect_callbacks.add(lambda *args: logger.info("✅ RabbitMQ 已重新连接，消费已恢复"))
+
+    tasks = []
+    try:
+        # 数据帧和追踪事件走不带发布确认的通道，与原来的 basic_publish 一致，不为每帧等待 broker 回执
+        publish_channel = await connection.channel(publisher_confirms=False)
+        exchange = await publish_channel.declare_exchange(EXCHANGE_NAME, aio_pika.ExchangeType.DIRECT, durable=True)
+        data_exchange = await publish_channel.declare_exchange(SERIAL_DATA_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+
+        # 指令通道: 每个消费者最多一条未确认的指令，同一设备的指令严格按顺序写入
+        command_channel = await connection.channel()
+        await command_channel.set_qos(prefetch_count=1)
+        command_exchange = await command_channel.declare_exchange(EXCHANGE_NAME, aio_pika.ExchangeType.DIRECT, durable=True)
+
+        queues = []
+        for device in serial_devices:
+            queue = await declare_to_serial_queue(connection, command_channel, device.to_serial_queue)
+            await queue.bind(command_exchange, routing_key=device.to_serial_routing_key)
+            await queue.consume(lambda message, device=device: device.on_command(message, exchange))
+            queues.append(queue)
+            logger.info(f'[MQ->SERIAL][{device.device_id}] 等待来自 {device.to_serial_queue} 的消息...')
+
+            tasks.append(asyncio.create_task(device.publisher(exchange, data_exchange, connection)))
+            tasks.append(asyncio.create_task(device.replayer(data_exchange, connection)))
+            tasks.append(asyncio.create_task(device.serial_keeper()))
+        tasks.append(asyncio.create_task(queue_depth_worker(queues)))
+        logger.info("✅ RabbitMQ 连接成功并完成设置!")
+
+        logger.info(f"[MAIN] {len(serial_devices)} 台设备的串口读写已启动。程序正在运行...")
+        logger.info("[MAIN] 按下 Ctrl+C 退出程序。")
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for device in serial_devices:
+            device.close()
+        logger.info("[MAIN] 串口已关闭。")
+        await connection.close()
 
-    # 启动线程
-    mq_consumer_thread.start()
-    serial_reader_thread.start()
 
-    logger.info("\n[MAIN] 两个工作线程已启动。程序正在运行...")
-    logger.info("[MAIN] 按下 Ctrl+C 退出程序。\n")
+# 主程序入口
+if __name__ == "__main__":
+    # 启动 Prometheus 指标服务
+    start_http_server(METRICS_PORT)
+    logger.info(f"Prometheus 指标服务已启动，端口 {METRICS_PORT}")
 
-    # 主线程在这里保持运行，直到用户按下 Ctrl+C
     try:
-        # 保持主线程存活，让守护线程工作
-        while True:
-            time.sleep(1)
+        asyncio.run(main())
     except KeyboardInterrupt:
-        logger.info("\n[MAIN] 收到 Ctrl+C，正在关闭程序...")
-    finally:
-        if ser and ser.is_open:
-            ser.close()
-            logger.info("[MAIN] 串口已关闭。")
-        logger.info("[MAIN] 程序退出。")
+        logger.info("[MAIN] 收到 Ctrl+C，正在关闭程序...")
+    logger.info("[MAIN] 程序退出。")
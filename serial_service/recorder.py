@@ -0,0 +1,99 @@
+"""
+串口收发记录
+设置 RECORD_DIR 后，串口服务把每台设备串口上收发的原始字节连同时间戳追加写入二进制记录文件，
+用于复现现场问题，以及在没有硬件的情况下用真实的示波器数据压测 web 服务的解码和分发链路
+(python simulator.py --replay <文件> --speed 1，见 simulator.py)。
+- 文件头8字节 RECORD_MAGIC，之后每条记录: 时间(float64，小端) + 方向(1字节) + 长度(uint16) + 原始字节
+- 接收方向按串口实际读到的字节块记录，不做分帧，帧未对齐、丢字节等现场问题可以原样复现
+- 每台设备每次启动一个文件 <设备ID>-<启动时间>.ytjrec，超过 RECORD_MAX_BYTES 后停止记录
+"""
+import logging
+import os
+import struct
+import time
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+# 记录文件目录，为空时不记录
+RECORD_DIR = os.getenv('RECORD_DIR', '')
+# 单个记录文件的大小上限，默认256MB
+RECORD_MAX_BYTES = int(os.getenv('RECORD_MAX_BYTES', 256 * 1024 * 1024))
+
+RECORD_MAGIC = b'YTJREC1\n'
+RECORD_HEADER = struct.Struct('<dBH')
+RECORD_SUFFIX = '.ytjrec'
+# 方向: 从设备读到(rx)、写入设备(tx)
+DIRECTION_RX, DIRECTION_TX = 0, 1
+DIRECTIONS = {DIRECTION_RX: "rx", DIRECTION_TX: "tx"}
+# 单条记录的最大字节数，更长的字节块拆成多条
+MAX_CHUNK = 0xFFFF
+
+RECORD_BYTES = Counter('ytj_serial_record_bytes_total', '写入记录文件的串口字节数', ['device', 'direction'])
+
+
+class SerialRecorder:
+    """单台设备的串口收发记录"""
+
+    def __init__(self, device_id: str, record_dir: str = RECORD_DIR, max_bytes: int = RECORD_MAX_BYTES):
+        self.device_id = device_id
+        self.max_bytes = max_bytes
+        os.makedirs(record_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(record_dir, f"{device_id}-{stamp}{RECORD_SUFFIX}")
+        self.file = open(self.path, 'ab')
+        self.file.write(RECORD_MAGIC)
+        self.size = len(RECORD_MAGIC)
+        self.counters = {direction: RECORD_BYTES.labels(device=device_id, direction=name)
+                         for direction, name in DIRECTIONS.items()}
+        logger.info(f"[{device_id}] 串口收发记录写入 {self.path}")
+
+    def write(self, direction: int, data: bytes, ts: float = None):
+        if self.file is None or not data:
+            return
+        ts = time.time() if ts is None else ts
+        for start in range(0, len(data), MAX_CHUNK):
+            chunk = data[start:start + MAX_CHUNK]
+            if self.size + RECORD_HEADER.size + len(chunk) > self.max_bytes:
+                logger.warning(f"[{self.device_id}] 记录文件 {self.path} 已达到 {self.max_bytes} 字节，停止记录")
+                self.close()
+                return
+            self.file.write(RECORD_HEADER.pack(ts, direction, len(chunk)))
+            self.file.write(chunk)
+            self.size += RECORD_HEADER.size + len(chunk)
+            self.counters[direction].inc(len(chunk))
+
+    def rx(self, data: bytes, ts: float = None):
+        self.write(DIRECTION_RX, data, ts)
+
+    def tx(self, data: bytes, ts: float = None):
+        self.write(DIRECTION_TX, data, ts)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def open_recorder(device_id: str):
+    """按 RECORD_DIR 配置创建记录器，未配置时返回 None"""
+    if not RECORD_DIR:
+        return None
+    return SerialRecorder(device_id)
+
+
+def read_records(path: str):
+    """按顺序读出记录文件中的 (时间, 方向, 字节)，末尾写了一半的记录会被忽略"""
+    with open(path, 'rb') as f:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError(f"{path} 不是串口收发记录文件")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            ts, direction, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield ts, direction, data
@@ -0,0 +1,342 @@
+"""
+一体机串口设备模拟器
+实现4字节串口协议，在没有真实 /dev/ttyACM0 的环境(笔记本、CI)中驱动整条链路:
+- 示波器/万用表打开后按配置的速率持续上报数据帧
+- 温度、测距、手势、光照等传感器指令按配置的延迟和抖动应答
+- LED、电源、信号发生器指令回显状态帧
+
+两种接入方式:
+- pty: 创建伪终端对，并把从端链接到 --link 路径，serial_service 设置 SERIAL_PORT 为该路径即可
+      python simulator.py --link /tmp/ttyYTJ
+- tcp: 监听TCP端口，serial_service 设置 SERIAL_PORT=socket://<host>:<port>
+      python simulator.py --tcp 7000
+
+回放模式: 不模拟协议，把串口服务记录的收发文件(RECORD_DIR，见 recorder.py)中设备上报的字节按原始时间间隔重新发出，
+--speed 为回放倍速，max 表示不等待、全速发送；写入的指令只读取丢弃
+      python simulator.py --tcp 7000 --replay default-20250101-120000.ytjrec --speed 10
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+import tty
+
+from protocol import (CMD_CLOSE_MULTIMETER, CMD_CLOSE_OSCILLOSCOPE, FRAME_END, FRAME_SIZE, LED_COMMANDS,
+                      MODE_BY_OPCODE, OP_DISTANCE, OP_GESTURE, OP_LIGHT, OP_POWER_SUPPLY, OP_SIGNAL_GENERATOR,
+                      OP_SIGNAL_GENERATOR_REPORT, OP_TEMPERATURE, VOLTAGE_RESOLUTION, encode, encode_bytes,
+                      frame_value)
+from recorder import DIRECTION_RX, read_records
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+LED_OPCODES = frozenset(LED_COMMANDS.values())
+
+
+class PtyTransport:
+    """伪终端传输，从端路径通过符号链接暴露给串口服务"""
+
+    def __init__(self, link_path: str):
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        self.slave_name = os.ttyname(slave)
+        self.connected = threading.Event()
+        self.connected.set()
+        self._slave = slave  # 保持从端打开，避免串口服务未连接时读到EOF
+        self.link_path = link_path
+        if os.path.lexists(link_path):
+            os.unlink(link_path)
+        os.symlink(self.slave_name, link_path)
+        logger.info(f"模拟串口已创建: {link_path} -> {self.slave_name}")
+
+    def read(self, n: int) -> bytes:
+        return os.read(self.master, n)
+
+    def write(self, data: bytes):
+        os.write(self.master, data)
+
+    def close(self):
+        if os.path.islink(self.link_path):
+            os.unlink(self.link_path)
+        os.close(self.master)
+        os.close(self._slave)
+
+
+class TcpTransport:
+    """TCP传输，供 pyserial 的 socket:// URL 连接，只服务一个客户端"""
+
+    def __init__(self, port: int, host: str = '0.0.0.0'):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.conn = None
+        self.connected = threading.Event()
+        logger.info(f"模拟串口正在监听 tcp://{host}:{port}")
+
+    def _accept(self):
+        self.conn, addr = self.server.accept()
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected.set()
+        logger.info(f"串口服务已连接: {addr}")
+
+    def read(self, n: int) -> bytes:
+        while True:
+            if self.conn is None:
+                self._accept()
+            data = self.conn.recv(n)
+            if data:
+                return data
+            logger.info("串口服务已断开，等待重新连接")
+            self.connected.clear()
+            self.conn.close()
+            self.conn = None
+
+    def write(self, data: bytes):
+        conn = self.conn
+        if conn is None:
+            return
+        try:
+            conn.sendall(data)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+        self.server.close()
+
+
+class DeviceSimulator:
+    """模拟一体机的协议行为"""
+
+    def __init__(self, transport, scope_rate: float, meter_rate: float,
+                 latency_ms: float, jitter_ms: float, seed: int = None):
+        self.transport = transport
+        self.scope_rate = scope_rate
+        self.meter_rate = meter_rate
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.random = random.Random(seed)
+        self.write_lock = threading.Lock()
+        self.stream_mode = None   # 当前串流档位
+        self.voltage = 1.0        # 电源设置电压
+        self.frequency = 1        # 信号发生器频率
+        self.running = True
+        self.frames_out = 0
+
+    def send(self, frame: bytes):
+        with self.write_lock:
+            self.transport.write(frame)
+            self.frames_out += 1
+
+    def send_later(self, frame: bytes):
+        """按配置的延迟和抖动异步应答"""
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        timer = threading.Timer(delay, self.send, args=(frame,))
+        timer.daemon = True
+        timer.start()
+
+    # --- 指令处理 ---
+    def handle(self, frame: bytes):
+        opcode = frame[0]
+        mode = MODE_BY_OPCODE[opcode]
+        if mode is not None:
+            self.stream_mode = mode
+            logger.info(f"切换到 {mode.name}")
+        elif frame in (CMD_CLOSE_OSCILLOSCOPE, CMD_CLOSE_MULTIMETER):
+            self.stream_mode = None
+            self.send(frame)
+        elif opcode in LED_OPCODES:
+            self.send(frame)
+        elif opcode == OP_POWER_SUPPLY:
+            self.voltage = frame_value(frame) * VOLTAGE_RESOLUTION
+            self.send(frame)
+        elif opcode == OP_SIGNAL_GENERATOR:
+            self.frequency = max(frame[2], 1)
+            self.send(encode_bytes(OP_SIGNAL_GENERATOR_REPORT, frame[1], frame[2]))
+        elif opcode == OP_TEMPERATURE:
+            self.send_later(encode_bytes(OP_TEMPERATURE, 25 + self.random.randint(-2, 2),
+                                         50 + self.random.randint(-5, 5)))
+        elif opcode == OP_DISTANCE:
+            self.send_later(encode(OP_DISTANCE, int(self.random.uniform(50, 500) * 10)))
+        elif opcode == OP_GESTURE:
+            self.send_later(encode_bytes(OP_GESTURE, 0, self.random.randint(1, 4)))
+        elif opcode == OP_LIGHT:
+            self.send_later(encode(OP_LIGHT, self.random.randint(100, 800)))
+        else:
+            logger.warning(f"未知指令: {frame.hex()}")
+
+    def command_loop(self):
+        buf = b''
+        while self.running:
+            try:
+                data = self.transport.read(64)
+            except OSError:
+                time.sleep(0.1)
+                continue
+            buf += data
+            while len(buf) >= FRAME_SIZE:
+                if buf[FRAME_SIZE - 1] != FRAME_END:
+                    # 帧未对齐，丢弃一个字节重新同步
+                    buf = buf[1:]
+                    continue
+                frame, buf = buf[:FRAME_SIZE], buf[FRAME_SIZE:]
+                self.handle(frame)
+
+    # --- 数据流 ---
+    def sample(self, mode, t: float) -> int:
+        """按档位生成一个原始16位数值"""
+        key = mode.key
+        noise = self.random.gauss(0, 1)
+        if key == "oscilloscope":
+            volts = 2.5 + 2.0 * math.sin(2 * math.pi * self.frequency * t) + 0.02 * noise
+            return int(max(volts, 0) * 100)
+        if key == "resistance":
+            return int(1000 + 5 * noise)
+        if key == "continuity":
+            return 1
+        if key == "dc_voltage":
+            return int(max(self.voltage + 0.01 * noise, 0) * 100)
+        if key == "ac_voltage":
+            return int((2.3 + 0.02 * noise) * 100)
+        if key == "dc_current":
+            return int((0.12 + 0.002 * noise) * 100)
+        return 0
+
+    def stream_loop(self):
+        next_time = time.monotonic()
+        while self.running:
+            mode = self.stream_mode
+            if mode is None:
+                time.sleep(0.05)
+                next_time = time.monotonic()
+                continue
+            rate = self.scope_rate if mode.key == "oscilloscope" else self.meter_rate
+            if rate <= 0:
+                time.sleep(0.05)
+                continue
+            value = max(0, min(self.sample(mode, time.time()), 0xFFFF))
+            self.send(encode(mode.open_frame[0], value))
+            next_time += 1 / rate
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1:
+                # 落后太多时重新对齐，避免突发补发
+                next_time = time.monotonic()
+
+    def run(self):
+        threads = [
+            threading.Thread(target=self.command_loop, daemon=True),
+            threading.Thread(target=self.stream_loop, daemon=True),
+        ]
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                time.sleep(5)
+                logger.info(f"已发送 {self.frames_out} 帧，当前档位: "
+                            f"{self.stream_mode.name if self.stream_mode else '无'}")
+        except KeyboardInterrupt:
+            logger.info("模拟器退出")
+        finally:
+            self.running = False
+            self.transport.close()
+
+
+class LogReplayer:
+    """按记录的时间间隔回放设备上报的字节，speed 为倍速，0 表示全速"""
+
+    def __init__(self, transport, path: str, speed: float, loop: bool = False):
+        self.transport = transport
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.running = True
+        self.bytes_out = 0
+        self.commands = 0
+
+    def drain_loop(self):
+        """读取并丢弃串口服务写入的指令；TCP 模式下同时负责接受连接"""
+        while self.running:
+            try:
+                self.commands += len(self.transport.read(64)) // FRAME_SIZE
+            except OSError:
+                time.sleep(0.1)
+
+    def replay(self):
+        first = None
+        for ts, direction, data in read_records(self.path):
+            if not self.running:
+                return
+            if direction != DIRECTION_RX:
+                continue
+            if first is None:
+                first, started = ts, time.monotonic()
+            elif self.speed > 0:
+                delay = started + (ts - first) / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.transport.write(data)
+            self.bytes_out += len(data)
+
+    def run(self):
+        threading.Thread(target=self.drain_loop, daemon=True).start()
+        try:
+            while self.running:
+                self.transport.connected.wait()
+                started = time.monotonic()
+                self.replay()
+                elapsed = time.monotonic() - started
+                logger.info(f"回放完成: {self.path}，已发送 {self.bytes_out} 字节，用时 {elapsed:.1f} 秒，"
+                            f"收到 {self.commands} 条指令")
+                if not self.loop:
+                    # 保持连接，等待串口服务把剩余数据读完
+                    while True:
+                        time.sleep(5)
+        except KeyboardInterrupt:
+            logger.info("模拟器退出")
+        finally:
+            self.running = False
+            self.transport.close()
+
+
+def replay_speed(value: str) -> float:
+    if value == 'max':
+        return 0.0
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("回放倍速必须大于0，或者为 max")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="一体机串口设备模拟器")
+    parser.add_argument('--link', default='/tmp/ttyYTJ', help="pty模式下从端的符号链接路径")
+    parser.add_argument('--tcp', type=int, help="以TCP模式监听该端口，代替pty")
+    parser.add_argument('--scope-rate', type=float, default=200, help="示波器上报速率(帧/秒)")
+    parser.add_argument('--meter-rate', type=float, default=5, help="万用表上报速率(帧/秒)")
+    parser.add_argument('--latency-ms', type=float, default=50, help="传感器应答延迟(毫秒)")
+    parser.add_argument('--jitter-ms', type=float, default=10, help="传感器应答延迟抖动(毫秒)")
+    parser.add_argument('--seed', type=int, help="随机数种子，便于复现")
+    parser.add_argument('--replay', help="回放串口服务记录的收发文件，代替协议模拟")
+    parser.add_argument('--speed', type=replay_speed, default=1.0, help="回放倍速，max 表示全速")
+    parser.add_argument('--loop', action='store_true', help="回放结束后从头循环")
+    args = parser.parse_args()
+
+    transport = TcpTransport(args.tcp) if args.tcp else PtyTransport(args.link)
+    if args.replay:
+        LogReplayer(transport, args.replay, args.speed, args.loop).run()
+        return
+    DeviceSimulator(transport, args.scope_rate, args.meter_rate,
+                    args.latency_ms, args.jitter_ms, args.seed).run()
+
+
+if __name__ == "__main__":
+    main()
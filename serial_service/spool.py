@@ -0,0 +1,167 @@
+"""
+串口数据帧的本地落盘缓冲
+RabbitMQ 不可用时，串口服务把读到的数据帧追加写入本地分段文件，连接恢复后按原顺序全速补发。
+- 每条记录12字节: 串口读到该帧的时间(float64，小端) + 4字节帧
+- 每台设备一个目录，段文件按序号命名，写满 SPOOL_SEGMENT_BYTES 后换新段，补发完的段直接删除
+- 总大小超过 SPOOL_MAX_BYTES 时按 SPOOL_DROP_POLICY 丢弃: drop-oldest 删除最旧的段，drop-newest 拒绝新帧
+- 最后写入时间早于 SPOOL_RETENTION 秒之前的段不再补发，直接删除
+
+进程重启后会接着补发目录中残留的段。已补发的位置只记在内存里，进程在补发中途退出时，当前段会从头重新补发。
+"""
+import logging
+import os
+import struct
+import time
+from collections import deque
+
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', '/tmp/ytj_spool')
+# 每台设备落盘缓冲的总大小上限
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', 64 * 1024 * 1024))
+# 单个段文件的大小
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', 1024 * 1024))
+# 超过该时长(秒)的缓冲数据不再补发，默认1小时
+SPOOL_RETENTION = float(os.getenv('SPOOL_RETENTION', 3600))
+# 缓冲满时的丢弃策略: drop-oldest 或 drop-newest
+SPOOL_DROP_POLICY = os.getenv('SPOOL_DROP_POLICY', 'drop-oldest')
+DROP_POLICIES = ('drop-oldest', 'drop-newest')
+
+RECORD = struct.Struct('<d4s')
+
+SPOOL_FRAMES = Counter('ytj_serial_spool_frames_total', '落盘缓冲的数据帧数', ['device', 'event'])
+SPOOL_BYTES = Gauge('ytj_serial_spool_bytes', '落盘缓冲中尚未补发的字节数', ['device'])
+
+
+class FrameSpool:
+    """单台设备的追加写入分段缓冲"""
+
+    def __init__(self, device_id: str, spool_dir: str = SPOOL_DIR, max_bytes: int = SPOOL_MAX_BYTES,
+                 segment_bytes: int = SPOOL_SEGMENT_BYTES, retention: float = SPOOL_RETENTION,
+                 policy: str = SPOOL_DROP_POLICY):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"无效的丢弃策略: {policy}，可选 {', '.join(DROP_POLICIES)}")
+        self.device_id = device_id
+        self.directory = os.path.join(spool_dir, device_id)
+        self.max_bytes = max_bytes
+        # 段大小取记录大小的整数倍，保证记录不跨段
+        self.segment_bytes = max(RECORD.size, segment_bytes - segment_bytes % RECORD.size)
+        self.retention = retention
+        self.policy = policy
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.segments = deque()  # 段序号，最旧的在前
+        self.sizes = {}          # 段序号 -> 字节数
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.seg'):
+                continue
+            seq = int(name[:-4])
+            # 上次进程退出时可能只写了半条记录，按整条记录截断
+            size = os.path.getsize(self.segment_path(seq))
+            self.segments.append(seq)
+            self.sizes[seq] = size - size % RECORD.size
+        self.writer = None        # 当前写入段(始终是最新的段)
+        self.read_offset = 0      # 最旧段中已补发的字节数
+        self.unread = sum(self.sizes.values())
+        self._set_gauge()
+        if self.unread:
+            logger.info(f"[{device_id}] 落盘缓冲中有 {len(self)} 帧待补发")
+
+    def segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:012d}.seg")
+
+    def __len__(self):
+        return self.unread // RECORD.size
+
+    @property
+    def pending(self) -> bool:
+        return self.unread > 0
+
+    def append(self, frame: bytes, t_read: float) -> bool:
+        """追加一帧，缓冲已满且策略为 drop-newest 时返回 False"""
+        if self.unread + RECORD.size > self.max_bytes:
+            if self.policy == 'drop-newest' or not self._drop_oldest():
+                SPOOL_FRAMES.labels(device=self.device_id, event="dropped").inc()
+                return False
+        writer = self._writer()
+        writer.write(RECORD.pack(t_read, frame))
+        self.sizes[self.segments[-1]] += RECORD.size
+        self.unread += RECORD.size
+        SPOOL_FRAMES.labels(device=self.device_id, event="spooled").inc()
+        self._set_gauge()
+        return True
+
+    def read(self, max_records: int):
+        """从最旧的未补发位置读出最多 max_records 帧，补发成功后调用 commit"""
+        self._expire()
+        if not self.segments:
+            return []
+        seq = self.segments[0]
+        if self.writer is not None and seq == self.segments[-1]:
+            self.writer.flush()
+        with open(self.segment_path(seq), 'rb') as f:
+            f.seek(self.read_offset)
+            data = f.read(min(max_records * RECORD.size, self.sizes[seq] - self.read_offset))
+        data = data[:len(data) - len(data) % RECORD.size]
+        return [(frame, t_read) for t_read, frame in RECORD.iter_unpack(data)]
+
+    def commit(self, count: int):
+        """确认最旧的 count 帧已补发"""
+        nbytes = count * RECORD.size
+        self.read_offset += nbytes
+        self.unread -= nbytes
+        SPOOL_FRAMES.labels(device=self.device_id, event="replayed").inc(count)
+        seq = self.segments[0]
+        if self.read_offset >= self.sizes[seq]:
+            self._remove_head()
+        self._set_gauge()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def _writer(self):
+        if self.writer is not None and self.sizes[self.segments[-1]] < self.segment_bytes:
+            return self.writer
+        self.close()
+        seq = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(seq)
+        self.sizes[seq] = 0
+        self.writer = open(self.segment_path(seq), 'ab')
+        return self.writer
+
+    def _remove_head(self):
+        """删除最旧的段，返回其中未补发的帧数"""
+        seq = self.segments.popleft()
+        remaining = self.sizes.pop(seq) - self.read_offset
+        self.read_offset = 0
+        self.unread -= remaining
+        if self.writer is not None and not self.segments:
+            self.close()
+        try:
+            os.remove(self.segment_path(seq))
+        except FileNotFoundError:
+            pass
+        return remaining // RECORD.size
+
+    def _drop_oldest(self) -> bool:
+        # 正在写入的段不能删除
+        if len(self.segments) < 2:
+            return False
+        dropped = self._remove_head()
+        SPOOL_FRAMES.labels(device=self.device_id, event="dropped").inc(dropped)
+        logger.warning(f"[{self.device_id}] 落盘缓冲已满，丢弃最旧的 {dropped} 帧")
+        return True
+
+    def _expire(self):
+        deadline = time.time() - self.retention
+        while len(self.segments) > 1 and os.path.getmtime(self.segment_path(self.segments[0])) < deadline:
+            expired = self._remove_head()
+            SPOOL_FRAMES.labels(device=self.device_id, event="expired").inc(expired)
+            logger.warning(f"[{self.device_id}] 落盘缓冲中 {expired} 帧已超过保留时长，不再补发")
+
+    def _set_gauge(self):
+        SPOOL_BYTES.labels(device=self.device_id).set(self.unread)
@@ -0,0 +1,51 @@
+import pytest
+
+from recorder import DIRECTION_RX, DIRECTION_TX, MAX_CHUNK, RECORD_HEADER, RECORD_MAGIC, SerialRecorder, read_records
+
+
+def test_round_trip(tmp_path):
+    recorder = SerialRecorder("default", record_dir=str(tmp_path))
+    recorder.rx(b"\x08\x01\x02\xfe\x08", ts=10.0)
+    recorder.tx(b"\x08\x00\x01\xfe", ts=10.5)
+    recorder.rx(b"", ts=11.0)  # 空字节块不记录
+    recorder.close()
+    assert list(read_records(recorder.path)) == [
+        (10.0, DIRECTION_RX, b"\x08\x01\x02\xfe\x08"),
+        (10.5, DIRECTION_TX, b"\x08\x00\x01\xfe"),
+    ]
+
+
+def test_long_chunks_are_split(tmp_path):
+    recorder = SerialRecorder("default", record_dir=str(tmp_path))
+    data = bytes(range(256)) * 300
+    recorder.rx(data, ts=1.0)
+    recorder.close()
+    records = list(read_records(recorder.path))
+    assert [len(chunk) for _, _, chunk in records] == [MAX_CHUNK, len(data) - MAX_CHUNK]
+    assert b"".join(chunk for _, _, chunk in records) == data
+
+
+def test_stops_at_max_bytes(tmp_path):
+    limit = len(RECORD_MAGIC) + 2 * (RECORD_HEADER.size + 4)
+    recorder = SerialRecorder("default", record_dir=str(tmp_path), max_bytes=limit)
+    for i in range(5):
+        recorder.tx(bytes([i] * 4), ts=float(i))
+    assert recorder.file is None
+    assert [ts for ts, _, _ in read_records(recorder.path)] == [0.0, 1.0]
+
+
+def test_truncated_tail_is_ignored(tmp_path):
+    recorder = SerialRecorder("default", record_dir=str(tmp_path))
+    recorder.rx(b"abcd", ts=1.0)
+    recorder.rx(b"efgh", ts=2.0)
+    recorder.close()
+    with open(recorder.path, 'r+b') as f:
+        f.truncate(len(RECORD_MAGIC) + RECORD_HEADER.size + 4 + RECORD_HEADER.size + 2)
+    assert list(read_records(recorder.path)) == [(1.0, DIRECTION_RX, b"abcd")]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "capture.bin"
+    path.write_bytes(b"not a recording")
+    with pytest.raises(ValueError):
+        list(read_records(str(path)))
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from spool import RECORD, FrameSpool
+
+
+def frame(i: int) -> bytes:
+    return bytes([0x08, i >> 8 & 0xFF, i & 0xFF, 0xFE])
+
+
+def spool_of(tmp_path, **kwargs) -> FrameSpool:
+    return FrameSpool("default", spool_dir=str(tmp_path), **kwargs)
+
+
+def drain(spool: FrameSpool, batch: int = 7):
+    replayed = []
+    while spool.pending:
+        records = spool.read(batch)
+        replayed.extend(records)
+        spool.commit(len(records))
+    return replayed
+
+
+def test_replays_in_order_across_segments(tmp_path):
+    spool = spool_of(tmp_path, segment_bytes=RECORD.size * 4)
+    for i in range(10):
+        assert spool.append(frame(i), 1000.0 + i)
+    assert len(spool) == 10
+    assert len(os.listdir(spool.directory)) == 3
+
+    assert drain(spool) == [(frame(i), 1000.0 + i) for i in range(10)]
+    assert len(spool) == 0
+    # 补发完的段被删除，正在写入的最新段除外
+    assert len(os.listdir(spool.directory)) <= 1
+    spool.close()
+
+
+def test_segment_size_is_a_whole_number_of_records(tmp_path):
+    assert spool_of(tmp_path, segment_bytes=RECORD.size * 3 + 5).segment_bytes == RECORD.size * 3
+
+
+def test_drop_oldest_removes_the_oldest_segment(tmp_path):
+    spool = spool_of(tmp_path, segment_bytes=RECORD.size * 2, max_bytes=RECORD.size * 4)
+    for i in range(6):
+        assert spool.append(frame(i), float(i))
+    assert [f for f, _ in drain(spool)] == [frame(i) for i in range(2, 6)]
+    spool.close()
+
+
+def test_drop_newest_rejects_new_frames(tmp_path):
+    spool = spool_of(tmp_path, segment_bytes=RECORD.size * 2, max_bytes=RECORD.size * 4, policy="drop-newest")
+    results = [spool.append(frame(i), float(i)) for i in range(6)]
+    assert results == [True] * 4 + [False] * 2
+    assert [f for f, _ in drain(spool)] == [frame(i) for i in range(4)]
+    spool.close()
+
+
+def test_invalid_policy(tmp_path):
+    with pytest.raises(ValueError):
+        spool_of(tmp_path, policy="drop-all")
+
+
+def test_expired_segments_are_not_replayed(tmp_path):
+    spool = spool_of(tmp_path, segment_bytes=RECORD.size * 2, retention=60)
+    for i in range(5):
+        spool.append(frame(i), float(i))
+    old = os.path.getmtime(spool.segment_path(spool.segments[0])) - 120
+    os.utime(spool.segment_path(spool.segments[0]), (old, old))
+    assert [f for f, _ in drain(spool)] == [frame(i) for i in range(2, 5)]
+    spool.close()
+
+
+def test_restart_resumes_and_truncates_partial_records(tmp_path):
+    spool = spool_of(tmp_path, segment_bytes=RECORD.size * 4)
+    for i in range(3):
+        spool.append(frame(i), float(i))
+    spool.close()
+    # 进程退出时只写了半条记录
+    with open(spool.segment_path(spool.segments[-1]), 'ab') as f:
+        f.write(b'\x01\x02\x03')
+
+    restarted = spool_of(tmp_path, segment_bytes=RECORD.size * 4)
+    assert len(restarted) == 3
+    restarted.append(frame(3), 3.0)
+    assert drain(restarted) == [(frame(i), float(i)) for i in range(4)]
+    restarted.close()
@@ -1,6 +1,24 @@
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+from collections import deque
+
 from fastmcp import FastMCP
+from fastmcp.server.dependencies import get_context
+import httpx
+from prometheus_client import Counter, Histogram, start_http_server
 import requests
 
+from logging_setup import setup_logging
+from protocol import CHANNEL_INDEX, STREAM_MODES
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
 mcp = FastMCP("Start Yitiji MCP Server")
 
 # 重要提示：
@@ -11,202 +29,685 @@ mcp = FastMCP("Start Yitiji MCP Server")
 
 YTJ_API_URL = "http://ytjweb-service:8000"
 
-# --- LED 控制 ---
+# 未指定设备ID时操作的一体机
+DEFAULT_DEVICE = "default"
+
+# Prometheus 指标端口
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9101))
+
+# 请求 ytjweb-service 的超时(秒)
+API_TIMEOUT = 5
+# 发给 web 服务的 X-Client-Id 前缀；web 服务按它为每个 MCP 会话单独限速，智能体之间不共用同一个IP的令牌桶
+MCP_CLIENT_ID = os.getenv('MCP_CLIENT_ID', 'mcp')
+
+TOOL_LATENCY = Histogram(
+    'ytj_mcp_tool_seconds', 'MCP工具调用耗时', ['tool'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+TOOL_ERRORS = Counter('ytj_mcp_tool_errors_total', 'MCP工具调用失败次数', ['tool'])
+TOOL_RATE_LIMITED = Counter('ytj_mcp_tool_rate_limited_total', 'MCP工具调用被 web 服务限流(429)的次数', ['tool'])
+
+
+class RateLimited(Exception):
+    """web 服务返回 429: 指令请求过于频繁或设备指令积压"""
+
+    def __init__(self, message: str, retry_after: str = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def tool_result(self) -> str:
+        retry = f"，请在 {self.retry_after} 秒后重试" if self.retry_after else "，请稍后重试"
+        return f"指令未执行: {self}{retry}"
 
-@mcp.tool()
-def open_all_led() -> str:
+
+def client_id() -> str:
+    """当前 MCP 会话的客户端标识，不在工具调用中时使用 MCP_CLIENT_ID"""
+    try:
+        context = get_context()
+        return context.client_id or f"{MCP_CLIENT_ID}-{id(context.session):x}"
+    except (RuntimeError, LookupError):
+        return MCP_CLIENT_ID
+
+
+def error_message(response) -> str:
+    try:
+        data = response.json()
+    except ValueError:
+        return response.text[:200]
+    if isinstance(data, dict):
+        return str(data.get("message") or data.get("detail") or data)
+    return str(data)
+
+
+def api_get(path: str, params: dict = None, timeout: float = API_TIMEOUT) -> requests.Response:
     """
-    打开设备所有led灯
+    调用 ytjweb-service 的接口并检查状态码: 429 时抛出 RateLimited(附带 Retry-After)，
+    连接失败和其他错误状态抛出 Exception，工具不会把失败的请求当作成功返回
     """
     try:
-        response = requests.get(f'{YTJ_API_URL}/api/open_all_led', timeout=5)
-        response.raise_for_status()
-        return "成功发送打开所有LED灯的指令"
+        response = requests.get(f'{YTJ_API_URL}{path}', params=params, timeout=timeout,
+                                headers={"X-Client-Id": client_id()})
     except requests.exceptions.RequestException as e:
-        print(f"请求失败: {str(e)}")
+        logger.error("请求失败: %s", e)
         raise Exception(f"无法连接到 ytjweb-service: {str(e)}")
+    if response.status_code == 429:
+        raise RateLimited(error_message(response), response.headers.get("Retry-After"))
+    if response.status_code >= 400:
+        raise Exception(f"ytjweb-service 返回 {response.status_code}: {error_message(response)}")
+    return response
+
+
+def tool():
+    """注册MCP工具，并统计每次调用的耗时和失败次数；被限流时把重试时间作为工具结果返回给智能体"""
+    def decorator(fn):
+        latency = TOOL_LATENCY.labels(tool=fn.__name__)
+        errors = TOOL_ERRORS.labels(tool=fn.__name__)
+        rate_limited = TOOL_RATE_LIMITED.labels(tool=fn.__name__)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with latency.time():
+                    try:
+                        return await fn(*args, **kwargs)
+                    except RateLimited as e:
+                        rate_limited.inc()
+                        return e.tool_result()
+                    except Exception:
+                        errors.inc()
+                        raise
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with latency.time():
+                    try:
+                        return fn(*args, **kwargs)
+                    except RateLimited as e:
+                        rate_limited.inc()
+                        return e.tool_result()
+                    except Exception:
+                        errors.inc()
+                        raise
+        return mcp.tool()(wrapper)
+    return decorator
+
+# --- LED 控制 ---
+
+@tool()
+def open_all_led(device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    打开设备所有led灯
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    api_get('/api/open_all_led', {"device_id": device_id})
+    return "成功发送打开所有LED灯的指令"
 
-@mcp.tool()
-def close_all_led() -> str:
+@tool()
+def close_all_led(device_id: str = DEFAULT_DEVICE) -> str:
     """
     关闭设备所有led灯
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/close_all_led')
+    api_get('/api/close_all_led', {"device_id": device_id})
     return "成功发送关闭所有LED灯的指令"
 
-@mcp.tool()
-def open_led(numbers: str) -> str:
+@tool()
+def open_led(numbers: str, device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开指定的一个或多个LED灯
     args:
         numbers: 设备的编号1~9, 如果有多个，用','分割，例如： "1,3,5"
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/open_led?numbers={numbers}')
+    api_get('/api/open_led', {"numbers": numbers, "device_id": device_id})
     return f"成功发送打开 {numbers} 号LED灯的指令"
 
-@mcp.tool()
-def close_led(numbers: str) -> str:
+@tool()
+def close_led(numbers: str, device_id: str = DEFAULT_DEVICE) -> str:
     """
     关闭指定的一个或多个LED灯
     args:
         numbers: 设备的编号1~9, 如果有多个，用','分割，例如： "2,4,6"
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/close_led?numbers={numbers}')
+    api_get('/api/close_led', {"numbers": numbers, "device_id": device_id})
     return f"成功发送关闭 {numbers} 号LED灯的指令"
 
 # --- 示波器控制 ---
 
-@mcp.tool()
-def open_occ() -> str:
+@tool()
+def open_occ(device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开设备的示波器
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/open_occ')
+    api_get('/api/open_occ', {"device_id": device_id})
     return "成功打开示波器"
 
-@mcp.tool()
-def close_occ() -> str:
+@tool()
+def close_occ(device_id: str = DEFAULT_DEVICE) -> str:
     """
     关闭设备的示波器
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/close_occ')
+    api_get('/api/close_occ', {"device_id": device_id})
     return "成功关闭示波器"
 
 # --- 万用表控制 ---
 
-@mcp.tool()
-def open_resistance() -> str:
+@tool()
+def open_resistance(device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开万用表并切换到电阻档
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/open_resistense')
+    api_get('/api/open_resistense', {"device_id": device_id})
     return "成功打开万用表-电阻档"
 
-@mcp.tool()
-def open_continuity() -> str:
+@tool()
+def open_continuity(device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开万用表并切换到通断档（蜂鸣档）
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/open_cont')
+    api_get('/api/open_cont', {"device_id": device_id})
     return "成功打开万用表-通断档"
 
-@mcp.tool()
-def open_dc_voltage() -> str:
+@tool()
+def open_dc_voltage(device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开万用表并切换到直流电压档
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/open_dcv')
+    api_get('/api/open_dcv', {"device_id": device_id})
     return "成功打开万用表-直流电压档"
 
-@mcp.tool()
-def open_ac_voltage() -> str:
+@tool()
+def open_ac_voltage(device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开万用表并切换到交流电压档
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/open_acv')
+    api_get('/api/open_acv', {"device_id": device_id})
     return "成功打开万用表-交流电压档"
 
-@mcp.tool()
-def open_dc_current() -> str:
+@tool()
+def open_dc_current(device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开万用表并切换到直流电流档
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/open_dca')
+    api_get('/api/open_dca', {"device_id": device_id})
     return "成功打开万用表-直流电流档"
 
-@mcp.tool()
-def close_multimeter() -> str:
+@tool()
+def close_multimeter(device_id: str = DEFAULT_DEVICE) -> str:
     """
     关闭万用表
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/close_multimeter')
+    api_get('/api/close_multimeter', {"device_id": device_id})
     return "成功关闭万用表"
 
+@tool()
+def open_instrument(mode: str, device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    按档位标识打开示波器或万用表的某个档位
+    args:
+        mode: 档位标识，可选值为 "oscilloscope" (示波器), "resistance" (电阻档), "continuity" (通断档),
+              "dc_voltage" (直流电压档), "ac_voltage" (交流电压档), "dc_current" (直流电流档)
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    if mode not in STREAM_MODES:
+        return f"未知档位 {mode}，可选值: {', '.join(STREAM_MODES)}"
+    api_get('/api/open_mode', {"mode": mode, "device_id": device_id})
+    return f"成功打开{STREAM_MODES[mode].name}"
+
 # --- 传感器数据获取 ---
 
-@mcp.tool()
-def get_temperature() -> str:
+@tool()
+def get_temperature(device_id: str = DEFAULT_DEVICE) -> str:
     """
     获取设备当前的温度数据
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/get_temperature')
+    api_get('/api/get_temperature', {"device_id": device_id})
     return "成功发送温度读取指令"
 
-@mcp.tool()
-def get_gesture() -> str:
+@tool()
+def get_gesture(device_id: str = DEFAULT_DEVICE) -> str:
     """
     获取设备当前的手势传感器数据
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/get_gesture')
+    api_get('/api/get_gesture', {"device_id": device_id})
     return "成功发送手势读取指令"
 
-@mcp.tool()
-def get_distance() -> str:
+@tool()
+def get_distance(device_id: str = DEFAULT_DEVICE) -> str:
     """
     获取设备当前的测距数据
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/get_distance')
+    api_get('/api/get_distance', {"device_id": device_id})
     return "成功发送测距读取指令"
 
-@mcp.tool()
-def get_light_intensity() -> str:
+@tool()
+def get_light_intensity(device_id: str = DEFAULT_DEVICE) -> str:
     """
     获取设备当前的光照强度数据
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/get_light')
+    api_get('/api/get_light', {"device_id": device_id})
     return "成功发送光照读取指令"
 
+# --- 测量数据读取 ---
+
+@tool()
+def read_measurement(device: str, seconds: float = 5, device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    读取测量通道最近一段时间的数据统计（最新值、最小值、最大值、平均值），附带实时的标准差、RMS 和频率估计
+    args:
+        device: 测量通道，可选值为 "oscilloscope" (示波器), "multimeter_resistance" (电阻档),
+                "multimeter_continuity" (通断档), "multimeter_dc_voltage" (直流电压档),
+                "multimeter_ac_voltage" (交流电压档), "multimeter_dc_current" (直流电流档),
+                "power_supply" (电源), "temperature" (温度), "humidity" (湿度),
+                "distance" (测距), "light" (光照)
+        seconds: 统计的时间范围，单位是秒，默认5秒
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    if device not in CHANNEL_INDEX:
+        return f"未知测量通道 {device}，可选值: {', '.join(CHANNEL_INDEX)}"
+    response = api_get('/api/measurement/recent',
+                       {"device": device, "seconds": seconds, "limit": 0, "device_id": device_id})
+    data = response.json()
+    if data.get("status") != "success":
+        return data.get("message", "读取测量数据失败")
+    result = (f"{device} 最近 {seconds} 秒共 {data['count']} 个采样: 最新值 {data['latest']:.4g}, "
+              f"最小值 {data['min']:.4g}, 最大值 {data['max']:.4g}, 平均值 {data['mean']:.4g}")
+    summary = api_get('/api/measurement/summary',
+                      {"device": device, "device_id": device_id}).json()
+    if summary.get("status") == "success":
+        result += f"; 最近 {summary['count']} 个采样 {format_summary(summary)}"
+    return result
+
+
+def format_summary(data: dict) -> str:
+    text = f"标准差 {data['std']:.4g}, RMS {data['rms']:.4g}"
+    if data.get("frequency"):
+        text += f", 频率约 {data['frequency']:.4g} Hz"
+    return text
+
+
+@tool()
+def read_measurement_summary(device: str = None, device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    读取测量通道的实时统计（最新值、平均值、最小值、最大值、标准差、RMS，示波器等周期信号附带频率估计），
+    由服务端增量维护，调用开销很小
+    args:
+        device: 测量通道，可选值与 read_measurement 相同；不指定时使用当前打开的万用表档位或示波器
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    if device is not None and device not in CHANNEL_INDEX:
+        return f"未知测量通道 {device}，可选值: {', '.join(CHANNEL_INDEX)}"
+    params = {"device_id": device_id}
+    if device is not None:
+        params["device"] = device
+    response = api_get('/api/measurement/summary', params)
+    data = response.json()
+    if data.get("status") != "success":
+        return data.get("message", "读取测量统计失败")
+    return (f"{data['device']} 最近 {data['count']} 个采样 ({data['span']:.3g} 秒): 最新值 {data['latest']:.4g}, "
+            f"平均值 {data['mean']:.4g}, 最小值 {data['min']:.4g}, 最大值 {data['max']:.4g}, {format_summary(data)}")
+
+# --- 等待条件 ---
+# 订阅 ytjweb-service 的 /api/stream 事件流，在服务端阻塞到条件满足或超时后只返回一次，
+# 代替智能体反复调用 read_measurement 轮询。等待期间不会向设备发送任何指令。
+# 长轮询工具必须是 async 函数，同步工具会阻塞 MCP 服务的事件循环。
+
+# 单次等待的最长时间(秒)
+MAX_WAIT_SECONDS = 600
+WAIT_CONDITIONS = ("above", "below", "change", "stable")
+# 事件流断开后重新连接的间隔(秒)
+STREAM_RECONNECT_SECONDS = 1
+
+
+async def stream_events(device_id: str):
+    """
+    逐个返回 /api/stream 的 (事件名, 数据)，不会自行结束，由调用方的超时取消。
+    第一次连接失败时抛出 httpx.HTTPError；之后事件流断开(web 服务重启、代理关闭空闲连接)时
+    按 STREAM_RECONNECT_SECONDS 间隔带 Last-Event-ID 重新连接，从断开处续传
+    """
+    timeout = httpx.Timeout(5, read=60)
+    last_event_id = None
+    connected = False
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        while True:
+            headers = {"X-Client-Id": client_id()}
+            if last_event_id:
+                headers["Last-Event-ID"] = last_event_id
+            try:
+                async with client.stream("GET", f'{YTJ_API_URL}/api/stream', params={"device_id": device_id},
+                                         headers=headers) as response:
+                    response.raise_for_status()
+                    connected = True
+                    event, data, event_id = "message", [], None
+                    async for line in response.aiter_lines():
+                        if not line:
+                            if data:
+                                if event_id:
+                                    last_event_id = event_id
+                                yield event, json.loads("\n".join(data))
+                            event, data, event_id = "message", [], None
+                        elif line.startswith("event:"):
+                            event = line[6:].strip()
+                        elif line.startswith("data:"):
+                            data.append(line[5:].strip())
+                        elif line.startswith("id:"):
+                            event_id = line[3:].strip()
+            except httpx.HTTPError as e:
+                if not connected:
+                    raise
+                logger.warning("事件流连接中断，%s 秒后重新连接: %s", STREAM_RECONNECT_SECONDS, e)
+            else:
+                logger.info("事件流已结束，%s 秒后重新连接", STREAM_RECONNECT_SECONDS)
+            await asyncio.sleep(STREAM_RECONNECT_SECONDS)
+
+
+class MeasurementWaiter:
+    """根据每条测量事件的统计(latest/min/max)判断等待条件是否满足"""
+
+    def __init__(self, condition: str, threshold: float, tolerance: float, window_seconds: float):
+        self.condition = condition
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.window_seconds = window_seconds
+        self.baseline = None
+        self.latest = None
+        self.samples = 0
+        self.window = deque()  # (时间, 最小值, 最大值)
+
+    def feed(self, summary: dict) -> bool:
+        self.latest = summary["latest"]
+        self.samples += summary["count"]
+        if self.condition == "above":
+            return summary["max"] > self.threshold
+        if self.condition == "below":
+            return summary["min"] < self.threshold
+        if self.condition == "change":
+            if self.baseline is None:
+                self.baseline = summary["latest"]
+                return False
+            return (summary["max"] - self.baseline > self.tolerance or
+                    self.baseline - summary["min"] > self.tolerance)
+        # stable: 最近 window_seconds 秒内的最大值与最小值之差不超过 tolerance
+        self.window.append((summary["t"], summary["min"], summary["max"]))
+        start = self.window[0][0]
+        while self.window[0][0] < summary["t"] - self.window_seconds:
+            start = self.window.popleft()[0]
+        if summary["t"] - start < self.window_seconds:
+            return False
+        low = min(item[1] for item in self.window)
+        high = max(item[2] for item in self.window)
+        return high - low <= self.tolerance
+
+
+@tool()
+async def wait_for_measurement(device: str, condition: str, threshold: float = None, tolerance: float = 0,
+                               window_seconds: float = 5, timeout: float = 60,
+                               device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    等待测量通道满足条件后返回，不需要反复调用 read_measurement 轮询。
+    需要先打开对应的仪器(例如 open_dc_voltage)，否则没有测量数据。
+    args:
+        device: 测量通道，可选值与 read_measurement 相同，例如 "multimeter_dc_voltage"、"temperature"
+        condition: 等待条件，可选值为 "above" (高于 threshold), "below" (低于 threshold),
+                   "change" (相对开始等待时的数值变化超过 tolerance),
+                   "stable" (连续 window_seconds 秒内最大值与最小值之差不超过 tolerance)
+        threshold: above/below 条件的阈值
+        tolerance: change/stable 条件的容差，默认0
+        window_seconds: stable 条件的稳定时长，单位是秒，默认5秒
+        timeout: 最长等待时间，单位是秒，默认60秒，最大600秒
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    if device not in CHANNEL_INDEX:
+        return f"未知测量通道 {device}，可选值: {', '.join(CHANNEL_INDEX)}"
+    if condition not in WAIT_CONDITIONS:
+        return f"未知等待条件 {condition}，可选值: {', '.join(WAIT_CONDITIONS)}"
+    if condition in ("above", "below") and threshold is None:
+        return f"{condition} 条件需要指定 threshold"
+    timeout = min(max(timeout, 0), MAX_WAIT_SECONDS)
+
+    waiter = MeasurementWaiter(condition, threshold, tolerance, window_seconds)
+    started = time.monotonic()
+
+    async def watch():
+        async for event, data in stream_events(device_id):
+            summary = data.get("channels", {}).get(device) if event == "measurement" else None
+            if summary and waiter.feed(summary):
+                return
+
+    try:
+        await asyncio.wait_for(watch(), timeout)
+    except asyncio.TimeoutError:
+        if waiter.latest is None:
+            return f"等待 {timeout:g} 秒内没有收到 {device} 的测量数据，请确认对应仪器已打开"
+        return f"等待 {timeout:g} 秒后 {device} 仍未满足条件 {condition}，最新值 {waiter.latest:.4g}"
+    except httpx.HTTPError as e:
+        logger.error("订阅事件流失败: %s", e)
+        raise Exception(f"无法连接到 ytjweb-service: {str(e)}")
+    elapsed = time.monotonic() - started
+    return f"{device} 已满足条件 {condition}，用时 {elapsed:.1f} 秒，最新值 {waiter.latest:.4g}"
+
+
+@tool()
+async def wait_for_state_change(timeout: float = 60, device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    等待设备状态(LED、电源、信号发生器、打开的仪器)发生变化后返回变化的内容
+    args:
+        timeout: 最长等待时间，单位是秒，默认60秒，最大600秒
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    timeout = min(max(timeout, 0), MAX_WAIT_SECONDS)
+
+    async def watch():
+        async for event, data in stream_events(device_id):
+            if event == "state":
+                return data
+
+    try:
+        changes = await asyncio.wait_for(watch(), timeout)
+    except asyncio.TimeoutError:
+        return f"等待 {timeout:g} 秒内设备状态没有变化"
+    except httpx.HTTPError as e:
+        logger.error("订阅事件流失败: %s", e)
+        raise Exception(f"无法连接到 ytjweb-service: {str(e)}")
+    changes = {key: value for key, value in changes.items() if key not in ("device_id", "updated_at")}
+    return f"设备状态已变化: {json.dumps(changes, ensure_ascii=False)}"
+
+# --- 触发器 ---
+
+@tool()
+def add_trigger(device: str, type: str, level: float = None, low: float = None, high: float = None,
+                hysteresis: float = 0, pre_seconds: float = 1, post_seconds: float = 1,
+                device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    在服务端添加测量触发器，命中后可以用 wait_for_trigger 等待事件
+    args:
+        device: 测量通道，可选值与 read_measurement 相同，例如 "multimeter_dc_voltage"
+        type: 触发类型，可选值为 "rising" (上穿 level), "falling" (下穿 level), "range" (超出 [low, high] 报警)
+        level: rising/falling 的触发电平
+        low: range 报警的下限
+        high: range 报警的上限
+        hysteresis: 迟滞量，数值回到触发电平另一侧超过该值后才会再次触发，默认0
+        pre_seconds: 事件附带触发前多少秒的采样，默认1秒
+        post_seconds: 事件附带触发后多少秒的采样，默认1秒
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    params = {"channel": device, "type": type, "hysteresis": hysteresis, "pre_seconds": pre_seconds,
+              "post_seconds": post_seconds, "device_id": device_id}
+    for key, value in (("level", level), ("low", low), ("high", high)):
+        if value is not None:
+            params[key] = value
+    response = api_get('/api/triggers/add', params)
+    data = response.json()
+    if data.get("status") != "success":
+        return data.get("message", "添加触发器失败")
+    return f"已添加触发器 {data['trigger']['trigger_id']}"
+
+@tool()
+def remove_trigger(trigger_id: str, device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    删除服务端的测量触发器
+    args:
+        trigger_id: add_trigger 返回的触发器ID
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    response = api_get('/api/triggers/remove',
+                       {"trigger_id": trigger_id, "device_id": device_id})
+    return response.json().get("message", "删除触发器失败")
+
+@tool()
+async def wait_for_trigger(trigger_id: str = None, timeout: float = 60, device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    等待触发器命中后返回触发时间、触发值和前后采集窗口的统计
+    args:
+        trigger_id: 只等待指定的触发器，默认等待该设备的任意触发器
+        timeout: 最长等待时间，单位是秒，默认60秒，最大600秒
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    timeout = min(max(timeout, 0), MAX_WAIT_SECONDS)
+
+    async def watch():
+        async for event, data in stream_events(device_id):
+            if event == "trigger" and trigger_id in (None, data.get("trigger_id")):
+                return data
+
+    try:
+        event = await asyncio.wait_for(watch(), timeout)
+    except asyncio.TimeoutError:
+        return f"等待 {timeout:g} 秒内触发器没有命中"
+    except httpx.HTTPError as e:
+        logger.error("订阅事件流失败: %s", e)
+        raise Exception(f"无法连接到 ytjweb-service: {str(e)}")
+    result = (f"触发器 {event['trigger_id']} ({event['type']}) 在 {event['channel']} = {event['value']:.4g} 时命中，"
+              f"时间 {event['t']:.3f}")
+    values = [sample["value"] for sample in event.get("samples", [])]
+    if values:
+        result += (f"; 前后窗口共 {len(values)} 个采样: 最小值 {min(values):.4g}, 最大值 {max(values):.4g}, "
+                   f"平均值 {sum(values) / len(values):.4g}")
+    return result
+
 # --- 电源控制 ---
 
-@mcp.tool()
-def power_supply_on() -> str:
+@tool()
+def power_supply_on(device_id: str = DEFAULT_DEVICE) -> str:
     """
     打开可编程电源的输出
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/power_supply_on')
+    api_get('/api/power_supply_on', {"device_id": device_id})
     return "电源输出已开启"
 
-@mcp.tool()
-def power_supply_off() -> str:
+@tool()
+def power_supply_off(device_id: str = DEFAULT_DEVICE) -> str:
     """
     关闭可编程电源的输出
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/power_supply_off')
+    api_get('/api/power_supply_off', {"device_id": device_id})
     return "电源输出已关闭"
 
-@mcp.tool()
-def set_voltage(voltage: float) -> str:
+@tool()
+def set_voltage(voltage: float, device_id: str = DEFAULT_DEVICE) -> str:
     """
     设置可编程电源的输出电压
     args:
         voltage: 要设置的电压值，浮点数，单位是伏特(V)。例如: 5.0
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/set_voltage?voltage={voltage}')
+    api_get('/api/set_voltage', {"voltage": voltage, "device_id": device_id})
     return f"成功发送设置电压为 {voltage}V 的指令"
 
+@tool()
+def voltage_ramp(start: float, stop: float, step: float, dwell_ms: int = 0,
+                 device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    让可编程电源从起始电压按步进逐步变化到结束电压，所有步骤一次性下发
+    args:
+        start: 起始电压，单位伏特(V)，范围0~10.1
+        stop: 结束电压，单位伏特(V)，范围0~10.1
+        step: 步进，单位伏特(V)，最小0.01
+        dwell_ms: 每一步的停留时间，单位毫秒，默认0
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    response = api_get('/api/voltage_ramp',
+                       {"start": start, "stop": stop, "step": step, "dwell_ms": dwell_ms,
+                        "device_id": device_id})
+    return response.json().get("message", "电压斜坡指令发送失败")
+
 # --- 信号发生器控制 ---
 
-@mcp.tool()
-def set_waveform(waveform: str, frequency: int) -> str:
+@tool()
+def set_waveform(waveform: str, frequency: int, device_id: str = DEFAULT_DEVICE) -> str:
     """
     设置信号发生器的输出波形和频率
     args:
         waveform: 波形类型，可选值为 "sine" (正弦波), "square" (方波), "triangle" (三角波)
-        frequency: 频率，整数，单位是赫兹(Hz)
+        frequency: 频率，整数，单位是赫兹(Hz)，范围1~255
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/set_waveform?waveform={waveform}&frequency={frequency}')
+    api_get('/api/set_waveform',
+            {"waveform": waveform, "frequency": frequency, "device_id": device_id})
     return f"成功设置信号发生器: {waveform}波, {frequency}Hz"
 
-@mcp.tool()
-def signal_generator_stop() -> str:
+@tool()
+def frequency_sweep(waveform: str, start: int, stop: int, step: int = 1, dwell_ms: int = 0,
+                    device_id: str = DEFAULT_DEVICE) -> str:
+    """
+    让信号发生器从起始频率按步进扫到结束频率，所有步骤一次性下发
+    args:
+        waveform: 波形类型，可选值为 "sine" (正弦波), "square" (方波), "triangle" (三角波)
+        start: 起始频率，整数，单位赫兹(Hz)，范围1~255
+        stop: 结束频率，整数，单位赫兹(Hz)，范围1~255
+        step: 步进，整数，单位赫兹(Hz)，默认1
+        dwell_ms: 每一步的停留时间，单位毫秒，默认0
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
+    """
+    response = api_get('/api/frequency_sweep',
+                       {"waveform": waveform, "start": start, "stop": stop,
+                        "step": step, "dwell_ms": dwell_ms, "device_id": device_id})
+    return response.json().get("message", "扫频指令发送失败")
+
+@tool()
+def signal_generator_stop(device_id: str = DEFAULT_DEVICE) -> str:
     """
     停止信号发生器的输出
+    args:
+        device_id: 一体机设备ID，同时管理多台设备时用于区分，默认 "default"
     """
-    response = requests.get(f'{YTJ_API_URL}/api/signal_generator_stop')
+    api_get('/api/signal_generator_stop', {"device_id": device_id})
     return "信号发生器已停止"
 
 
 if __name__ == "__main__":
-    print(f"Agent Service 启动中...")
-    print(f"将要连接的 Yitiji API 地址: {YTJ_API_URL}")
+    logger.info("Agent Service 启动中...")
+    logger.info(f"将要连接的 Yitiji API 地址: {YTJ_API_URL}")
+    start_http_server(METRICS_PORT)
+    logger.info(f"Prometheus 指标服务已启动，端口 {METRICS_PORT}")
     mcp.run(transport="sse", host="0.0.0.0", port=8001)
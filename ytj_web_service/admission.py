@@ -0,0 +1,118 @@
+"""
+指令准入控制
+串口服务每写入一条指令后至少停留 COMMAND_INTERVAL 秒(默认0.05秒，指令的 dwell_ms 更长时按 dwell_ms)，
+每秒最多写入约20条，指令发得再快也只会在 to_serial_queue 里越积越多，
+后来的正常操作要排在积压的指令后面很久才生效。这里在 web 服务入口处按串口服务的写入节奏限流:
+- 每个客户端一个令牌桶(COMMAND_RATE 个请求/秒，突发 COMMAND_BURST 个)，客户端用 X-Client-Id 头区分，
+  没有时按来源IP；智能体循环或前端 bug 只会限制到它自己
+- 每台设备按已发布的指令数及其停留时间推算串口服务还需要多久才能写完(结合 queue_depth_worker 采集的实际队列深度)，
+  积压超过 COMMAND_MAX_BACKLOG 秒时拒绝新的指令请求，正常用户的指令延迟不会超过这个上限
+- 被拒绝的请求返回 429 和 Retry-After，客户端按提示的秒数重试
+to_serial_queue 本身也有长度上限(reject-publish)，作为最后一道保护，broker 拒收时同样返回 429。
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+
+import metrics
+from devices import COMMAND_INTERVAL
+
+# 9600 波特率、每字节10位(起始位+8数据位+停止位)、每帧4字节
+LINK_FRAMES_PER_SECOND = 9600 / 10 / 4
+# 每个客户端每秒允许的指令请求数和突发数
+COMMAND_RATE = float(os.getenv('COMMAND_RATE', 10))
+COMMAND_BURST = float(os.getenv('COMMAND_BURST', 20))
+# 设备指令积压超过该时长(秒)时拒绝新的指令请求
+COMMAND_MAX_BACKLOG = float(os.getenv('COMMAND_MAX_BACKLOG', 1.0))
+# 最多跟踪的客户端数，超出时淘汰最久未出现的客户端
+MAX_TRACKED_CLIENTS = 1024
+
+
+class CommandRejected(Exception):
+    """指令请求被限流或被 broker 拒收，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def wait_time(self, now: float, cost: float = 1) -> float:
+        """补充令牌后还需要等待多久(秒)才有 cost 个令牌，0 表示可以立即取用"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def take(self, cost: float = 1):
+        self.tokens -= cost
+
+
+class AdmissionControl:
+    """按客户端限速、按设备串口积压限流"""
+
+    def __init__(self, rate: float = COMMAND_RATE, burst: float = COMMAND_BURST,
+                 max_backlog: float = COMMAND_MAX_BACKLOG, interval: float = COMMAND_INTERVAL,
+                 link_rate: float = LINK_FRAMES_PER_SECOND):
+        self.rate = rate
+        self.burst = burst
+        self.max_backlog = max_backlog
+        self.interval = interval
+        self.link_rate = link_rate
+        self.buckets = OrderedDict()  # 客户端 -> TokenBucket
+        self.link_free_at = {}        # 设备ID -> 已发布的指令预计全部写入串口的时刻(monotonic)
+        self.queue_depth = {}         # 设备ID -> (最近一次采集的指令队列深度, 采集时刻)
+
+    def command_seconds(self, dwell_ms: float = 0) -> float:
+        """串口服务处理一条指令的时间: 写入4字节加上之后的停留"""
+        return 1 / self.link_rate + max(self.interval, dwell_ms / 1000)
+
+    def backlog(self, device_id: str, now: float = None) -> float:
+        """设备指令积压还需要多少秒才能发完"""
+        now = time.monotonic() if now is None else now
+        estimated = self.link_free_at.get(device_id, now) - now
+        # 采集到的队列深度(按默认间隔估算)按采集之后经过的时间扣除已经发完的部分
+        depth, observed_at = self.queue_depth.get(device_id, (0, now))
+        measured = depth * self.command_seconds() - (now - observed_at)
+        return max(estimated, measured, 0.0)
+
+    def admit(self, client: str, device_id: str):
+        """准入一个指令请求，被拒绝时抛出 CommandRejected"""
+        now = time.monotonic()
+        backlog = self.backlog(device_id, now)
+        if backlog > self.max_backlog:
+            metrics.COMMANDS_REJECTED.labels(reason="backlog").inc()
+            raise CommandRejected(f"设备 {device_id} 指令积压 {backlog:.1f} 秒，请稍后重试",
+                                  backlog - self.max_backlog)
+
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.rate, self.burst, now)
+            if len(self.buckets) > MAX_TRACKED_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        wait = bucket.wait_time(now)
+        if wait > 0:
+            metrics.COMMANDS_REJECTED.labels(reason="rate").inc()
+            raise CommandRejected(f"指令请求过于频繁，每秒最多 {self.rate:g} 个", wait)
+        bucket.take()
+
+    def record(self, device_id: str, frames: int, dwell_ms: float = 0):
+        """记录发布到设备指令队列的指令数，dwell_ms 为这些指令要求的停留时间"""
+        now = time.monotonic()
+        start = max(now, self.link_free_at.get(device_id, now))
+        self.link_free_at[device_id] = start + frames * self.command_seconds(dwell_ms)
+
+    def observe_queue_depth(self, device_id: str, depth: int):
+        self.queue_depth[device_id] = (depth, time.monotonic())
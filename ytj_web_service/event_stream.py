@@ -0,0 +1,167 @@
+"""
+Server-Sent Events 推送
+只读的看板通过 /api/stream 订阅状态和测量数据，不需要 WebSocket:
+- 进程内只有一份事件环形缓冲，状态变化(只含变化的字段)和抽稀后的测量统计各写入一次，所有SSE连接共享
+- SSE连接不声明 RabbitMQ 队列，也不会向设备补发指令，连接数增加对 broker 和设备没有额外开销
+- 事件ID为 <启动时间>-<序号>。断线重连时浏览器自动带上 Last-Event-ID，从缓冲中补发错过的事件;
+  缓冲中已经没有这些事件或服务重启过时，先发送一份完整快照(snapshot)再继续推送
+"""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+# 事件环形缓冲长度，决定断线多久以内可以无缝续传
+STREAM_BUFFER_SIZE = int(os.getenv('STREAM_BUFFER_SIZE', 5000))
+# 同一设备两次测量事件之间的最小间隔(秒)，期间的批次合并为一条
+STREAM_MEASUREMENT_INTERVAL = float(os.getenv('STREAM_MEASUREMENT_INTERVAL', 0.5))
+# 没有事件时发送注释行的间隔(秒)，防止代理断开空闲连接
+STREAM_HEARTBEAT = 15
+# 浏览器断线后的重连间隔(毫秒)
+STREAM_RETRY_MS = 3000
+
+# 不计入状态变化的字段
+VOLATILE_STATE_FIELDS = ("timestamp", "updated_at")
+
+# 事件ID前缀，服务重启后旧的 Last-Event-ID 不再有效
+EPOCH = str(int(time.time() * 1000))
+
+
+def format_event(seq: int, event: str, data: str) -> str:
+    return f"id: {EPOCH}-{seq}\nevent: {event}\ndata: {data}\n\n"
+
+
+def merge_summary(pending: dict, summary: dict) -> dict:
+    """合并同一通道的两批统计"""
+    if pending is None:
+        return dict(summary)
+    count = pending["count"] + summary["count"]
+    return {
+        "t": summary["t"],
+        "latest": summary["latest"],
+        "min": min(pending["min"], summary["min"]),
+        "max": max(pending["max"], summary["max"]),
+        "mean": (pending["mean"] * pending["count"] + summary["mean"] * summary["count"]) / count,
+        "count": count,
+    }
+
+
+class EventStream:
+    """所有SSE连接共享的事件缓冲，发布一次，各连接按自己的位置读取"""
+
+    def __init__(self, maxlen: int = STREAM_BUFFER_SIZE):
+        self.events = deque(maxlen=maxlen)  # (序号, 设备ID, 事件名, JSON数据)
+        self.seq = 0
+        self.last_state = {}            # 设备ID -> 最近一次状态
+        self.latest_measurements = {}   # 设备ID -> {通道名: 统计}
+        self.pending_measurements = {}  # 设备ID -> {通道名: 尚未推送的统计}
+        self.last_measurement_at = {}   # 设备ID -> 上次推送测量事件的时间
+        self._waiter = None
+
+    def publish(self, device_id: str, event: str, data: dict):
+        self.seq += 1
+        self.events.append((self.seq, device_id, event, json.dumps(data, ensure_ascii=False)))
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        self._waiter = None
+
+    def set_state(self, state_data: dict):
+        """记录设备当前状态作为比较基准，不推送事件"""
+        # 深拷贝: led_states 等字段是设备状态对象上会被原地修改的字典
+        self.last_state[state_data["device_id"]] = json.loads(json.dumps(state_data))
+
+    def publish_state(self, state_data: dict):
+        """只推送与上一次相比有变化的字段"""
+        device_id = state_data["device_id"]
+        previous = self.last_state.get(device_id, {})
+        self.set_state(state_data)
+        delta = {
+            key: value for key, value in state_data.items()
+            if key not in VOLATILE_STATE_FIELDS and previous.get(key) != value
+        }
+        if not delta:
+            return
+        delta["device_id"] = device_id
+        delta["updated_at"] = state_data.get("updated_at")
+        self.publish(device_id, "state", delta)
+
+    def publish_measurements(self, device_id: str, summaries: dict):
+        """按 STREAM_MEASUREMENT_INTERVAL 抽稀，期间到达的批次合并统计"""
+        if not summaries:
+            return
+        pending = self.pending_measurements.setdefault(device_id, {})
+        for name, summary in summaries.items():
+            pending[name] = merge_summary(pending.get(name), summary)
+        now = time.monotonic()
+        if now - self.last_measurement_at.get(device_id, 0) < STREAM_MEASUREMENT_INTERVAL:
+            return
+        self.last_measurement_at[device_id] = now
+        self.latest_measurements.setdefault(device_id, {}).update(pending)
+        self.pending_measurements[device_id] = {}
+        self.publish(device_id, "measurement", {"device_id": device_id, "channels": pending})
+
+    def snapshot(self, device_id: str, state_data: dict) -> dict:
+        return {
+            "device_id": device_id,
+            "state": state_data,
+            "measurements": self.latest_measurements.get(device_id, {}),
+        }
+
+    def resume_position(self, last_event_id: str):
+        """Last-Event-ID 对应的序号；无法续传(格式错误、服务已重启、事件已被淘汰)时返回 None"""
+        if not last_event_id:
+            return None
+        epoch, _, seq = last_event_id.partition('-')
+        if epoch != EPOCH or not seq.isdigit():
+            return None
+        seq = int(seq)
+        first = self.events[0][0] if self.events else self.seq + 1
+        if seq > self.seq or seq < first - 1:
+            return None
+        return seq
+
+    def events_after(self, seq: int):
+        """序号大于 seq 的事件列表；seq 之后的事件已被淘汰时返回 None"""
+        if not self.events:
+            return []
+        first = self.events[0][0]
+        if seq < first - 1:
+            return None
+        start = seq - first + 1
+        return [self.events[i] for i in range(start, len(self.events))]
+
+    async def wait(self, timeout: float) -> bool:
+        """等待新事件，超时返回 False"""
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._waiter), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def subscribe(self, device_id: str, last_event_id: str, get_state):
+        """单个SSE连接的事件流，get_state() 返回该设备当前的完整状态"""
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        seq = self.resume_position(last_event_id)
+        while True:
+            if seq is None:
+                seq = self.seq
+                snapshot = self.snapshot(device_id, get_state())
+                yield format_event(seq, "snapshot", json.dumps(snapshot, ensure_ascii=False))
+            events = self.events_after(seq)
+            if events is None:
+                # 客户端读得太慢，缓冲已经覆盖了它还没读到的事件，重新发送快照
+                seq = None
+                continue
+            for event_seq, event_device, event, data in events:
+                if event_device == device_id:
+                    yield format_event(event_seq, event, data)
+            if events:
+                seq = events[-1][0]
+            # yield 期间可能又有新事件发布，先补发完再等待
+            if seq != self.seq:
+                continue
+            if not await self.wait(STREAM_HEARTBEAT):
+                yield ": keepalive\n\n"
@@ -0,0 +1,57 @@
+"""
+串口帧批量解码模块
+串口协议每帧固定4字节: [操作码, 高字节, 低字节, 0xFE]。
+这里用 NumPy 结构化 dtype 直接在连续缓冲区上建立零拷贝视图，一次向量化处理 N 帧，
+替代逐帧 message.body.hex() 再切片解析的做法。
+"""
+import numpy as np
+
+from protocol import FRAME_END, FRAME_SIZE, MEASUREMENT_CHANNELS
+
+# 单帧布局: 操作码(u1) + 大端16位数值(>u2) + 结束字节(u1)
+FRAME_DTYPE = np.dtype({
+    'names': ['opcode', 'value', 'end'],
+    'formats': ['u1', '>u2', 'u1'],
+    'offsets': [0, 1, 3],
+    'itemsize': FRAME_SIZE,
+})
+
+# 采集文件记录布局: 小端float64时间戳 + 4字节原始帧
+CAPTURE_DTYPE = np.dtype({
+    'names': ['ts', 'opcode', 'value', 'end'],
+    'formats': ['<f8', 'u1', '>u2', 'u1'],
+    'offsets': [0, 8, 9, 11],
+    'itemsize': 12,
+})
+
+# 按操作码索引的查找表，用于整批判断是否为测量帧
+IS_MEASUREMENT = np.zeros(256, dtype=bool)
+IS_MEASUREMENT[list(MEASUREMENT_CHANNELS)] = True
+
+
+def frame_view(buf) -> np.ndarray:
+    """把连续的N帧缓冲区映射为结构化数组视图（不拷贝），末尾不足一帧的字节被忽略"""
+    count = len(buf) // FRAME_SIZE
+    return np.frombuffer(buf, dtype=FRAME_DTYPE, count=count)
+
+
+def capture_view(buf) -> np.ndarray:
+    """把采集文件内容映射为结构化数组视图（不拷贝）"""
+    count = len(buf) // CAPTURE_DTYPE.itemsize
+    return np.frombuffer(buf, dtype=CAPTURE_DTYPE, count=count)
+
+
+def valid_mask(frames: np.ndarray) -> np.ndarray:
+    """结束字节为0xFE的帧才是有效帧"""
+    return frames['end'] == FRAME_END
+
+
+def channel_values(frames: np.ndarray, kind: str, scale: float) -> np.ndarray:
+    """按取值方式把帧数组转换为物理量数组"""
+    raw = frames['value']
+    if kind == "hi":
+        raw = raw >> 8
+    elif kind == "lo":
+        raw = raw & 0xFF
+    return raw * float(scale)
+
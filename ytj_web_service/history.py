@@ -0,0 +1,381 @@
+"""
+测量数据采集与历史查询模块
+负责把串口上报的测量帧落盘为原始采集文件，并增量维护多分辨率的 min/max/mean 汇总，
+供 /api/history 在长时间范围内快速缩放查询，而不需要扫描原始采样。
+"""
+import bisect
+import fcntl
+import logging
+import os
+import time
+
+import numpy as np
+
+from frames import CAPTURE_DTYPE, IS_MEASUREMENT, capture_view, channel_values, frame_view, valid_mask
+from protocol import CHANNEL_INDEX, FRAME_END, MEASUREMENT_CHANNELS
+
+logger = logging.getLogger(__name__)
+
+# 采集文件目录，每个测量通道一个追加写入的文件
+CAPTURE_DIR = os.getenv('CAPTURE_DIR', '/tmp/ytj_captures')
+# 同一主机上共用 CAPTURE_DIR 的实例(worker)数上限
+CAPTURE_MAX_INSTANCES = int(os.getenv('CAPTURE_MAX_INSTANCES', 64))
+# 单个采集文件的最大字节数，超过后轮转为 .1 文件
+CAPTURE_MAX_BYTES = int(os.getenv('CAPTURE_MAX_BYTES', 64 * 1024 * 1024))
+
+# 汇总分辨率(秒) -> 保留的桶数量
+ROLLUP_LEVELS = {
+    1: 6 * 3600,        # 1秒粒度保留6小时
+    10: 24 * 360,       # 10秒粒度保留24小时
+    60: 7 * 24 * 60,    # 1分钟粒度保留7天
+    600: 30 * 24 * 6,   # 10分钟粒度保留30天
+    3600: 365 * 24,     # 1小时粒度保留1年
+}
+
+# 单次查询返回的最大点数，resolution=auto 时据此选择分辨率
+MAX_QUERY_POINTS = 2000
+# 导出时每次从采集文件读取的记录数
+EXPORT_CHUNK_RECORDS = 65536
+
+def claim_capture_root(root: str = CAPTURE_DIR, max_instances: int = CAPTURE_MAX_INSTANCES):
+    """
+    为本进程独占一个采集目录。每个实例都消费完整的数据流，多个 worker 写入同一目录会重复写入、
+    交错出乱序的时间戳，轮转时还会移走其他 worker 正在追加的文件。
+    依次对 root/.instance-<序号>.lock 加非阻塞排他锁，占用第一个空闲的序号:
+    序号0使用 root 本身(单实例部署的目录布局不变)，其余使用 root/instance-<序号>。
+    锁随进程退出释放，重启的 worker 重新占用空闲序号并从该目录重建历史汇总。
+    返回 (目录, 锁文件)，锁文件需要在进程运行期间保持打开。
+    """
+    os.makedirs(root, exist_ok=True)
+    for slot in range(max_instances):
+        lock = open(os.path.join(root, f".instance-{slot}.lock"), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        path = root if slot == 0 else os.path.join(root, f"instance-{slot}")
+        os.makedirs(path, exist_ok=True)
+        logger.info(f"本实例的采集目录: {path}")
+        return path, lock
+    raise RuntimeError(f"采集目录 {root} 的 {max_instances} 个实例序号都已被占用")
+
+
+def summarize(decoded: dict) -> dict:
+    """一批解码数据的各通道统计 {通道名: {"t", "latest", "min", "max", "mean", "count"}}"""
+    return {
+        name: {
+            "t": float(ts[-1]),
+            "latest": float(values[-1]),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "mean": float(values.mean()),
+            "count": int(len(values)),
+        }
+        for name, (ts, values) in decoded.items()
+    }
+
+
+def _record_time(rf, index: int) -> float:
+    rf.seek(index * CAPTURE_DTYPE.itemsize)
+    return np.frombuffer(rf.read(8), dtype='<f8')[0]
+
+
+def _search_time(rf, count: int, t: float, right: bool) -> int:
+    """第一条时间戳大于等于 t (right=True 时为大于 t) 的记录序号"""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        ts = _record_time(rf, mid)
+        if ts < t or (right and ts == t):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def capture_bounds(rf, start: float, end: float):
+    """采集文件中时间戳落在 [start, end] 内的记录序号范围 [lo, hi)"""
+    count = os.fstat(rf.fileno()).st_size // CAPTURE_DTYPE.itemsize
+    lo = _search_time(rf, count, start, right=False)
+    hi = _search_time(rf, count, end, right=True)
+    return lo, max(lo, hi)
+
+
+class CaptureRange:
+    """
+    一段时间范围内的采集记录。打开时只确定各文件的起止记录和文件标识(inode)，不持有文件句柄；
+    chunks() 开始迭代时才打开文件，之后采集文件继续追加或轮转(轮转是重命名，inode 不变)都不影响，
+    count 与实际产出的采样数一致。
+    """
+
+    def __init__(self, parts: list, kind: str, scale: float):
+        self.parts = parts  # [(文件路径, inode, 起始记录, 结束记录)]
+        self.kind = kind
+        self.scale = scale
+        self.count = sum(hi - lo for _, _, lo, hi in parts)
+
+    @staticmethod
+    def _open(path: str, inode: int):
+        """按 inode 找到确定范围时的那个文件: 当前文件期间轮转过时已改名为 .1，.1 文件再次轮转后已被覆盖"""
+        for candidate in (path, path + '.1'):
+            try:
+                rf = open(candidate, 'rb')
+            except FileNotFoundError:
+                continue
+            if os.fstat(rf.fileno()).st_ino == inode:
+                return rf
+            rf.close()
+        return None
+
+    def chunks(self, chunk_records: int = EXPORT_CHUNK_RECORDS):
+        """逐块产出 (时间戳数组, 物理量数组)，内存占用只和块大小有关；文件在迭代过程中打开并确保关闭"""
+        record_size = CAPTURE_DTYPE.itemsize
+        for path, inode, lo, hi in self.parts:
+            rf = self._open(path, inode)
+            if rf is None:
+                logger.warning(f"导出期间采集文件 {path} 已被轮转删除，跳过 {hi - lo} 条记录")
+                continue
+            with rf:
+                rf.seek(lo * record_size)
+                while lo < hi:
+                    records = capture_view(rf.read(min(chunk_records, hi - lo) * record_size))
+                    if not len(records):
+                        break
+                    lo += len(records)
+                    yield records['ts'], channel_values(records, self.kind, self.scale)
+
+
+class RollupSeries:
+    """单个通道在单个分辨率下的汇总序列，桶按起始时间递增"""
+
+    def __init__(self, resolution: int, capacity: int):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.starts = []   # 桶起始时间，用于二分查找
+        self.buckets = []  # [min, max, sum, count]
+
+    def add_many(self, ts: np.ndarray, values: np.ndarray):
+        """批量追加一组按到达顺序排列的采样，每个桶只做一次归约"""
+        starts = (ts // self.resolution).astype(np.int64) * self.resolution
+        if self.starts:
+            # 乱序帧归入最后一个桶，保持序列有序
+            np.maximum(starts, self.starts[-1], out=starts)
+        np.maximum.accumulate(starts, out=starts)
+        seg = np.flatnonzero(np.diff(starts)) + 1
+        seg = np.concatenate(([0], seg))
+        seg_starts = starts[seg].tolist()
+        mins = np.minimum.reduceat(values, seg).tolist()
+        maxs = np.maximum.reduceat(values, seg).tolist()
+        sums = np.add.reduceat(values, seg).tolist()
+        counts = np.diff(np.append(seg, len(values))).tolist()
+
+        i = 0
+        if self.starts and self.starts[-1] == seg_starts[0]:
+            bucket = self.buckets[-1]
+            bucket[0] = min(bucket[0], mins[0])
+            bucket[1] = max(bucket[1], maxs[0])
+            bucket[2] += sums[0]
+            bucket[3] += counts[0]
+            i = 1
+        self.starts.extend(seg_starts[i:])
+        self.buckets.extend([list(b) for b in zip(mins[i:], maxs[i:], sums[i:], counts[i:])])
+        if len(self.starts) > self.capacity + self.capacity // 2:
+            drop = len(self.starts) - self.capacity
+            del self.starts[:drop]
+            del self.buckets[:drop]
+
+    def query(self, start: float, end: float):
+        lo = bisect.bisect_left(self.starts, start - self.resolution + 1)
+        hi = bisect.bisect_right(self.starts, end)
+        points = []
+        for i in range(lo, hi):
+            b_min, b_max, b_sum, b_count = self.buckets[i]
+            points.append({
+                "t": self.starts[i],
+                "min": b_min,
+                "max": b_max,
+                "mean": b_sum / b_count,
+                "count": b_count,
+            })
+        return points
+
+    @property
+    def oldest(self):
+        return self.starts[0] if self.starts else None
+
+
+class HistoryStore:
+    """保存所有通道的原始采集文件和多分辨率汇总"""
+
+    def __init__(self, capture_dir: str = CAPTURE_DIR, levels: dict = None):
+        self.capture_dir = capture_dir
+        self.levels = dict(sorted((levels or ROLLUP_LEVELS).items()))
+        self.series = {}          # 通道名 -> {分辨率: RollupSeries}
+        self._capture_files = {}  # 操作码 -> 打开的采集文件
+        self._last_ts = {}        # 操作码 -> 采集文件中最后一条记录的时间
+        os.makedirs(self.capture_dir, exist_ok=True)
+
+    def capture_path(self, opcode: int) -> str:
+        return os.path.join(self.capture_dir, f"{opcode:02x}.bin")
+
+    def _capture_file(self, opcode: int):
+        f = self._capture_files.get(opcode)
+        if f is None:
+            f = open(self.capture_path(opcode), 'ab')
+            self._capture_files[opcode] = f
+        elif f.tell() >= CAPTURE_MAX_BYTES:
+            # 轮转采集文件，只保留一个历史文件
+            f.close()
+            path = self.capture_path(opcode)
+            os.replace(path, path + '.1')
+            f = open(path, 'ab')
+            self._capture_files[opcode] = f
+        return f
+
+    def ingest_batch(self, buf, timestamps):
+        """
+        批量处理一段连续的串口帧: 追加到采集文件并更新各分辨率汇总。
+        timestamps 与帧一一对应，整批只做一次向量化解码。
+        返回本批解码后的各通道数据 {通道名: (时间戳数组, 物理量数组)}，供实时统计、推送和触发器复用。
+        """
+        frames = frame_view(buf)
+        ts = np.asarray(timestamps, dtype=np.float64)[:len(frames)]
+        mask = valid_mask(frames) & IS_MEASUREMENT[frames['opcode']]
+        decoded = {}
+        if not mask.any():
+            return decoded
+        if not mask.all():
+            frames = frames[mask]
+            ts = ts[mask]
+        opcodes = frames['opcode']
+        for opcode in np.unique(opcodes).tolist():
+            selected = opcodes == opcode
+            sub = frames[selected]
+            # 采集文件按时间递增写入，导出时据此二分查找；时钟回拨等乱序的时间戳按前一条记录的时间处理
+            sub_ts = np.maximum.accumulate(np.maximum(ts[selected], self._last_ts.get(opcode, -np.inf)))
+            self._last_ts[opcode] = float(sub_ts[-1])
+
+            records = np.empty(len(sub), dtype=CAPTURE_DTYPE)
+            records['ts'] = sub_ts
+            records['opcode'] = opcode
+            records['value'] = sub['value']
+            records['end'] = FRAME_END
+            self._capture_file(opcode).write(records.tobytes())
+
+            for name, kind, scale in MEASUREMENT_CHANNELS[opcode]:
+                values = channel_values(sub, kind, scale)
+                self._add_rollups(self.series, name, sub_ts, values)
+                decoded[name] = (sub_ts, values)
+        return decoded
+
+    def _add_rollups(self, series: dict, name: str, ts: np.ndarray, values: np.ndarray):
+        levels = series.get(name)
+        if levels is None:
+            levels = series[name] = {res: RollupSeries(res, cap) for res, cap in self.levels.items()}
+        for rollup in levels.values():
+            rollup.add_many(ts, values)
+
+    def rebuild(self, chunk_records: int = EXPORT_CHUNK_RECORDS):
+        """
+        启动时从现有采集文件(先 .1 再当前文件)重建各分辨率汇总，进程重启后 /api/history 仍能查询之前的数据。
+        在后台线程中构建新的汇总，完成后整体替换；需要在开始写入新数据之前调用。
+        """
+        started = time.perf_counter()
+        series = {}
+        total = 0
+        record_size = CAPTURE_DTYPE.itemsize
+        for opcode, channels in MEASUREMENT_CHANNELS.items():
+            path = self.capture_path(opcode)
+            for file_path in (path + '.1', path):
+                try:
+                    rf = open(file_path, 'rb')
+                except FileNotFoundError:
+                    continue
+                with rf:
+                    while True:
+                        records = capture_view(rf.read(chunk_records * record_size))
+                        if not len(records):
+                            break
+                        total += len(records)
+                        self._last_ts[opcode] = float(records['ts'][-1])
+                        for name, kind, scale in channels:
+                            self._add_rollups(series, name, records['ts'], channel_values(records, kind, scale))
+        self.series = series
+        if total:
+            logger.info(f"已从采集文件重建历史汇总: {total} 条记录，耗时 {time.perf_counter() - started:.1f} 秒")
+
+    def read_recent(self, name: str, seconds: float, max_records: int = 100000):
+        """读取通道最近一段时间的原始采样，返回 (时间戳数组, 物理量数组)；需要读文件，在线程池中调用"""
+        if name not in CHANNEL_INDEX:
+            return np.empty(0), np.empty(0)
+        opcode, kind, scale = CHANNEL_INDEX[name]
+        path = self.capture_path(opcode)
+        f = self._capture_files.get(opcode)
+        if f is not None:
+            f.flush()
+        if not os.path.exists(path):
+            return np.empty(0), np.empty(0)
+        record_size = CAPTURE_DTYPE.itemsize
+        with open(path, 'rb') as rf:
+            size = os.fstat(rf.fileno()).st_size
+            size -= size % record_size
+            offset = max(0, size - max_records * record_size)
+            rf.seek(offset)
+            data = rf.read(size - offset)
+        records = capture_view(data)
+        records = records[records['ts'] >= time.time() - seconds]
+        return records['ts'], channel_values(records, kind, scale)
+
+    def open_range(self, name: str, start: float, end: float) -> "CaptureRange":
+        """确定通道在 [start, end] 内的原始采样范围，用于分块导出；需要读文件二分查找，在线程池中调用"""
+        if name not in CHANNEL_INDEX:
+            return CaptureRange([], "word", 1)
+        opcode, kind, scale = CHANNEL_INDEX[name]
+        path = self.capture_path(opcode)
+        f = self._capture_files.get(opcode)
+        if f is not None:
+            f.flush()
+        parts = []
+        for file_path in (path + '.1', path):
+            try:
+                rf = open(file_path, 'rb')
+            except FileNotFoundError:
+                continue
+            with rf:
+                lo, hi = capture_bounds(rf, start, end)
+                if hi > lo:
+                    parts.append((file_path, os.fstat(rf.fileno()).st_ino, lo, hi))
+        return CaptureRange(parts, kind, scale)
+
+    def flush(self):
+        for f in self._capture_files.values():
+            f.flush()
+
+    def close(self):
+        for f in self._capture_files.values():
+            f.close()
+        self._capture_files.clear()
+
+    def channels(self):
+        return sorted(self.series.keys())
+
+    def pick_resolution(self, name: str, start: float, end: float) -> int:
+        """选择能覆盖查询起点且点数不超过 MAX_QUERY_POINTS 的最细分辨率"""
+        levels = self.series.get(name, {})
+        span = max(end - start, 0)
+        for res, series in levels.items():
+            covers = series.oldest is not None and series.oldest <= start
+            if span / res <= MAX_QUERY_POINTS and covers:
+                return res
+        # 没有能完整覆盖的分辨率时，退回到点数满足限制的最细分辨率
+        for res in self.levels:
+            if span / res <= MAX_QUERY_POINTS:
+                return res
+        return max(self.levels)
+
+    def query(self, name: str, start: float, end: float, resolution: int):
+        levels = self.series.get(name)
+        if not levels or resolution not in levels:
+            return []
+        return levels[resolution].query(start, end)
@@ -0,0 +1,156 @@
+"""
+日志初始化
+- 日志记录只在调用线程里入队，由后台线程写 stdout，日志 I/O 不会阻塞事件循环或串口线程
+- 队列满时直接丢弃并计数，绝不等待
+- 热路径日志通过 extra={"category": ...} 归类，按类别做令牌桶限速，被抑制的条数会附在下一条日志上
+- LOG_FORMAT=json 时输出单行JSON，便于采集
+
+环境变量:
+    LOG_LEVEL        日志级别，默认 INFO
+    LOG_FORMAT       text 或 json，默认 text
+    LOG_QUEUE_SIZE   日志队列长度，默认 10000
+    LOG_RATE_LIMITS  各类别每秒允许的条数，例如 "ws_frame=1,serial_frame=0.5"
+
+注意: serial_service、ytj_web_service、ytj_mcp_service 各有一份相同的 logging_setup.py，修改时需同步更新。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# 默认的类别限速(条/秒)
+DEFAULT_RATE_LIMITS = {
+    "ws_frame": 1,       # 推送到WebSocket的每一帧
+    "serial_frame": 1,   # 串口读到的每一帧
+    "serial_command": 20,
+    "broadcast": 5,      # 状态广播
+}
+
+
+def parse_rate_limits(value: str) -> dict:
+    rates = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        name, rate = item.split('=', 1)
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class RateLimitFilter(logging.Filter):
+    """按 record.category 做令牌桶限速，没有类别的日志不受限制"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.buckets = {}     # 类别 -> [令牌数, 上次补充时间]
+        self.suppressed = {}  # 类别 -> 被抑制的条数
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        if category is None:
+            return True
+        rate = self.rates.get(category)
+        if rate is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(category)
+            burst = max(rate, 1.0)
+            if bucket is None:
+                bucket = self.buckets[category] = [burst, now]
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.suppressed[category] = self.suppressed.get(category, 0) + 1
+                return False
+            bucket[0] -= 1
+            record.suppressed = self.suppressed.pop(category, 0)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志而不是阻塞调用方"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f" (同类日志已抑制 {suppressed} 条)"
+        dropped = getattr(record, 'dropped', 0)
+        if dropped:
+            text += f" (日志队列已满，丢弃 {dropped} 条)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ('category', 'suppressed', 'dropped'):
+            value = getattr(record, key, None)
+            if value:
+                data[key] = value
+        return json.dumps(data, ensure_ascii=False)
+
+
+def setup_logging():
+    """配置根日志: 限速过滤 -> 非阻塞队列 -> 后台线程输出"""
+    level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    rates = dict(DEFAULT_RATE_LIMITS)
+    rates.update(parse_rate_limits(os.getenv('LOG_RATE_LIMITS', '')))
+
+    if os.getenv('LOG_FORMAT', 'text').lower() == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter(TEXT_FORMAT)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    # uvicorn 自带的日志处理器同步写 stdout，统一改为走根日志的队列
+    for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access'):
+        uv_logger = logging.getLogger(name)
+        uv_logger.handlers.clear()
+        uv_logger.propagate = True
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
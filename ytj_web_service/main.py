@@ -2,19 +2,47 @@ import asyncio
 import logging
 import os
 import json
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime
 
 import aio_pika
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends
+from aio_pika.exceptions import ChannelPreconditionFailed
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pamqp.commands import Basic
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+import metrics
+
+from admission import AdmissionControl, CommandRejected
+from devices import (DEFAULT_DEVICE, SERIAL_DATA_EXCHANGE, TO_SERIAL_QUEUE_ARGUMENTS, data_routing_key,
+                     parse_device_ids, scoped)
+from event_stream import EventStream
+from export import EXPORT_FORMATS, available_formats, content_length, export_chunks
+from history import HistoryStore, claim_capture_root, summarize
+from logging_setup import setup_logging
+from state_actor import StateActor
+from state_sync import StateSync
+from stats import MeasurementStats
+from static_assets import StaticAssets
+from protocol import (CHANNEL_INDEX, CMD_CLOSE_MULTIMETER, CMD_CLOSE_OSCILLOSCOPE, CMD_READ_DISTANCE, CMD_READ_GESTURE,
+                      CMD_READ_LIGHT, CMD_READ_TEMPERATURE, LED_COMMANDS, MULTIMETER_UI_KEYS, STREAM_MODES,
+                      encode_voltage, encode_waveform, frequency_sweep, is_valid_frame, led_frame, mode_for_frame,
+                      voltage_ramp)
+from tracing import TraceBuffer, request_context
+from triggers import TriggerEngine
+from ws_schema import WS_DEFAULT_SCHEMA, WsFormat, compact_state, compact_trigger_event, hello_message
 
 # --- 1. 配置和日志 ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# 热路径日志的限速类别
+WS_FRAME_LOG = {"category": "ws_frame"}
+BROADCAST_LOG = {"category": "broadcast"}
+
 # RabbitMQ 配置
 MQ_HOST = os.getenv('MQ_HOST', 'rabbitmq-service')
 MQ_PORT = int(os.getenv('MQ_PORT', 5672))
@@ -25,245 +53,366 @@ EXCHANGE_NAME = 'aio_exchange'
 TO_SERIAL_ROUTING_KEY = 'to_serial_routing_key'
 TO_SERIAL_QUEUE = 'to_serial_queue' 
 
-FROM_SERIAL_ROUTING_KEY = 'from_serial_routing_key'
-FROM_SERIAL_QUEUE = 'from_serial_queue' 
+# 每个WebSocket连接独占一个绑定到串口数据交换机的队列，只保留最新的若干帧
+WS_QUEUE_MAX_LENGTH = int(os.getenv('WS_QUEUE_MAX_LENGTH', 50))
+WS_QUEUE_OVERFLOW = os.getenv('WS_QUEUE_OVERFLOW', 'drop-head')
+# 每个WebSocket连接使用自己的通道，最多这么多条未确认的帧在本进程中，其余留在队列里按 overflow 策略丢弃
+WS_PREFETCH = int(os.getenv('WS_PREFETCH', 10))
+
+# 历史数据采集队列，同样绑定到串口数据交换机，收到一份完整的串口数据；
+# 每个实例(worker/副本)独占一个，各自维护完整的历史、统计和触发器。名称只用作指标标签
+# 采集文件同样按实例分目录写入(见 claim_capture_root)，同一主机上的多个 worker 不会写同一个文件
+HISTORY_QUEUE = 'from_serial_history_queue'
+HISTORY_QUEUE_MAX_LENGTH = 10000
+# 历史数据批量解码的间隔(秒)
+HISTORY_BATCH_INTERVAL = 0.2
+# 队列深度指标的采集间隔(秒)
+QUEUE_DEPTH_INTERVAL = 5
+
+# 串口服务发布的指令追踪事件
+TRACE_ROUTING_KEY = 'serial_trace_routing_key'
+TRACE_QUEUE = 'serial_trace_queue'
+TRACE_QUEUE_MAX_LENGTH = 1000
 
 # 状态持久化文件路径
 STATE_FILE_PATH = "/tmp/device_state.json"
 
+# 本实例服务的一体机设备ID，逗号分隔，例如 "default,ytj2"
+DEVICE_IDS = parse_device_ids(os.getenv('DEVICE_IDS', DEFAULT_DEVICE))
+
+# 本实例独占的采集目录，锁文件在进程退出前保持打开
+CAPTURE_ROOT, capture_lock = claim_capture_root()
+
+# 等待服务就绪的最长时间(秒)，启动阶段的指令请求最多排队这么久，超时返回503
+READY_WAIT_TIMEOUT = float(os.getenv('READY_WAIT_TIMEOUT', 5))
+# 连接 RabbitMQ 失败后的最长重试间隔(秒)
+BROKER_RETRY_MAX = 5
+# 后台任务异常退出后重启前的等待时间(秒)
+WORKER_RESTART_DELAY = 1
+
 # --- 2. FastAPI 生命周期管理 (Lifespan) ---
 app_state = {}
+# RabbitMQ 连接和队列声明完成、后台任务已启动
+broker_ready = asyncio.Event()
 
 # --- 辅助函数和全局状态 ---
-led_states = {}  # LED状态字典，存储每个LED的开关状态
-
-# 🔋 新增：电源状态管理
-power_supply_state = {
-    "outputEnabled": False,
-    "setVoltage": 1.0,
-    "actualVoltage": 0.0
-}
-
-# 🌊 新增：信号发生器状态管理
-signal_generator_state = {
-    "outputEnabled": False,
-    "waveform": "sine",
-    "frequency": 1
-}
-
-LED_COMMANDS = {
-    1: 0x10, 2: 0x11, 3: 0x12, 4: 0x13, 5: 0x14,
-    6: 0x15, 7: 0x16, 8: 0x17, 9: 0x18
-}
-
-# 全局WebSocket连接管理
-active_websockets = set()
+class DeviceState:
+    """一台一体机的状态、WebSocket连接和测量数据，按设备ID区分队列和状态文件"""
+
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self.to_serial_routing_key = scoped(TO_SERIAL_ROUTING_KEY, device_id)
+        self.to_serial_queue = scoped(TO_SERIAL_QUEUE, device_id)
+        self.data_routing_key = data_routing_key(device_id)
+        self.history_queue = scoped(HISTORY_QUEUE, device_id)
+        if device_id == DEFAULT_DEVICE:
+            self.state_file = STATE_FILE_PATH
+            capture_dir = CAPTURE_ROOT
+        else:
+            self.state_file = STATE_FILE_PATH.replace(".json", f"_{device_id}.json")
+            capture_dir = os.path.join(CAPTURE_ROOT, device_id)
+
+        self.last_stream_common = None  # 当前打开的串流档位指令
+        self.led_states = {}  # LED状态字典，存储每个LED的开关状态
+
+        # 🔋 新增：电源状态管理
+        self.power_supply_state = {
+            "outputEnabled": False,
+            "setVoltage": 1.0,
+            "actualVoltage": 0.0
+        }
+
+        # 🌊 新增：信号发生器状态管理
+        self.signal_generator_state = {
+            "outputEnabled": False,
+            "waveform": "sine",
+            "frequency": 1
+        }
+
+        # 最近一次状态变化的时间(Unix时间)，多实例同步时较新的状态获胜
+        self.updated_at = 0.0
+
+        # 本实例上该设备的WebSocket连接 -> 连接协商的消息格式
+        self.websockets = {}
+        # 等待广播的最新状态和正在广播的任务，见 schedule_state_broadcast
+        self.pending_broadcast = None
+        self.broadcast_task = None
+
+        # 测量数据采集和多分辨率汇总
+        self.history = HistoryStore(capture_dir)
+        # 各测量通道最近一段采样的实时统计
+        self.stats = MeasurementStats()
+
+        # 测量数据触发器(只保存在本实例内存中)
+        self.triggers = TriggerEngine(device_id)
+
+        # 状态修改都通过执行器串行执行，每批修改后保存并广播一次
+        self.actor = StateActor(device_id, lambda: save_device_state(self))
+
+    @property
+    def snapshot(self):
+        """最近一次提交的只读状态快照，读取时不需要经过执行器"""
+        return self.actor.snapshot
+
+
+devices = {device_id: DeviceState(device_id) for device_id in DEVICE_IDS}
+
+# 多实例之间的状态同步
+state_sync = StateSync(DEVICE_IDS)
+
+# 每个WebSocket客户端最近一帧的延迟(秒)
+websocket_lag = {}
+metrics.WEBSOCKET_CLIENTS.set_function(lambda: sum(len(unit.websockets) for unit in devices.values()))
+metrics.WEBSOCKET_CLIENT_LAG_MAX.set_function(lambda: max(websocket_lag.values(), default=0))
+
+# 最近指令的链路追踪记录
+trace_buffer = TraceBuffer()
+
+# 指令请求的限速和串口积压限流
+admission = AdmissionControl()
+
+# 只读看板的SSE事件流
+event_stream = EventStream()
 
 # 状态持久化函数
-async def save_device_state(device_state, led_states_dict=None, power_supply_dict=None, signal_generator_dict=None):
-    """保存设备状态到文件并通过WebSocket广播更新"""
+def device_state_data(unit: DeviceState) -> dict:
+    """设备当前的完整状态，写入状态文件、广播和同步给其他实例都用这份数据"""
+    return {
+        "device_id": unit.device_id,
+        "last_stream_common": unit.last_stream_common.hex() if unit.last_stream_common else None,
+        "led_states": unit.led_states,
+        "power_supply_state": unit.power_supply_state,
+        "signal_generator_state": unit.signal_generator_state,
+        "timestamp": datetime.now().isoformat(),
+        "updated_at": unit.updated_at
+    }
+
+async def save_device_state(unit: DeviceState) -> dict:
+    """
+    保存设备状态到文件，通过WebSocket广播更新(在执行器之外发送)，并同步给其他实例；返回保存的状态数据。
+    只由设备的状态执行器在一批修改之后调用
+    """
+    started = time.perf_counter()
+    unit.updated_at = time.time()
+    state_data = device_state_data(unit)
     try:
-        state_data = {
-            "last_stream_common": device_state.hex() if device_state else None,
-            "led_states": led_states_dict if led_states_dict is not None else led_states,
-            "power_supply_state": power_supply_dict if power_supply_dict is not None else power_supply_state,
-            "signal_generator_state": signal_generator_dict if signal_generator_dict is not None else signal_generator_state,
-            "timestamp": datetime.now().isoformat()
-        }
-        with open(STATE_FILE_PATH, 'w', encoding='utf-8') as f:
+        # 先写临时文件再替换，同一主机上的多个worker不会读到写了一半的文件
+        tmp_path = f"{unit.state_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(state_data, f, ensure_ascii=False, indent=2)
-        logger.info(f"设备状态已保存: {state_data}")
+        os.replace(tmp_path, unit.state_file)
+        logger.debug("设备状态已保存: %s", state_data)
         
-        # 通过WebSocket广播状态更新
-        await broadcast_state_update(state_data)
+        # 通过WebSocket和SSE广播状态更新
+        schedule_state_broadcast(unit, state_data)
+        event_stream.publish_state(state_data)
+
+        # 同步给其他实例
+        await state_sync.publish(state_data)
         
     except Exception as e:
         logger.error(f"保存设备状态失败: {e}")
+    finally:
+        metrics.STATE_SAVE_DURATION.observe(time.perf_counter() - started)
+    return state_data
 
-async def broadcast_state_update(state_data):
-    """向所有WebSocket连接广播状态更新"""
-    if not active_websockets:
-        return
-        
-    try:
-        # 🎯 根据设备状态构建不同类型的消息
-        message = None
-        
-        # 检查是否有设备状态变化
-        if state_data.get('last_stream_common'):
-            command_hex = state_data['last_stream_common']
-            
-            # 示波器开启指令
-            if command_hex == "080001fe":  # 示波器开启指令的十六进制
-                message = {
-                    "type": "state_update",
-                    "device": "oscilloscope",
-                    "device_type": "oscilloscope", 
-                    "state": "opened",
-                    "device_state": "opened",
-                    "device_name": "示波器",
-                    "data": state_data
-                }
-                logger.info("🔄 广播示波器开启状态")
-                
-            # 万用表开启指令识别
-            elif command_hex.startswith("02") or command_hex.startswith("03") or \
-                 command_hex.startswith("04") or command_hex.startswith("05") or \
-                 command_hex.startswith("06"):
-                
-                # 根据指令确定万用表类型
-                multimeter_types = {
-                    "02": {"type": "multimeter_resistance", "name": "万用表-电阻档", "subtype": "resistance"},
-                    "03": {"type": "multimeter_continuity", "name": "万用表-通断档", "subtype": "continuity"},
-                    "04": {"type": "multimeter_dc_voltage", "name": "万用表-直流电压档", "subtype": "dc_voltage"},
-                    "05": {"type": "multimeter_ac_voltage", "name": "万用表-交流电压档", "subtype": "ac_voltage"},
-                    "06": {"type": "multimeter_dc_current", "name": "万用表-直流电流档", "subtype": "dc_current"}
-                }
-                
-                device_prefix = command_hex[:2]
-                device_info = multimeter_types.get(device_prefix, {
-                    "type": "multimeter_unknown", 
-                    "name": "万用表-未知档位", 
-                    "subtype": "unknown"
-                })
-                
-                message = {
-                    "type": "state_update",
-                    "device": "multimeter",
-                    "device_type": device_info["type"],
-                    "state": "opened", 
-                    "device_state": "opened",
-                    "device_name": device_info["name"],
-                    "subtype": device_info["subtype"],
-                    "data": state_data
-                }
-                logger.info(f"🔄 广播万用表开启状态: {device_info['name']}")
-                
-        else:
-            # 设备关闭状态（last_stream_common为None）
+def verbose_state_messages(state_data) -> list:
+    """详细格式(schema=1)的状态更新消息，按设备分别发送"""
+    messages = []
+
+    # 如果有LED状态变化，也发送LED状态更新
+    if state_data.get('led_states'):
+        messages.append({
+            "type": "state_update",
+            "device": "led",
+            "led_states": state_data['led_states'],
+            "data": state_data
+        })
+
+    # 🔋 如果有电源状态变化，发送电源状态更新
+    if state_data.get('power_supply_state'):
+        messages.append({
+            "type": "state_update",
+            "device": "power_supply",
+            "device_type": "power_supply",
+            "state": "updated",
+            "device_state": "updated",
+            "device_name": "直流电源",
+            "power_supply_state": state_data['power_supply_state'],
+            "data": state_data
+        })
+
+    # 🌊 如果有信号发生器状态变化，发送信号发生器状态更新
+    if state_data.get('signal_generator_state'):
+        messages.append({
+            "type": "state_update",
+            "device": "signal_generator",
+            "device_type": "signal_generator",
+            "state": "updated",
+            "device_state": "updated",
+            "device_name": "信号发生器",
+            "signal_generator_state": state_data['signal_generator_state'],
+            "data": state_data
+        })
+
+    # 🎯 主要设备状态: 当前串流档位已开启，或者所有设备关闭（last_stream_common为None）
+    if state_data.get('last_stream_common'):
+        mode = mode_for_frame(bytes.fromhex(state_data['last_stream_common']))
+        if mode is not None:
             message = {
-                "type": "state_update", 
-                "device": "all_devices",
-                "device_type": "all_devices",
-                "state": "closed",
-                "device_state": "closed", 
-                "device_name": "所有设备",
-                "data": state_data
-            }
-            logger.info("🔄 广播设备关闭状态")
-        
-        # 如果有LED状态变化，也发送LED状态更新
-        if state_data.get('led_states'):
-            led_message = {
-                "type": "state_update",
-                "device": "led",
-                "led_states": state_data['led_states'],
-                "data": state_data
-            }
-            
-            # 广播LED状态更新
-            for websocket in active_websockets.copy():
-                try:
-                    await websocket.send_text(json.dumps(led_message, ensure_ascii=False))
-                except Exception as e:
-                    logger.warning(f"发送LED状态更新失败: {e}")
-                    active_websockets.discard(websocket)
-        
-        # 🔋 如果有电源状态变化，发送电源状态更新
-        if state_data.get('power_supply_state'):
-            power_message = {
-                "type": "state_update",
-                "device": "power_supply",
-                "device_type": "power_supply",
-                "state": "updated",
-                "device_state": "updated",
-                "device_name": "直流电源",
-                "power_supply_state": state_data['power_supply_state'],
-                "data": state_data
-            }
-            logger.info(f"🔋 广播电源状态更新: {state_data['power_supply_state']}")
-            
-            # 广播电源状态更新
-            for websocket in active_websockets.copy():
-                try:
-                    await websocket.send_text(json.dumps(power_message, ensure_ascii=False))
-                except Exception as e:
-                    logger.warning(f"发送电源状态更新失败: {e}")
-                    active_websockets.discard(websocket)
-        
-        # 🌊 如果有信号发生器状态变化，发送信号发生器状态更新
-        if state_data.get('signal_generator_state'):
-            signal_message = {
                 "type": "state_update",
-                "device": "signal_generator",
-                "device_type": "signal_generator",
-                "state": "updated",
-                "device_state": "updated",
-                "device_name": "信号发生器",
-                "signal_generator_state": state_data['signal_generator_state'],
+                "device": mode.device,
+                "device_type": mode.device_type,
+                "state": "opened",
+                "device_state": "opened",
+                "device_name": mode.name,
                 "data": state_data
             }
-            logger.info(f"🌊 广播信号发生器状态更新: {state_data['signal_generator_state']}")
-            
-            # 广播信号发生器状态更新
-            for websocket in active_websockets.copy():
-                try:
-                    await websocket.send_text(json.dumps(signal_message, ensure_ascii=False))
-                except Exception as e:
-                    logger.warning(f"发送信号发生器状态更新失败: {e}")
-                    active_websockets.discard(websocket)
-        
-        # 广播主要设备状态更新
-        if message:
-            for websocket in active_websockets.copy():
-                try:
-                    await websocket.send_text(json.dumps(message, ensure_ascii=False))
-                    logger.info(f"✅ 已广播状态更新到 {len(active_websockets)} 个WebSocket连接")
-                except Exception as e:
-                    logger.warning(f"广播状态更新失败: {e}")
-                    active_websockets.discard(websocket)
-                    
+            if mode.ui_key:
+                message["subtype"] = mode.ui_key
+            messages.append(message)
+    else:
+        messages.append({
+            "type": "state_update",
+            "device": "all_devices",
+            "device_type": "all_devices",
+            "state": "closed",
+            "device_state": "closed",
+            "device_name": "所有设备",
+            "data": state_data
+        })
+    return messages
+
+async def send_to_websockets(unit: DeviceState, verbose, compact, what: str):
+    """
+    按各连接协商的格式发送消息。verbose() 返回详细格式的消息列表，compact() 返回精简格式的单条消息，
+    只在有连接使用该格式时才构建，每种格式和编码只编码一次
+    """
+    encoded = {}
+    for websocket, fmt in list(unit.websockets.items()):
+        payloads = encoded.get(fmt.key)
+        if payloads is None:
+            messages = [compact()] if fmt.compact else verbose()
+            payloads = encoded[fmt.key] = [fmt.encode(message) for message in messages]
+            size = sum(len(payload) for payload in payloads)
+            metrics.WEBSOCKET_MESSAGE_BYTES.labels(schema=fmt.schema, encoding=fmt.encoding).inc(size)
+        try:
+            for payload in payloads:
+                await fmt.send(websocket, payload)
+        except Exception as e:
+            logger.warning(f"发送{what}失败: {e}")
+            unit.websockets.pop(websocket, None)
+
+def schedule_state_broadcast(unit: DeviceState, state_data):
+    """
+    在状态执行器之外向WebSocket广播状态，慢的客户端不会拖住该设备后续的状态修改。
+    每台设备同时只有一个广播任务按顺序发送；广播期间又有新的状态时只发送最新的一份(状态消息都是完整快照)
+    """
+    unit.pending_broadcast = state_data
+    if unit.broadcast_task is None or unit.broadcast_task.done():
+        unit.broadcast_task = asyncio.create_task(broadcast_latest_state(unit))
+
+async def broadcast_latest_state(unit: DeviceState):
+    while unit.pending_broadcast is not None:
+        state_data, unit.pending_broadcast = unit.pending_broadcast, None
+        await broadcast_state_update(unit, state_data)
+
+async def broadcast_state_update(unit: DeviceState, state_data):
+    """向该设备的所有WebSocket连接广播状态更新"""
+    if not unit.websockets:
+        return
+    try:
+        await send_to_websockets(unit, lambda: verbose_state_messages(state_data),
+                                 lambda: compact_state(state_data), "状态更新")
+        logger.info("✅ 已广播状态更新到 %d 个WebSocket连接", len(unit.websockets), extra=BROADCAST_LOG)
     except Exception as e:
         logger.error(f"广播状态更新时发生错误: {e}")
 
-def load_device_state():
+def load_device_state(unit: DeviceState):
     """从文件加载设备状态"""
-    global led_states, power_supply_state, signal_generator_state
     try:
-        if os.path.exists(STATE_FILE_PATH):
-            with open(STATE_FILE_PATH, 'r', encoding='utf-8') as f:
+        if os.path.exists(unit.state_file):
+            with open(unit.state_file, 'r', encoding='utf-8') as f:
                 state_data = json.load(f)
             
             # 加载LED状态
             if "led_states" in state_data:
-                led_states = state_data["led_states"]
-                logger.info(f"已加载LED状态: {led_states}")
+                unit.led_states = state_data["led_states"]
+                logger.info(f"[{unit.device_id}] 已加载LED状态: {unit.led_states}")
             
             # 🔋 加载电源状态
             if "power_supply_state" in state_data:
-                power_supply_state = state_data["power_supply_state"]
-                logger.info(f"已加载电源状态: {power_supply_state}")
+                unit.power_supply_state = state_data["power_supply_state"]
+                logger.info(f"[{unit.device_id}] 已加载电源状态: {unit.power_supply_state}")
             
             # 🌊 加载信号发生器状态
             if "signal_generator_state" in state_data:
-                signal_generator_state = state_data["signal_generator_state"]
-                logger.info(f"已加载信号发生器状态: {signal_generator_state}")
+                unit.signal_generator_state = state_data["signal_generator_state"]
+                logger.info(f"[{unit.device_id}] 已加载信号发生器状态: {unit.signal_generator_state}")
             
             # 加载设备状态
             if state_data.get("last_stream_common"):
-                device_state = bytes.fromhex(state_data["last_stream_common"])
-                logger.info(f"已加载设备状态: {state_data}")
-                return device_state
+                unit.last_stream_common = bytes.fromhex(state_data["last_stream_common"])
+                logger.info(f"[{unit.device_id}] 已加载设备状态: {state_data}")
+
+            unit.updated_at = state_data.get("updated_at", 0.0)
     except Exception as e:
-        logger.error(f"加载设备状态失败: {e}")
-    return None
+        logger.error(f"[{unit.device_id}] 加载设备状态失败: {e}")
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # --- 应用启动时执行 ---
+def apply_state_data(unit: DeviceState, state_data: dict) -> bool:
+    """用其他实例发布的状态快照覆盖本地状态，快照不比本地新时忽略并返回False"""
+    updated_at = state_data.get("updated_at", 0.0)
+    if updated_at <= unit.updated_at:
+        return False
+    unit.led_states = state_data.get("led_states", unit.led_states)
+    unit.power_supply_state = state_data.get("power_supply_state", unit.power_supply_state)
+    unit.signal_generator_state = state_data.get("signal_generator_state", unit.signal_generator_state)
+    command = state_data.get("last_stream_common")
+    unit.last_stream_common = bytes.fromhex(command) if command else None
+    unit.updated_at = updated_at
+    return True
+
+async def on_remote_state(state_data: dict):
+    """其他实例的状态变化: 由执行器合并到本地状态并广播给本实例的WebSocket客户端"""
+    unit = devices.get(state_data.get("device_id"))
+    if unit is None:
+        return
+
+    async def merge():
+        if not apply_state_data(unit, state_data):
+            return
+        unit.actor.publish(device_state_data(unit))
+        logger.info("[%s] 已同步其他实例的设备状态", unit.device_id, extra=BROADCAST_LOG)
+        schedule_state_broadcast(unit, state_data)
+        event_stream.publish_state(state_data)
+
+    # 其他实例的状态已经持久化过，这里不再保存和转发
+    await unit.actor.call(merge, save=False)
+
+async def declare_to_serial_queue(connection: aio_pika.RobustConnection, channel: aio_pika.Channel,
+                                  name: str) -> aio_pika.Queue:
+    """
+    声明有长度限制的指令队列。旧版本创建的同名队列没有长度参数，重新声明会失败并关闭通道，
+    所以先在临时通道上尝试；失败时沿用旧队列并提示删除，限流仍由 web 服务的准入控制保证
+    """
+    probe = await connection.channel()
+    try:
+        await probe.declare_queue(name, durable=True, arguments=TO_SERIAL_QUEUE_ARGUMENTS)
+    except ChannelPreconditionFailed:
+        logger.warning(f"队列 '{name}' 已存在且没有长度限制，删除该队列并重启服务后生效")
+        return await channel.declare_queue(name, passive=True)
+    finally:
+        if not probe.is_closed:
+            await probe.close()
+    return await channel.declare_queue(name, durable=True, arguments=TO_SERIAL_QUEUE_ARGUMENTS)
+
+async def connect_broker():
+    """后台连接 RabbitMQ 并声明队列，失败时按间隔重试；完成后启动各后台任务并标记就绪"""
     loop = asyncio.get_event_loop()
-    retry_interval = 5
+    # 和 broker 同时启动时先快速重试，之后逐步放慢到 BROKER_RETRY_MAX 秒
+    retry_interval = 1
     while True:
+        connection = None
         try:
             logger.info(f"正在尝试连接到 RabbitMQ at {MQ_HOST}:{MQ_PORT}...")
             connection = await aio_pika.connect_robust(
@@ -271,24 +420,41 @@ async def lifespan(app: FastAPI):
             )
             channel = await connection.channel()
             exchange = await channel.declare_exchange(EXCHANGE_NAME, aio_pika.ExchangeType.DIRECT, durable=True)
-            
-            # 发送指令队列
-            toqueue = await channel.declare_queue(TO_SERIAL_QUEUE, durable=True)
-            await toqueue.bind(exchange, routing_key=TO_SERIAL_ROUTING_KEY)
-            logger.info(f"队列 '{TO_SERIAL_QUEUE}' 已声明并绑定到路由 '{TO_SERIAL_ROUTING_KEY}'")
-
-            # 接收指令队列
-            from_queue_args = {
-                'x-max-length': 50,      # 队列最大长度50条消息
-                'x-overflow': 'drop-head' # 当队列满时丢弃队头的旧消息
-            }
-            comequeue = await channel.declare_queue(FROM_SERIAL_QUEUE, durable=True, arguments=from_queue_args)
-            await comequeue.bind(exchange, routing_key=FROM_SERIAL_ROUTING_KEY)
-            logger.info(f"队列 '{FROM_SERIAL_QUEUE}' 已声明并绑定到路由 '{FROM_SERIAL_ROUTING_KEY}'")
+            data_exchange = await channel.declare_exchange(SERIAL_DATA_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+
+            history_queues = {}
+            for unit in devices.values():
+                # 发送指令队列
+                toqueue = await declare_to_serial_queue(connection, channel, unit.to_serial_queue)
+                await toqueue.bind(exchange, routing_key=unit.to_serial_routing_key)
+                logger.info(f"队列 '{unit.to_serial_queue}' 已声明并绑定到路由 '{unit.to_serial_routing_key}'")
+
+                # 历史采集队列: 本实例独占，多个实例各自收到完整的数据流，不会互相分走数据
+                history_queue = await declare_tap_queue(channel, data_exchange, unit, HISTORY_QUEUE_MAX_LENGTH)
+                history_queues[unit.device_id] = history_queue
+                logger.info(f"队列 '{history_queue.name}' 已声明并绑定到路由 '{unit.data_routing_key}'")
+
+            # 指令追踪事件队列: 同样每个实例独占一个，所有实例都能关联追踪记录
+            trace_queue = await channel.declare_queue(
+                exclusive=True, auto_delete=True,
+                arguments={'x-max-length': TRACE_QUEUE_MAX_LENGTH, 'x-overflow': 'drop-head'}
+            )
+            await trace_queue.bind(exchange, routing_key=TRACE_ROUTING_KEY)
+            logger.info(f"队列 '{trace_queue.name}' 已声明并绑定到路由 '{TRACE_ROUTING_KEY}'")
+
+            # 多实例状态同步: 先读取各设备的最新快照，再订阅后续变化
+            await state_sync.setup(channel)
+            for unit in devices.values():
+                snapshot = await state_sync.load_snapshot(unit.device_id)
+                if snapshot and apply_state_data(unit, snapshot):
+                    unit.actor.publish(device_state_data(unit))
+                    logger.info(f"[{unit.device_id}] 已从共享快照恢复设备状态")
+            await state_sync.consume(on_remote_state)
 
             app_state["mq_connection"] = connection
             app_state["mq_channel"] = channel
             app_state["mq_exchange"] = exchange
+            app_state["mq_data_exchange"] = data_exchange
 
             logger.info("✅ RabbitMQ 连接成功并完成设置!")
             
@@ -297,10 +463,61 @@ async def lifespan(app: FastAPI):
             break
         except Exception as e:
             logger.error(f"RabbitMQ 连接失败: {e}. 将在 {retry_interval} 秒后重试...")
+            # 连接成功但之后的声明或恢复失败时关闭这次的连接，否则它会一直在后台自动重连
+            for key in ("mq_connection", "mq_channel", "mq_exchange", "mq_data_exchange"):
+                app_state.pop(key, None)
+            if connection is not None:
+                try:
+                    await connection.close()
+                except Exception as close_error:
+                    logger.warning(f"关闭 RabbitMQ 连接失败: {close_error}")
             await asyncio.sleep(retry_interval)
+            retry_interval = min(retry_interval * 2, BROKER_RETRY_MAX)
+
+    app_state["workers"] = [
+        asyncio.create_task(supervise(f"[{unit.device_id}] 历史数据采集任务",
+                                      history_ingest_worker, history_queues[unit.device_id], unit))
+        for unit in devices.values()
+    ] + [
+        asyncio.create_task(supervise("队列深度采集任务", queue_depth_worker, connection, {
+            TRACE_QUEUE: trace_queue.name,
+            **{unit.history_queue: history_queues[unit.device_id].name for unit in devices.values()},
+        })),
+        asyncio.create_task(supervise("指令追踪任务", trace_worker, trace_queue)),
+    ]
+    broker_ready.set()
+    logger.info("✅ 服务已就绪")
+
+async def load_history():
+    """在后台线程中从采集文件重建各设备的历史汇总"""
+    for unit in devices.values():
+        try:
+            await asyncio.to_thread(unit.history.rebuild)
+        except Exception as e:
+            logger.error(f"[{unit.device_id}] 重建历史汇总失败: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # --- 应用启动时执行 ---
+    # 本地状态文件很小，直接加载；RabbitMQ 在后台连接，HTTP 服务(静态页面、/health)立即可用
+    for unit in devices.values():
+        load_device_state(unit)
+        unit.actor.publish(device_state_data(unit))
+    app_state["state_loaded"] = True
+    # 历史汇总从采集文件重建，文件较大时需要一些时间，同样在后台进行
+    history_task = app_state["history_loaded"] = asyncio.create_task(load_history())
+    connect_task = asyncio.create_task(connect_broker())
     yield
-    
+
     # --- 应用关闭时执行 ---
+    connect_task.cancel()
+    history_task.cancel()
+    for task in app_state.get("workers", []):
+        task.cancel()
+    for unit in devices.values():
+        if unit.broadcast_task is not None:
+            unit.broadcast_task.cancel()
+        unit.history.close()
     logger.info("正在关闭 RabbitMQ 连接...")
     if "mq_connection" in app_state:
         await app_state["mq_connection"].close()
@@ -314,24 +531,93 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
-app.mount("/app", StaticFiles(directory="app"), name="static")
+static_assets = StaticAssets(directory="app")
+app.mount("/app", static_assets, name="static")
+
+@app.exception_handler(CommandRejected)
+async def command_rejected_handler(request: Request, exc: CommandRejected):
+    return JSONResponse(status_code=429, headers={"Retry-After": exc.retry_after_header},
+                        content={"status": "error", "message": str(exc)})
+
+@app.middleware("http")
+async def trace_request_context(request, call_next):
+    """记录API请求的到达时间，供该请求发出的指令追踪使用"""
+    if request.url.path.startswith("/api/"):
+        request_context.set((f"{request.method} {request.url.path}", time.time()))
+    return await call_next(request)
 
 # --- 3. 依赖注入 ---
+async def get_device(device_id: str = DEFAULT_DEVICE) -> DeviceState:
+    unit = devices.get(device_id)
+    if unit is None:
+        raise HTTPException(status_code=404, detail=f"未知设备: {device_id}，可选值: {', '.join(devices)}")
+    return unit
+
+async def wait_until_ready(timeout: float = READY_WAIT_TIMEOUT) -> bool:
+    """等待 RabbitMQ 就绪，超时返回 False"""
+    if broker_ready.is_set():
+        return True
+    try:
+        await asyncio.wait_for(broker_ready.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
 async def get_mq_channel() -> aio_pika.Channel:
+    if not await wait_until_ready():
+        raise HTTPException(status_code=503, detail="服务正在启动，RabbitMQ 尚未连接，请稍后重试")
     return app_state["mq_channel"]
 
-async def get_mq_exchange() -> aio_pika.Exchange:
+def client_key(request: Request) -> str:
+    """限速用的客户端标识: X-Client-Id 头，没有时用来源IP"""
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id[:64]
+    return request.client.host if request.client else "unknown"
+
+async def get_mq_exchange(request: Request, unit: DeviceState = Depends(get_device)) -> aio_pika.Exchange:
+    """指令接口的依赖: 等待服务就绪并通过准入控制，超出限制时返回429"""
+    if not await wait_until_ready():
+        raise HTTPException(status_code=503, detail="服务正在启动，RabbitMQ 尚未连接，请稍后重试")
+    admission.admit(client_key(request), unit.device_id)
     return app_state["mq_exchange"]
 
-# 在全局变量定义后加载状态
-last_stream_common = load_device_state()  # 从文件加载之前的状态
 
-async def send_serial_command(command_bytes: bytes, exchange: aio_pika.Exchange):
-    await exchange.publish(aio_pika.Message(body=command_bytes), routing_key=TO_SERIAL_ROUTING_KEY)
+async def send_serial_command(command_bytes: bytes, exchange: aio_pika.Exchange, unit: DeviceState):
+    headers = trace_buffer.start(command_bytes, unit.device_id)
+    with metrics.PUBLISH_LATENCY.time():
+        confirmation = await exchange.publish(aio_pika.Message(body=command_bytes, headers=headers),
+                                              routing_key=unit.to_serial_routing_key)
+    check_confirmations([confirmation], unit)
+    metrics.COMMANDS_OUT.inc()
 
-async def check_current_status(exchange: aio_pika.Exchange, new_command: bytes = None):
+async def send_serial_commands(commands, exchange: aio_pika.Exchange, unit: DeviceState, dwell_ms: int = 0):
+    """一次性批量发布多条指令，串口服务按 dwell_ms 在相邻指令之间停留"""
+    messages = []
+    for command in commands:
+        headers = trace_buffer.start(command, unit.device_id)
+        if dwell_ms:
+            headers["dwell_ms"] = dwell_ms
+        messages.append(aio_pika.Message(body=command, headers=headers))
+    with metrics.PUBLISH_LATENCY.time():
+        confirmations = await asyncio.gather(*(
+            exchange.publish(message, routing_key=unit.to_serial_routing_key) for message in messages
+        ))
+    check_confirmations(confirmations, unit, dwell_ms)
+    metrics.COMMANDS_OUT.inc(len(commands))
+
+def check_confirmations(confirmations, unit: DeviceState, dwell_ms: int = 0):
+    """记录已入队的指令数；指令队列已满、broker 拒收(reject-publish)时抛出 CommandRejected"""
+    rejected = sum(isinstance(confirmation, Basic.Nack) for confirmation in confirmations)
+    admission.record(unit.device_id, len(confirmations) - rejected, dwell_ms)
+    if rejected:
+        metrics.COMMANDS_REJECTED.labels(reason="queue_full").inc(rejected)
+        raise CommandRejected(f"设备 {unit.device_id} 的指令队列已满，{rejected} 条指令被拒收",
+                              admission.backlog(unit.device_id))
+
+async def check_current_status(exchange: aio_pika.Exchange, unit: DeviceState, new_command: bytes = None):
     """检查当前状态，如果需要切换设备则先关闭当前设备"""
-    global last_stream_common
+    last_stream_common = unit.last_stream_common
     if last_stream_common is None: 
         return
     
@@ -341,393 +627,736 @@ async def check_current_status(exchange: aio_pika.Exchange, new_command: bytes =
         return
     
     # 只有在切换到不同设备时才关闭当前设备
-    if last_stream_common == bytes([0x08, 0x00, 0x01, 0xFE]):
-        await send_serial_command(bytes([0x07, 0x00, 0x00, 0xFE]), exchange)
-        logger.info("已发送关闭示波器的指令（切换设备）")
-    elif last_stream_common and last_stream_common[0] in [0x02, 0x03, 0x04, 0x05, 0x06]:
-        await send_serial_command(bytes([0x01, 0x00, 0x00, 0xFE]), exchange)
-        logger.info("已发送关闭万用表的指令（切换设备）")
-
-async def restore_previous_device(exchange: aio_pika.Exchange):
-    global last_stream_common
-    if last_stream_common:
-        logger.info(f"正在恢复之前的设备状态: {last_stream_common.hex()}")
-        await send_serial_command(last_stream_common, exchange)
+    mode = mode_for_frame(last_stream_common)
+    if mode is not None:
+        await send_serial_command(mode.close_frame, exchange, unit)
+        # 已经关闭，之后打开新档位失败时状态也与设备一致
+        unit.last_stream_common = None
+        logger.info(f"已发送关闭{mode.device_name}的指令（切换设备）")
+
+async def read_sensor(command: bytes, exchange: aio_pika.Exchange, unit: DeviceState):
+    """发送单次读取指令后恢复之前的串流档位，在状态执行器中执行，读取期间档位不会被其他请求切换"""
+    await send_serial_command(command, exchange, unit)
+    await restore_previous_device(exchange, unit)
+
+async def restore_previous_device(exchange: aio_pika.Exchange, unit: DeviceState):
+    if unit.last_stream_common:
+        logger.info(f"正在恢复之前的设备状态: {unit.last_stream_common.hex()}")
+        await send_serial_command(unit.last_stream_common, exchange, unit)
 
 # 新增：在应用启动时恢复设备状态的函数
 async def restore_device_state_on_startup():
     """在应用启动时恢复设备状态"""
-    global last_stream_common
-    if last_stream_common:
-        logger.info(f"检测到之前的设备状态，将在WebSocket连接时恢复: {last_stream_common.hex()}")
-        # 判断设备类型并记录
-        if last_stream_common == bytes([0x08, 0x00, 0x01, 0xFE]):
-            logger.info("检测到示波器之前处于开启状态")
-        elif last_stream_common and last_stream_common[0] in [0x02, 0x03, 0x04, 0x05, 0x06]:
-            device_types = {0x02: "电阻档", 0x03: "通断档", 0x04: "直流电压档", 0x05: "交流电压档", 0x06: "直流电流档"}
-            device_type = device_types.get(last_stream_common[0], "未知档位")
-            logger.info(f"检测到万用表之前处于开启状态 - {device_type}")
-    else:
-        logger.info("没有检测到之前的设备状态，所有设备处于关闭状态")
+    for unit in devices.values():
+        event_stream.set_state(device_state_data(unit))
+        last_stream_common = unit.last_stream_common
+        if last_stream_common:
+            logger.info(f"[{unit.device_id}] 检测到之前的设备状态，将在WebSocket连接时恢复: {last_stream_common.hex()}")
+            # 判断设备类型并记录
+            mode = mode_for_frame(last_stream_common)
+            if mode is not None and mode.ui_key:
+                logger.info(f"[{unit.device_id}] 检测到{mode.device_name}之前处于开启状态 - {mode.mode_name}")
+            elif mode is not None:
+                logger.info(f"[{unit.device_id}] 检测到{mode.device_name}之前处于开启状态")
+        else:
+            logger.info(f"[{unit.device_id}] 没有检测到之前的设备状态，所有设备处于关闭状态")
+
+async def supervise(name: str, worker, *args):
+    """运行后台任务，异常退出时记录日志并在 WORKER_RESTART_DELAY 秒后重新启动，正常返回时结束"""
+    while True:
+        try:
+            await worker(*args)
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"{name}异常退出: {e}，{WORKER_RESTART_DELAY} 秒后重启")
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+async def history_ingest_worker(queue: aio_pika.Queue, unit: DeviceState):
+    """后台消费历史采集队列，把到达的帧攒成连续缓冲区后批量解码入库，更新实时统计，推送每批的统计和命中的触发事件"""
+    pending = bytearray()
+    pending_ts = []
+
+    async def on_message(message: aio_pika.IncomingMessage):
+        pending.extend(message.body)
+        # 使用串口服务读到该帧的时间: 落盘缓冲补发的帧会集中到达，不能用到达时间
+        read_ts = message.headers.get('ts') if message.headers else None
+        pending_ts.append(read_ts if read_ts is not None else time.time())
+
+    # 先等历史汇总从采集文件重建完成，再写入新数据
+    await app_state["history_loaded"]
+    consumer_tag = await queue.consume(on_message, no_ack=True)
+    try:
+        while True:
+            await asyncio.sleep(HISTORY_BATCH_INTERVAL)
+            buf = bytes(pending)
+            ts = list(pending_ts)
+            pending.clear()
+            pending_ts.clear()
+            try:
+                if ts:
+                    await ingest_history_batch(unit, buf, ts)
+                elif unit.triggers.pending:
+                    # 通道停止上报时，等待触发后采样的事件也要按时完成
+                    await publish_trigger_events(unit, unit.triggers.complete(time.time()))
+            except Exception as e:
+                # 只丢弃出错的这一批，之后的数据照常入库
+                metrics.FRAMES_DROPPED.labels(reason="history_error").inc(len(ts))
+                logger.error(f"[{unit.device_id}] 历史数据批次处理失败: {e}")
+    finally:
+        # 任务被重启或取消时停止本次的消费，避免同一队列上残留多个消费者
+        try:
+            await queue.cancel(consumer_tag)
+        except Exception as e:
+            logger.warning(f"[{unit.device_id}] 取消历史采集队列消费失败: {e}")
+
+async def ingest_history_batch(unit: DeviceState, buf: bytes, ts: list):
+    """一批帧入库并更新实时统计、SSE 推送和触发器"""
+    metrics.FRAMES_IN.labels(path="history").inc(len(ts))
+    metrics.HISTORY_BATCH_SIZE.observe(len(ts))
+    decoded = unit.history.ingest_batch(buf, ts)
+    unit.history.flush()
+    unit.stats.update(decoded)
+    event_stream.publish_measurements(unit.device_id, summarize(decoded))
+    await publish_trigger_events(unit, unit.triggers.process(decoded))
+
+async def publish_trigger_events(unit: DeviceState, events: list):
+    """把触发事件推送给该设备的WebSocket连接和SSE订阅者"""
+    for event in events:
+        logger.info(f"[{unit.device_id}] 触发器 {event['trigger_id']} 命中: {event['channel']} = {event['value']:.4g}")
+        event_stream.publish(unit.device_id, "trigger", event)
+        await send_to_websockets(unit, lambda: [{"type": "trigger_event", **event}],
+                                 lambda: compact_trigger_event(event), "触发事件")
+
+async def trace_worker(queue: aio_pika.Queue):
+    """后台消费串口服务的指令追踪事件，合并到对应的追踪记录"""
+    async def on_message(message: aio_pika.IncomingMessage):
+        try:
+            trace_buffer.update(json.loads(message.body))
+        except Exception as e:
+            logger.warning(f"无法解析追踪事件: {e}")
+
+    await queue.consume(on_message, no_ack=True)
+
+async def queue_depth_worker(connection: aio_pika.RobustConnection, instance_queues: dict):
+    """
+    定期采集各队列的积压消息数，指令队列的深度同时交给准入控制。
+    instance_queues: 本实例独占队列的 指标标签 -> 实际队列名
+    被动声明不存在的队列时 broker 会关闭通道，所以使用单独的通道，关闭后重新打开，不影响发布指令的通道。
+    """
+    queue_names = dict(instance_queues)  # 指标标签 -> 队列名
+    command_queues = {}  # 指令队列名 -> 设备ID
+    for unit in devices.values():
+        queue_names[unit.to_serial_queue] = unit.to_serial_queue
+        command_queues[unit.to_serial_queue] = unit.device_id
+    channel = None
+    try:
+        while True:
+            for label, queue_name in queue_names.items():
+                try:
+                    if channel is None or channel.is_closed:
+                        channel = await connection.channel()
+                    queue = await channel.declare_queue(queue_name, passive=True)
+                    depth = queue.declaration_result.message_count
+                    metrics.QUEUE_DEPTH.labels(queue=label).set(depth)
+                    if queue_name in command_queues:
+                        admission.observe_queue_depth(command_queues[queue_name], depth)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"获取队列 {label} 深度失败: {e}")
+            await asyncio.sleep(QUEUE_DEPTH_INTERVAL)
+    finally:
+        if channel is not None and not channel.is_closed:
+            await channel.close()
+
+async def declare_tap_queue(channel: aio_pika.Channel, data_exchange: aio_pika.Exchange, unit: DeviceState,
+                            max_length: int, overflow: str = 'drop-head') -> aio_pika.Queue:
+    """为一个消费者声明独占、自动删除、有长度限制的队列并绑定到设备的串口数据
+
+    每个消费者都收到完整的数据流，消费慢时只会按自己的 overflow 策略丢弃自己队列里的帧，不影响其他消费者。
+    """
+    queue = await channel.declare_queue(
+        exclusive=True, auto_delete=True,
+        arguments={'x-max-length': max_length, 'x-overflow': overflow}
+    )
+    await queue.bind(data_exchange, routing_key=unit.data_routing_key)
+    return queue
+
+def parse_time_param(value: str, default: float) -> float:
+    """解析时间参数，支持Unix时间戳(秒)和ISO 8601格式"""
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
 
 # --- 4. API 端点 ---
-@app.get("/", response_class=FileResponse)
-async def read_index():
-    return "app/index.html"
+@app.get("/")
+async def read_index(request: Request):
+    return await static_assets.response(request, "index.html")
+
+async def switch_leds(unit: DeviceState, led_numbers, on: bool, exchange: aio_pika.Exchange):
+    """在状态执行器中发送LED开关指令并更新LED状态"""
+    for led_num in led_numbers:
+        if led_num in LED_COMMANDS:
+            await send_serial_command(led_frame(led_num, on), exchange, unit)
+            unit.led_states[str(led_num)] = on  # 更新LED状态
 
 @app.get("/api/open_all_led")
-async def open_all_led(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global led_states
-    for led_num in range(1, 10):
-        command = bytes([LED_COMMANDS[led_num], 0x00, 0x01, 0xFE])
-        await send_serial_command(command, exchange)
-        led_states[str(led_num)] = True  # 更新LED状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def open_all_led(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                       unit: DeviceState = Depends(get_device)):
+    await unit.actor.call(switch_leds, unit, range(1, 10), True, exchange)
     return {"status": "success", "message": "成功发送打开所有LED灯的指令"}
 
 @app.get("/api/close_all_led")
-async def close_all_led(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global led_states
-    for led_num in range(1, 10):
-        command = bytes([LED_COMMANDS[led_num], 0x00, 0x00, 0xFE])
-        await send_serial_command(command, exchange)
-        led_states[str(led_num)] = False  # 更新LED状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def close_all_led(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                        unit: DeviceState = Depends(get_device)):
+    await unit.actor.call(switch_leds, unit, range(1, 10), False, exchange)
     return {"status": "success", "message": "成功发送关闭所有LED灯的指令"}
 
 @app.get("/api/open_led")
-async def open_led(numbers: str, exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global led_states
+async def open_led(numbers: str, exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                   unit: DeviceState = Depends(get_device)):
     try:
         led_numbers = [int(num.strip()) for num in numbers.split(',')]
-        for led_num in led_numbers:
-            if led_num in LED_COMMANDS:
-                command = bytes([LED_COMMANDS[led_num], 0x00, 0x01, 0xFE])
-                await send_serial_command(command, exchange)
-                led_states[str(led_num)] = True  # 更新LED状态
-        await save_device_state(last_stream_common)  # 保存状态到文件
+        await unit.actor.call(switch_leds, unit, led_numbers, True, exchange)
         return {"status": "success", "message": f"成功发送打开 {len(led_numbers)} 个LED灯的指令"}
+    except CommandRejected:
+        raise
     except Exception as e:
         return {"status": "error", "message": f"操作失败: {str(e)}"}
 
 @app.get("/api/close_led")
-async def close_led(numbers: str, exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global led_states
+async def close_led(numbers: str, exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                    unit: DeviceState = Depends(get_device)):
     try:
         led_numbers = [int(num.strip()) for num in numbers.split(',')]
-        for led_num in led_numbers:
-            if led_num in LED_COMMANDS:
-                command = bytes([LED_COMMANDS[led_num], 0x00, 0x00, 0xFE])
-                await send_serial_command(command, exchange)
-                led_states[str(led_num)] = False  # 更新LED状态
-        await save_device_state(last_stream_common)  # 保存状态到文件
+        await unit.actor.call(switch_leds, unit, led_numbers, False, exchange)
         return {"status": "success", "message": f"成功发送关闭 {len(led_numbers)} 个LED灯的指令"}
+    except CommandRejected:
+        raise
     except Exception as e:
         return {"status": "error", "message": f"操作失败: {str(e)}"}
 
+async def open_stream_mode(unit: DeviceState, mode_key: str, exchange: aio_pika.Exchange):
+    """切换到指定的串流档位（示波器或万用表的某个档位）"""
+    mode = STREAM_MODES[mode_key]
+
+    async def switch():
+        await check_current_status(exchange, unit, mode.open_frame)
+        await send_serial_command(mode.open_frame, exchange, unit)
+        unit.last_stream_common = mode.open_frame  # 更新当前设备状态
+
+    await unit.actor.call(switch)
+
+async def close_stream_device(unit: DeviceState, close_frame: bytes, exchange: aio_pika.Exchange):
+    """关闭当前串流设备并清除设备状态"""
+    async def close():
+        await send_serial_command(close_frame, exchange, unit)
+        unit.last_stream_common = None  # 清除当前设备状态
+
+    await unit.actor.call(close)
+
 @app.get("/api/open_occ")
-async def open_occ(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await check_current_status(exchange, bytes([0x08, 0x00, 0x01, 0xFE]))
-    await send_serial_command(bytes([0x08, 0x00, 0x01, 0xFE]), exchange)
-    last_stream_common = bytes([0x08, 0x00, 0x01, 0xFE])  # 更新当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def open_occ(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                   unit: DeviceState = Depends(get_device)):
+    await open_stream_mode(unit, "oscilloscope", exchange)
     return {"message": "成功发送打开示波器的指令"}
 
 @app.get("/api/close_occ")
-async def close_occ(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await send_serial_command(bytes([0x07, 0x00, 0x00, 0xFE]), exchange)
-    last_stream_common = None  # 清除当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def close_occ(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                    unit: DeviceState = Depends(get_device)):
+    await close_stream_device(unit, CMD_CLOSE_OSCILLOSCOPE, exchange)
     return {"message": "成功发送关闭示波器的指令"}
 
 @app.get("/api/open_resistense")
-async def open_resistense(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await check_current_status(exchange, bytes([0x02, 0x00, 0x01, 0xFE]))
-    await send_serial_command(bytes([0x02, 0x00, 0x01, 0xFE]), exchange)
-    last_stream_common = bytes([0x02, 0x00, 0x01, 0xFE])  # 更新当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def open_resistense(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                          unit: DeviceState = Depends(get_device)):
+    await open_stream_mode(unit, "resistance", exchange)
     return {"message": "成功发送打开万用表-电阻档的指令"}
 
 @app.get("/api/open_cont")
-async def open_cont(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await check_current_status(exchange, bytes([0x03, 0x00, 0x02, 0xFE]))
-    await send_serial_command(bytes([0x03, 0x00, 0x02, 0xFE]), exchange)
-    last_stream_common = bytes([0x03, 0x00, 0x02, 0xFE])  # 更新当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def open_cont(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                    unit: DeviceState = Depends(get_device)):
+    await open_stream_mode(unit, "continuity", exchange)
     return {"message": "成功发送打开万用表-通断档的指令"}
 
 @app.get("/api/open_dcv")
-async def open_dcv(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await check_current_status(exchange, bytes([0x04, 0x00, 0x03, 0xFE]))
-    await send_serial_command(bytes([0x04, 0x00, 0x03, 0xFE]), exchange)
-    last_stream_common = bytes([0x04, 0x00, 0x03, 0xFE])  # 更新当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def open_dcv(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                   unit: DeviceState = Depends(get_device)):
+    await open_stream_mode(unit, "dc_voltage", exchange)
     return {"message": "成功发送打开万用表-直流电压档的指令"}
 
 @app.get("/api/open_acv")
-async def open_acv(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await check_current_status(exchange, bytes([0x05, 0x00, 0x04, 0xFE]))
-    await send_serial_command(bytes([0x05, 0x00, 0x04, 0xFE]), exchange)
-    last_stream_common = bytes([0x05, 0x00, 0x04, 0xFE])  # 更新当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def open_acv(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                   unit: DeviceState = Depends(get_device)):
+    await open_stream_mode(unit, "ac_voltage", exchange)
     return {"message": "成功发送打开万用表-交流电压档的指令"}
 
 @app.get("/api/open_dca")
-async def open_dca(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await check_current_status(exchange, bytes([0x06, 0x00, 0x05, 0xFE]))
-    await send_serial_command(bytes([0x06, 0x00, 0x05, 0xFE]), exchange)
-    last_stream_common = bytes([0x06, 0x00, 0x05, 0xFE])  # 更新当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def open_dca(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                   unit: DeviceState = Depends(get_device)):
+    await open_stream_mode(unit, "dc_current", exchange)
     return {"message": "成功发送打开万用表-直流电流档的指令"}
 
+@app.get("/api/open_mode")
+async def open_mode(mode: str, exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                    unit: DeviceState = Depends(get_device)):
+    """按档位标识打开示波器或万用表的任意档位"""
+    if mode not in STREAM_MODES:
+        return {"status": "error", "message": f"未知档位，可选值: {', '.join(STREAM_MODES)}"}
+    await open_stream_mode(unit, mode, exchange)
+    return {"status": "success", "message": f"成功发送打开{STREAM_MODES[mode].name}的指令"}
+
 @app.get("/api/close_multimeter")
-async def close_multimeter(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global last_stream_common
-    await send_serial_command(bytes([0x01, 0x00, 0x00, 0xFE]), exchange)
-    last_stream_common = None  # 清除当前设备状态
-    await save_device_state(last_stream_common)  # 保存状态到文件
+async def close_multimeter(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                           unit: DeviceState = Depends(get_device)):
+    await close_stream_device(unit, CMD_CLOSE_MULTIMETER, exchange)
     return {"message": "成功发送关闭万用表的指令"}
 
 @app.get("/api/get_temperature")
-async def get_temperature(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    await send_serial_command(bytes([0x0B, 0x00, 0x01, 0xFE]), exchange)
-    await restore_previous_device(exchange)
+async def get_temperature(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                          unit: DeviceState = Depends(get_device)):
+    await unit.actor.call(read_sensor, CMD_READ_TEMPERATURE, exchange, unit, save=False)
     return {"status": "success", "message": "成功发送温度读取指令"}
 
 @app.get("/api/get_gesture")
-async def get_gesture(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    await send_serial_command(bytes([0x0D, 0x00, 0x01, 0xFE]), exchange)
-    await restore_previous_device(exchange)
+async def get_gesture(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                      unit: DeviceState = Depends(get_device)):
+    await unit.actor.call(read_sensor, CMD_READ_GESTURE, exchange, unit, save=False)
     return {"status": "success", "message": "成功发送手势读取指令"}
 
 @app.get("/api/get_distance")
-async def get_distance(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    await send_serial_command(bytes([0x0C, 0x00, 0x01, 0xFE]), exchange)
-    await restore_previous_device(exchange)
+async def get_distance(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                       unit: DeviceState = Depends(get_device)):
+    await unit.actor.call(read_sensor, CMD_READ_DISTANCE, exchange, unit, save=False)
     return {"status": "success", "message": "成功发送测距读取指令"}
 
 @app.get("/api/get_light")
-async def get_light(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    await send_serial_command(bytes([0x0E, 0x00, 0x01, 0xFE]), exchange)
-    await restore_previous_device(exchange)
+async def get_light(exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                    unit: DeviceState = Depends(get_device)):
+    await unit.actor.call(read_sensor, CMD_READ_LIGHT, exchange, unit, save=False)
     return {"status": "success", "message": "成功发送光照读取指令"}
 
 @app.get("/api/power_supply_on")
-async def power_supply_on(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global power_supply_state
-    power_supply_state["outputEnabled"] = True
-    logger.info(f"🔋 电源输出已开启: {power_supply_state}")
-    await save_device_state(last_stream_common, power_supply_dict=power_supply_state)
+async def power_supply_on(unit: DeviceState = Depends(get_device)):
+    async def enable():
+        unit.power_supply_state["outputEnabled"] = True
+        logger.info(f"🔋 电源输出已开启: {unit.power_supply_state}")
+
+    await unit.actor.call(enable)
     return {"status": "success", "message": "电源输出已开启"}
 
 @app.get("/api/power_supply_off")
-async def power_supply_off(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global power_supply_state
-    power_supply_state["outputEnabled"] = False
-    power_supply_state["actualVoltage"] = 0.0  # 关闭时实际电压为0
-    logger.info(f"🔋 电源输出已关闭: {power_supply_state}")
-    await save_device_state(last_stream_common, power_supply_dict=power_supply_state)
+async def power_supply_off(unit: DeviceState = Depends(get_device)):
+    async def disable():
+        unit.power_supply_state["outputEnabled"] = False
+        unit.power_supply_state["actualVoltage"] = 0.0  # 关闭时实际电压为0
+        logger.info(f"🔋 电源输出已关闭: {unit.power_supply_state}")
+
+    await unit.actor.call(disable)
     return {"status": "success", "message": "电源输出已关闭"}
 
 @app.get("/api/set_voltage")
-async def set_voltage(voltage: float, exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global power_supply_state
-    if not (0 <= voltage <= 10.1):
-        return {"status": "error", "message": "电压超出范围 (0-10.1V)"}
-    
-    # 更新电源状态
-    power_supply_state["setVoltage"] = voltage
-    if power_supply_state["outputEnabled"]:
-        power_supply_state["actualVoltage"] = voltage  # 如果输出开启，设置实际电压
-    
-    command = None
-    if voltage == 0.1: command = bytes([0x09, 0x00, 0x01, 0xFE])
-    elif voltage == 1.0: command = bytes([0x09, 0x00, 0x64, 0xFE])
-    elif voltage == 10.0: command = bytes([0x09, 0x03, 0xe8, 0xFE])
-    elif voltage == 10.1: command = bytes([0x09, 0x03, 0xe9, 0xFE])
+async def set_voltage(voltage: float, exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                      unit: DeviceState = Depends(get_device)):
+    # 先编码校验，失败时不修改状态
+    try:
+        command = encode_voltage(voltage)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
     
-    if command:
-        await send_serial_command(command, exchange)
-        logger.info(f"🔋 电压设置为 {voltage}V: {power_supply_state}")
-        await save_device_state(last_stream_common, power_supply_dict=power_supply_state)
-        return {"status": "success", "message": f"电压设置为 {voltage}V"}
-    return {"status": "error", "message": "无法为该电压值生成指令"}
+    async def apply():
+        await send_serial_command(command, exchange, unit)
+        # 指令发送成功后再更新电源状态
+        unit.power_supply_state["setVoltage"] = voltage
+        if unit.power_supply_state["outputEnabled"]:
+            unit.power_supply_state["actualVoltage"] = voltage  # 如果输出开启，设置实际电压
+        logger.info(f"🔋 电压设置为 {voltage}V: {unit.power_supply_state}")
+
+    await unit.actor.call(apply)
+    return {"status": "success", "message": f"电压设置为 {voltage}V"}
+
+@app.get("/api/voltage_ramp")
+async def run_voltage_ramp(start: float, stop: float, step: float, dwell_ms: int = 0,
+                           exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                           unit: DeviceState = Depends(get_device)):
+    """生成从 start 到 stop 的电压斜坡，整批加入指令队列"""
+    try:
+        sequence = voltage_ramp(start, stop, step)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    if dwell_ms < 0:
+        return {"status": "error", "message": "停留时间不能为负数"}
+
+    final_voltage = round(sequence[-1][0], 2)
+
+    async def apply():
+        await send_serial_commands([frame for _, frame in sequence], exchange, unit, dwell_ms)
+        unit.power_supply_state["setVoltage"] = final_voltage
+        if unit.power_supply_state["outputEnabled"]:
+            unit.power_supply_state["actualVoltage"] = final_voltage
+
+    await unit.actor.call(apply)
+    logger.info(f"🔋 电压斜坡 {start}V -> {stop}V, 步进 {step}V, 共 {len(sequence)} 步")
+    return {
+        "status": "success",
+        "message": f"已加入 {len(sequence)} 条电压设置指令",
+        "steps": [round(v, 2) for v, _ in sequence]
+    }
 
 @app.get("/api/set_waveform")
-async def set_waveform(waveform: str, frequency: int, exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global signal_generator_state
-    waveform_codes = {"sine": 0x01, "square": 0x02, "triangle": 0x03}
-    freq_codes = {1: 0x01, 100: 0x64}
-    waveform_code = waveform_codes.get(waveform.lower())
-    freq_code = freq_codes.get(frequency)
-    if waveform_code is None or freq_code is None:
-        return {"status": "error", "message": "无效的波形或频率"}
-    
-    # 更新信号发生器状态
-    signal_generator_state["outputEnabled"] = True
-    signal_generator_state["waveform"] = waveform.lower()
-    signal_generator_state["frequency"] = frequency
+async def set_waveform(waveform: str, frequency: int, exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                       unit: DeviceState = Depends(get_device)):
+    # 先编码校验，失败时不修改状态
+    try:
+        command = encode_waveform(waveform, frequency)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
     
-    command = bytes([0x30, waveform_code, freq_code, 0xFE])
-    await send_serial_command(command, exchange)
-    logger.info(f"🌊 信号发生器设置: {waveform}波, {frequency}Hz - 状态: {signal_generator_state}")
-    await save_device_state(last_stream_common, signal_generator_dict=signal_generator_state)
+    async def apply():
+        await send_serial_command(command, exchange, unit)
+        # 指令发送成功后再更新信号发生器状态
+        unit.signal_generator_state["outputEnabled"] = True
+        unit.signal_generator_state["waveform"] = waveform.lower()
+        unit.signal_generator_state["frequency"] = frequency
+        logger.info(f"🌊 信号发生器设置: {waveform}波, {frequency}Hz - 状态: {unit.signal_generator_state}")
+
+    await unit.actor.call(apply)
     return {"status": "success", "message": f"信号发生器设置: {waveform}波, {frequency}Hz"}
 
+@app.get("/api/frequency_sweep")
+async def run_frequency_sweep(waveform: str, start: int, stop: int, step: int = 1, dwell_ms: int = 0,
+                              exchange: aio_pika.Exchange = Depends(get_mq_exchange),
+                              unit: DeviceState = Depends(get_device)):
+    """生成从 start 到 stop 的扫频序列，整批加入指令队列"""
+    try:
+        sequence = frequency_sweep(waveform, start, stop, step)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    if dwell_ms < 0:
+        return {"status": "error", "message": "停留时间不能为负数"}
+
+    async def apply():
+        await send_serial_commands([frame for _, frame in sequence], exchange, unit, dwell_ms)
+        unit.signal_generator_state["outputEnabled"] = True
+        unit.signal_generator_state["waveform"] = waveform.lower()
+        unit.signal_generator_state["frequency"] = sequence[-1][0]
+
+    await unit.actor.call(apply)
+    logger.info(f"🌊 扫频 {waveform}波 {start}Hz -> {stop}Hz, 步进 {step}Hz, 共 {len(sequence)} 步")
+    return {
+        "status": "success",
+        "message": f"已加入 {len(sequence)} 条信号发生器设置指令",
+        "steps": [f for f, _ in sequence]
+    }
+
 @app.get("/api/signal_generator_stop")
-async def signal_generator_stop(exchange: aio_pika.Exchange = Depends(get_mq_exchange)):
-    global signal_generator_state
-    signal_generator_state["outputEnabled"] = False
-    logger.info(f"🌊 信号发生器已停止: {signal_generator_state}")
-    await save_device_state(last_stream_common, signal_generator_dict=signal_generator_state)
+async def signal_generator_stop(unit: DeviceState = Depends(get_device)):
+    async def stop():
+        unit.signal_generator_state["outputEnabled"] = False
+        logger.info(f"🌊 信号发生器已停止: {unit.signal_generator_state}")
+
+    await unit.actor.call(stop)
     return {"status": "success", "message": "信号发生器已停止"}
 
 @app.get("/health")
 async def health():
+    """存活检查: 进程能响应HTTP即可，不依赖 RabbitMQ"""
     return {"status": "success", "message": f"当前时间: {datetime.now().isoformat()}"}
 
+@app.get("/ready")
+async def ready():
+    """就绪检查: RabbitMQ 已连接、设备状态和历史汇总已加载，未就绪时返回503"""
+    checks = {
+        "broker": broker_ready.is_set(),
+        "state_loaded": app_state.get("state_loaded", False),
+        "history_loaded": "history_loaded" in app_state and app_state["history_loaded"].done(),
+    }
+    if all(checks.values()):
+        return {"status": "success", "checks": checks}
+    return JSONResponse(status_code=503, content={"status": "error", "message": "服务尚未就绪", "checks": checks})
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 指标"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/api/devices")
+async def list_devices():
+    """本实例服务的所有一体机及其当前串流档位"""
+    result = []
+    for unit in devices.values():
+        mode = mode_for_frame(unit.last_stream_common)
+        result.append({
+            "device_id": unit.device_id,
+            "device_type": mode.device_type if mode else None,
+            "websocket_clients": len(unit.websockets),
+        })
+    return {"status": "success", "devices": result}
+
+@app.get("/api/stream")
+async def stream_events(request: Request, last_event_id: str = Query(None),
+                        unit: DeviceState = Depends(get_device)):
+    """
+    只读的SSE事件流: snapshot(完整状态)、state(变化的字段)、measurement(抽稀后的测量统计)。
+    断线重连时浏览器带 Last-Event-ID 头续传，也可以用 last_event_id 参数指定。
+    """
+    last_event_id = request.headers.get("last-event-id") or last_event_id
+
+    async def event_source():
+        metrics.SSE_CLIENTS.inc()
+        try:
+            async for chunk in event_stream.subscribe(unit.device_id, last_event_id, lambda: unit.snapshot):
+                yield chunk
+        finally:
+            metrics.SSE_CLIENTS.dec()
+
+    return StreamingResponse(event_source(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/triggers")
+async def list_triggers(unit: DeviceState = Depends(get_device)):
+    """该设备当前的所有触发器"""
+    return {
+        "status": "success",
+        "device_id": unit.device_id,
+        "triggers": [trigger.to_dict() for trigger in unit.triggers.triggers.values()],
+    }
+
+@app.get("/api/triggers/add")
+async def add_trigger(channel: str, kind: str = Query(..., alias="type"), level: float = None, low: float = None, high: float = None,
+                      hysteresis: float = 0.0, pre_seconds: float = 1.0, post_seconds: float = 1.0,
+                      unit: DeviceState = Depends(get_device)):
+    """
+    添加触发器: type=rising/falling 需要 level，type=range 需要 low 和 high。
+    命中的事件通过 /ws (type=trigger_event)、/api/stream (event: trigger) 推送。
+    """
+    try:
+        trigger = unit.triggers.add(channel=channel, kind=kind, level=level, low=low, high=high,
+                                    hysteresis=hysteresis, pre_seconds=pre_seconds, post_seconds=post_seconds)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    logger.info(f"[{unit.device_id}] 已添加触发器: {trigger.to_dict()}")
+    return {"status": "success", "device_id": unit.device_id, "trigger": trigger.to_dict()}
+
+@app.get("/api/triggers/remove")
+async def remove_trigger(trigger_id: str, unit: DeviceState = Depends(get_device)):
+    if not unit.triggers.remove(trigger_id):
+        return {"status": "error", "message": f"触发器 {trigger_id} 不存在"}
+    return {"status": "success", "message": f"触发器 {trigger_id} 已删除"}
+
+@app.get("/api/triggers/events")
+async def get_trigger_events(limit: int = Query(20, ge=1, le=200), unit: DeviceState = Depends(get_device)):
+    """最近命中的触发事件(新的在前)，包含前后采集窗口的采样"""
+    return {"status": "success", "device_id": unit.device_id, "events": unit.triggers.recent(limit)}
+
+@app.get("/api/trace/recent")
+async def get_recent_traces(limit: int = Query(20, ge=1, le=1000)):
+    """最近N条指令从HTTP请求到设备应答的各阶段耗时(毫秒)"""
+    return {"status": "success", "traces": trace_buffer.recent(limit)}
+
 # 新增：查询当前设备状态的API
 @app.get("/api/device_status")
-async def get_device_status():
-    """获取当前设备状态"""
-    global last_stream_common, led_states, power_supply_state, signal_generator_state
+async def get_device_status(unit: DeviceState = Depends(get_device)):
+    """获取当前设备状态(读取最近一次提交的状态快照)"""
+    state = unit.snapshot
+    last_stream_common = bytes.fromhex(state["last_stream_common"]) if state.get("last_stream_common") else None
+    led_states = state.get("led_states", {})
+    power_supply_state = state.get("power_supply_state")
+    signal_generator_state = state.get("signal_generator_state")
     
     # 构建LED状态，确保所有LED都有状态
     led_ui_state = {}
     for led_num in range(1, 10):
         led_ui_state[f"led{led_num}"] = led_states.get(str(led_num), False)
+
+    def build_ui_state(oscilloscope_button, multimeter_buttons):
+        return {
+            "oscilloscope_button": oscilloscope_button,
+            "multimeter_buttons": multimeter_buttons,
+            "led_states": led_ui_state,
+            "power_supply_state": power_supply_state,  # 🔋 添加电源状态
+            "signal_generator_state": signal_generator_state
+        }
     
     if last_stream_common is None:
         return {
             "status": "success", 
+            "device_id": unit.device_id,
             "device_state": "closed",
             "device_type": None,
-            "ui_state": {
-                "oscilloscope_button": "closed",
-                "multimeter_buttons": {
-                    "resistance": "closed",
-                    "continuity": "closed", 
-                    "dc_voltage": "closed",
-                    "ac_voltage": "closed",
-                    "dc_current": "closed"
-                },
-                "led_states": led_ui_state,
-                "power_supply_state": power_supply_state,  # 🔋 添加电源状态
-                "signal_generator_state": signal_generator_state
-            },
+            "ui_state": build_ui_state("closed", {key: "closed" for key in MULTIMETER_UI_KEYS}),
             "power_supply_state": power_supply_state,  # 🔋 添加电源状态
             "signal_generator_state": signal_generator_state,
             "message": "所有设备均已关闭"
         }
     
     # 判断设备类型
-    if last_stream_common == bytes([0x08, 0x00, 0x01, 0xFE]):
-        return {
-            "status": "success",
-            "device_state": "opened", 
-            "device_type": "oscilloscope",
-            "device_name": "示波器",
-            "command_hex": last_stream_common.hex(),
-            "ui_state": {
-                "oscilloscope_button": "opened",
-                "multimeter_buttons": {
-                    "resistance": "closed",
-                    "continuity": "closed",
-                    "dc_voltage": "closed", 
-                    "ac_voltage": "closed",
-                    "dc_current": "closed"
-                },
-                "led_states": led_ui_state,
-                "power_supply_state": power_supply_state,  # 🔋 添加电源状态
-                "signal_generator_state": signal_generator_state
-            },
-            "power_supply_state": power_supply_state,  # 🔋 添加电源状态
-            "signal_generator_state": signal_generator_state,
-            "message": "示波器当前处于开启状态"
-        }
-    elif last_stream_common and last_stream_common[0] in [0x02, 0x03, 0x04, 0x05, 0x06]:
-        device_info = {
-            0x02: {"type": "multimeter_resistance", "name": "万用表-电阻档", "ui_key": "resistance"},
-            0x03: {"type": "multimeter_continuity", "name": "万用表-通断档", "ui_key": "continuity"}, 
-            0x04: {"type": "multimeter_dc_voltage", "name": "万用表-直流电压档", "ui_key": "dc_voltage"},
-            0x05: {"type": "multimeter_ac_voltage", "name": "万用表-交流电压档", "ui_key": "ac_voltage"},
-            0x06: {"type": "multimeter_dc_current", "name": "万用表-直流电流档", "ui_key": "dc_current"}
-        }
-        info = device_info.get(last_stream_common[0], {"type": "unknown", "name": "未知设备", "ui_key": "unknown"})
-        
-        # 构建万用表按钮状态
-        multimeter_buttons = {
-            "resistance": "closed",
-            "continuity": "closed",
-            "dc_voltage": "closed",
-            "ac_voltage": "closed", 
-            "dc_current": "closed"
-        }
-        if info["ui_key"] in multimeter_buttons:
-            multimeter_buttons[info["ui_key"]] = "opened"
-        
+    mode = mode_for_frame(last_stream_common)
+    if mode is not None:
+        multimeter_buttons = {key: "closed" for key in MULTIMETER_UI_KEYS}
+        if mode.ui_key:
+            multimeter_buttons[mode.ui_key] = "opened"
+        oscilloscope_button = "closed" if mode.ui_key else "opened"
         return {
             "status": "success",
+            "device_id": unit.device_id,
             "device_state": "opened",
-            "device_type": info["type"],
-            "device_name": info["name"],
+            "device_type": mode.device_type,
+            "device_name": mode.name,
             "command_hex": last_stream_common.hex(),
-            "ui_state": {
-                "oscilloscope_button": "closed",
-                "multimeter_buttons": multimeter_buttons,
-                "led_states": led_ui_state,
-                "power_supply_state": power_supply_state,  # 🔋 添加电源状态
-                "signal_generator_state": signal_generator_state
-            },
+            "ui_state": build_ui_state(oscilloscope_button, multimeter_buttons),
             "power_supply_state": power_supply_state,  # 🔋 添加电源状态
             "signal_generator_state": signal_generator_state,
-            "message": f"{info['name']}当前处于开启状态"
+            "message": f"{mode.name}当前处于开启状态"
         }
     else:
         return {
             "status": "success",
+            "device_id": unit.device_id,
             "device_state": "unknown",
             "device_type": "unknown", 
             "command_hex": last_stream_common.hex(),
-            "ui_state": {
-                "oscilloscope_button": "unknown",
-                "multimeter_buttons": {
-                    "resistance": "unknown",
-                    "continuity": "unknown",
-                    "dc_voltage": "unknown",
-                    "ac_voltage": "unknown",
-                    "dc_current": "unknown"
-                },
-                "led_states": led_ui_state,
-                "power_supply_state": power_supply_state,  # 🔋 添加电源状态
-                "signal_generator_state": signal_generator_state
-            },
+            "ui_state": build_ui_state("unknown", {key: "unknown" for key in MULTIMETER_UI_KEYS}),
             "power_supply_state": power_supply_state,  # 🔋 添加电源状态
             "signal_generator_state": signal_generator_state,
             "message": "检测到未知的设备状态"
         }
 
+# 新增：历史测量数据查询API
+@app.get("/api/history")
+async def get_history(
+    device: str,
+    start: str = Query(None, alias="from"),
+    end: str = Query(None, alias="to"),
+    resolution: str = "auto",
+    unit: DeviceState = Depends(get_device),
+):
+    """查询测量通道在时间范围内的 min/max/mean 汇总数据"""
+    try:
+        end_ts = parse_time_param(end, time.time())
+        start_ts = parse_time_param(start, end_ts - 3600)
+    except ValueError:
+        return {"status": "error", "message": "时间参数格式错误，应为Unix时间戳或ISO 8601格式"}
+    if start_ts > end_ts:
+        return {"status": "error", "message": "起始时间不能晚于结束时间"}
+
+    history_store = unit.history
+    if resolution == "auto":
+        res = history_store.pick_resolution(device, start_ts, end_ts)
+    else:
+        try:
+            res = int(resolution)
+        except ValueError:
+            res = None
+        if res not in history_store.levels:
+            return {"status": "error", "message": f"不支持的分辨率，可选值: auto, {', '.join(map(str, history_store.levels))}"}
+
+    points = history_store.query(device, start_ts, end_ts, res)
+    return {
+        "status": "success",
+        "device_id": unit.device_id,
+        "device": device,
+        "from": start_ts,
+        "to": end_ts,
+        "resolution": res,
+        "points": points,
+        "channels": history_store.channels()
+    }
+
+@app.get("/api/export")
+async def export_measurement(
+    device: str,
+    start: str = Query(None, alias="from"),
+    end: str = Query(None, alias="to"),
+    fmt: str = Query("csv", alias="format"),
+    unit: DeviceState = Depends(get_device),
+):
+    """以 CSV/.npy/Arrow IPC 流分块下载测量通道在时间范围内的原始采样，默认最近1小时"""
+    if device not in CHANNEL_INDEX:
+        return {"status": "error", "message": f"未知测量通道 {device}，可选值: {', '.join(CHANNEL_INDEX)}"}
+    if fmt not in available_formats():
+        return {"status": "error", "message": f"不支持的导出格式，可选值: {', '.join(available_formats())}"}
+    try:
+        end_ts = parse_time_param(end, time.time())
+        start_ts = parse_time_param(start, end_ts - 3600)
+    except ValueError:
+        return {"status": "error", "message": "时间参数格式错误，应为Unix时间戳或ISO 8601格式"}
+    if start_ts > end_ts:
+        return {"status": "error", "message": "起始时间不能晚于结束时间"}
+
+    # 二分查找需要读文件，放到线程池；文件在开始发送响应时才打开，客户端提前断开也不会泄漏句柄
+    capture = await asyncio.to_thread(unit.history.open_range, device, start_ts, end_ts)
+    media_type, extension = EXPORT_FORMATS[fmt]
+    file_name = f"{unit.device_id}_{device}_{int(start_ts)}-{int(end_ts)}{extension}"
+    headers = {
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+        "X-Record-Count": str(capture.count),
+    }
+    length = content_length(fmt, capture.count)
+    if length is not None:
+        headers["Content-Length"] = str(length)
+    # 同步生成器由 Starlette 放到线程池中迭代，读文件和格式转换不阻塞事件循环
+    return StreamingResponse(export_chunks(capture, fmt, device, unit.device_id),
+                             media_type=media_type, headers=headers)
+
+# 新增：最近测量数据查询API
+@app.get("/api/measurement/recent")
+async def get_recent_measurement(device: str, seconds: float = 5, limit: int = 50,
+                                 unit: DeviceState = Depends(get_device)):
+    """返回测量通道最近一段时间的统计值和末尾若干个原始采样"""
+    # 每次最多读取约1MB的采集文件末尾，放到线程池中读取，不阻塞事件循环
+    ts, values = await asyncio.to_thread(unit.history.read_recent, device, seconds)
+    if len(values) == 0:
+        return {"status": "error", "message": f"最近 {seconds} 秒内没有 {device} 的测量数据"}
+    limit = max(0, limit)
+    return {
+        "status": "success",
+        "device_id": unit.device_id,
+        "device": device,
+        "count": int(len(values)),
+        "latest": float(values[-1]),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+        "samples": [
+            {"t": t, "value": v}
+            for t, v in zip(ts[-limit:].tolist(), values[-limit:].tolist())
+        ] if limit else []
+    }
+
+@app.get("/api/measurement/summary")
+async def get_measurement_summary(device: str = None, unit: DeviceState = Depends(get_device)):
+    """
+    返回测量通道最近 STATS_WINDOW 个采样的实时统计(均值、最值、标准差、RMS、频率)，
+    直接读取内存中增量维护的结果；不指定 device 时使用当前打开的档位
+    """
+    if device is None:
+        mode = mode_for_frame(unit.last_stream_common)
+        if mode is None:
+            return {"status": "error", "message": "当前没有打开的测量档位，请指定 device"}
+        device = mode.device_type
+    summary = unit.stats.summary(device)
+    if summary is None:
+        return {"status": "error", "message": f"还没有 {device} 的测量数据"}
+    return {"status": "success", "device_id": unit.device_id, "device": device, **summary}
+
 # 新增：前端页面加载时的状态初始化API
 @app.get("/api/init_ui_state")
-async def init_ui_state():
+async def init_ui_state(unit: DeviceState = Depends(get_device)):
     """前端页面加载时调用，获取完整的UI状态信息"""
-    global last_stream_common
-    
     # 获取设备状态
-    device_status = await get_device_status()
+    device_status = await get_device_status(unit)
     
     # 添加额外的初始化信息
     init_info = {
         "timestamp": datetime.now().isoformat(),
         "server_status": "running",
-        "websocket_endpoint": "/ws",
+        "websocket_endpoint": "/ws" if unit.device_id == DEFAULT_DEVICE else f"/ws?device_id={unit.device_id}",
         "device_status": device_status,
         "initialization": "completed"
     }
@@ -736,62 +1365,91 @@ async def init_ui_state():
     
     return init_info
 
+async def restore_device_outputs(unit: DeviceState, exchange: aio_pika.Exchange):
+    """重新发送开启的LED和当前串流档位的指令"""
+    if unit.led_states:
+        logger.info(f"恢复LED状态: {unit.led_states}")
+        for led_num_str, is_on in unit.led_states.items():
+            if is_on:  # 只恢复开启的LED
+                led_num = int(led_num_str)
+                if led_num in LED_COMMANDS:
+                    await send_serial_command(led_frame(led_num, True), exchange, unit)
+                    logger.info(f"✅ 已恢复LED{led_num}开启状态")
+    if unit.last_stream_common:
+        logger.info(f"WebSocket连接后自动恢复设备状态: {unit.last_stream_common.hex()}")
+        await send_serial_command(unit.last_stream_common, exchange, unit)
+
 # --- 5. WebSocket 端点 ---
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, channel: aio_pika.Channel = Depends(get_mq_channel)):
-    global last_stream_common, led_states, power_supply_state, signal_generator_state
-    
+async def websocket_endpoint(websocket: WebSocket, device_id: str = DEFAULT_DEVICE,
+                             schema: int = WS_DEFAULT_SCHEMA, encoding: str = "json"):
+    unit = devices.get(device_id)
+    if unit is None:
+        await websocket.close(code=1008, reason=f"unknown device: {device_id}")
+        return
+    # schema=2 使用精简消息格式，encoding=msgpack 时状态消息以 MessagePack 编码，见 ws_schema.py
+    try:
+        fmt = WsFormat(schema, encoding)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    # 服务启动阶段 RabbitMQ 尚未连接时拒绝连接，前端稍后自动重连
+    if not await wait_until_ready():
+        await websocket.close(code=1013, reason="service starting")
+        return
+    active_websockets = unit.websockets
+
     await websocket.accept()
-    logger.info("WebSocket 连接已建立")
+    logger.info(f"WebSocket 连接已建立，设备: {device_id}，消息格式: schema={fmt.schema} encoding={fmt.encoding}")
     
     # 将连接添加到活跃连接集合
-    active_websockets.add(websocket)
+    active_websockets[websocket] = fmt
     logger.info(f"当前活跃WebSocket连接数: {len(active_websockets)}")
     
     # 获取exchange用于恢复设备状态
     exchange = app_state.get("mq_exchange")
     
-    # 在WebSocket连接建立后，恢复LED状态
-    if led_states and exchange:
-        logger.info(f"恢复LED状态: {led_states}")
-        for led_num_str, is_on in led_states.items():
-            if is_on:  # 只恢复开启的LED
-                led_num = int(led_num_str)
-                if led_num in LED_COMMANDS:
-                    command = bytes([LED_COMMANDS[led_num], 0x00, 0x01, 0xFE])
-                    await send_serial_command(command, exchange)
-                    logger.info(f"✅ 已恢复LED{led_num}开启状态")
-    
-    # 在WebSocket连接建立后，如果有之前保存的设备状态，自动恢复
+    # 在WebSocket连接建立后，恢复LED状态和之前保存的设备状态；
+    # 在状态执行器中按当时的最新状态发送，不会和正在进行的切换交错
+    if exchange:
+        await unit.actor.call(restore_device_outputs, unit, exchange, save=False)
+
+    # 之后发给前端的同步消息都取自同一份状态快照
+    state = unit.snapshot
+    last_stream_common = bytes.fromhex(state["last_stream_common"]) if state.get("last_stream_common") else None
+    led_states = state.get("led_states")
+    power_supply_state = state.get("power_supply_state")
+    signal_generator_state = state.get("signal_generator_state")
+
+    if fmt.compact:
+        # 精简格式: 先发送编号字典，再用一条状态消息代替下面的各条同步消息
+        try:
+            await fmt.send(websocket, fmt.encode(hello_message(unit.device_id)))
+            await fmt.send(websocket, fmt.encode(compact_state(state)))
+        except Exception as e:
+            logger.error(f"发送状态同步消息失败: {e}")
+        last_stream_common = power_supply_state = signal_generator_state = led_states = None
+
     if last_stream_common and exchange:
-        logger.info(f"WebSocket连接后自动恢复设备状态: {last_stream_common.hex()}")
-        await send_serial_command(last_stream_common, exchange)
-        
         # 记录恢复的设备类型
         device_state_info = None
-        if last_stream_common == bytes([0x08, 0x00, 0x01, 0xFE]):
-            logger.info("✅ 已自动恢复示波器开启状态")
+        mode = mode_for_frame(last_stream_common)
+        if mode is not None and mode.ui_key:
+            logger.info(f"✅ 已自动恢复{mode.device_name}开启状态 - {mode.mode_name}")
             device_state_info = {
                 "type": "state_sync",
-                "device": "oscilloscope", 
-                "state": "opened",
-                "message": "示波器状态已恢复为开启"
-            }
-        elif last_stream_common and last_stream_common[0] in [0x02, 0x03, 0x04, 0x05, 0x06]:
-            device_types = {0x02: "电阻档", 0x03: "通断档", 0x04: "直流电压档", 0x05: "交流电压档", 0x06: "直流电流档"}
-            device_type = device_types.get(last_stream_common[0], "未知档位")
-            logger.info(f"✅ 已自动恢复万用表开启状态 - {device_type}")
-            
-            device_types_map = {
-                0x02: "resistance", 0x03: "continuity", 0x04: "dc_voltage", 
-                0x05: "ac_voltage", 0x06: "dc_current"
+                "device": mode.device,
+                "subtype": mode.ui_key,
+                "state": "opened", 
+                "message": f"{mode.device_name}{mode.mode_name}状态已恢复为开启"
             }
+        elif mode is not None:
+            logger.info(f"✅ 已自动恢复{mode.device_name}开启状态")
             device_state_info = {
                 "type": "state_sync",
-                "device": "multimeter",
-                "subtype": device_types_map.get(last_stream_common[0], "unknown"),
-                "state": "opened", 
-                "message": f"万用表{device_type}状态已恢复为开启"
+                "device": mode.device, 
+                "state": "opened",
+                "message": f"{mode.device_name}状态已恢复为开启"
             }
         
         # 发送状态同步消息到前端
@@ -852,27 +1510,35 @@ async def websocket_endpoint(websocket: WebSocket, channel: aio_pika.Channel = D
         except Exception as e:
             logger.error(f"发送LED状态同步消息失败: {e}")
     
-    # 获取对在启动时声明的固定队列的引用
-    comequeue = await channel.get_queue(FROM_SERIAL_QUEUE)
-    
-    # 强制清空队列中的所有消息
+    channel = comequeue = None
     try:
-        purged_result = await comequeue.purge()
-        logger.info(f"WebSocket连接时已清空队列，message_count: {purged_result.message_count} 删除了 {purged_result.message_count} 条消息")
-    except Exception as e:
-        logger.warning(f"清空队列时发生错误: {e}")
+        # 每个连接使用自己的通道并限制预取数，客户端消费慢时帧积压在有长度限制的队列里按 overflow 策略丢弃，
+        # 而不是堆在本进程的内存中
+        channel = await app_state["mq_connection"].channel()
+        await channel.set_qos(prefetch_count=WS_PREFETCH)
+        # 每个连接独占一个新队列，不会读到连接之前积压的旧数据，也不会和其他连接争抢数据
+        comequeue = await declare_tap_queue(channel, app_state["mq_data_exchange"], unit,
+                                            WS_QUEUE_MAX_LENGTH, WS_QUEUE_OVERFLOW)
 
-    try:
-        # 从共享队列中异步消费消息
+        # 从本连接的队列中异步消费消息
         async with comequeue.iterator() as queue_iter:
             async for message in queue_iter:
                 # 使用 message.process() 自动进行 ACK/NACK
                 async with message.process():
-                    hex_data = message.body.hex()
-                    logger.info(f"输出到websocket: {hex_data}")
+                    metrics.FRAMES_IN.labels(path="ws").inc()
+                    # 结束字节不是0xFE的残帧前端也无法解析，直接丢弃
+                    if not is_valid_frame(message.body):
+                        metrics.FRAMES_DROPPED.labels(reason="invalid").inc()
+                        continue
+                    logger.info("输出到websocket: %s", message.body.hex(), extra=WS_FRAME_LOG)
 
                     if websocket.client_state.name == "CONNECTED":
-                        await websocket.send_text(hex_data)
+                        await fmt.send_frame(websocket, message.body)
+                        read_ts = message.headers.get("ts") if message.headers else None
+                        if read_ts is not None:
+                            lag = time.time() - read_ts
+                            websocket_lag[websocket] = lag
+                            metrics.WEBSOCKET_LAG.observe(lag)
                     else:
                         logger.info("WebSocket 已断开，停止消费消息。")
                         break
@@ -882,6 +1548,17 @@ async def websocket_endpoint(websocket: WebSocket, channel: aio_pika.Channel = D
         logger.error(f"WebSocket 或 RabbitMQ 消费时发生错误: {e}")
     finally:
         # 从活跃连接集合中移除连接
-        active_websockets.discard(websocket)
+        active_websockets.pop(websocket, None)
+        websocket_lag.pop(websocket, None)
+        if comequeue is not None:
+            try:
+                await comequeue.delete(if_unused=False, if_empty=False)
+            except Exception as e:
+                logger.warning(f"删除WebSocket队列失败: {e}")
+        if channel is not None:
+            try:
+                await channel.close()
+            except Exception as e:
+                logger.warning(f"关闭WebSocket通道失败: {e}")
         logger.info(f"WebSocket连接已断开，当前活跃连接数: {len(active_websockets)}")
         logger.info("清理 WebSocket 连接资源。")
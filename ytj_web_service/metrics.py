@@ -0,0 +1,51 @@
+"""
+ytj_web_service 的 Prometheus 指标
+所有指标集中定义在这里，由 /metrics 端点以文本格式导出。
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+# 串口数据帧
+FRAMES_IN = Counter(
+    'ytj_web_frames_in_total', '从RabbitMQ收到的串口数据帧数', ['path'])
+FRAMES_DROPPED = Counter(
+    'ytj_web_frames_dropped_total', '被丢弃的串口数据帧数', ['reason'])
+COMMANDS_OUT = Counter(
+    'ytj_web_commands_out_total', '发布到串口指令队列的指令帧数')
+COMMANDS_REJECTED = Counter(
+    'ytj_web_commands_rejected_total', '被准入控制拒绝(429)的指令请求数', ['reason'])
+
+# RabbitMQ
+PUBLISH_LATENCY = Histogram(
+    'ytj_web_publish_seconds', '发布一条指令到RabbitMQ的耗时',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+QUEUE_DEPTH = Gauge(
+    'ytj_web_queue_depth', 'RabbitMQ队列中待消费的消息数', ['queue'])
+
+# WebSocket
+WEBSOCKET_CLIENTS = Gauge(
+    'ytj_web_websocket_clients', '当前WebSocket连接数')
+WEBSOCKET_LAG = Histogram(
+    'ytj_web_websocket_lag_seconds', '串口读到数据帧到推送给WebSocket客户端的延迟',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+WEBSOCKET_CLIENT_LAG_MAX = Gauge(
+    'ytj_web_websocket_client_lag_max_seconds', '各WebSocket客户端最近一帧延迟中的最大值')
+WEBSOCKET_MESSAGE_BYTES = Counter(
+    'ytj_web_websocket_message_bytes_total', '编码后的WebSocket状态和事件消息字节数(每种格式每条消息计一次)',
+    ['schema', 'encoding'])
+
+# SSE
+SSE_CLIENTS = Gauge(
+    'ytj_web_sse_clients', '当前 /api/stream 连接数')
+
+# 状态持久化
+STATE_SAVE_DURATION = Histogram(
+    'ytj_web_state_save_seconds', '保存设备状态(写文件并广播)的耗时',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+STATE_ACTOR_BATCH_SIZE = Histogram(
+    'ytj_web_state_actor_batch_operations', '状态执行器每批合并执行的操作数',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+
+# 历史数据
+HISTORY_BATCH_SIZE = Histogram(
+    'ytj_web_history_batch_frames', '历史数据每批解码的帧数',
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
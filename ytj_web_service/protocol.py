@@ -0,0 +1,241 @@
+"""
+一体机串口协议编解码表
+每帧固定4字节: [操作码, 高字节, 低字节, 0xFE]。
+所有操作码、预分配的指令帧以及帧 -> 设备/档位的查找表都集中在这里，
+新增仪器档位只需要在 STREAM_MODES 中加一行。
+
+注意: serial_service、ytj_web_service、ytj_mcp_service 使用各自独立的 Docker 构建上下文，
+三个目录下各有一份相同的 protocol.py，修改时需同步更新。
+"""
+from collections import namedtuple
+
+FRAME_SIZE = 4
+FRAME_END = 0xFE
+
+# --- 操作码 ---
+OP_MULTIMETER_OFF = 0x01
+OP_RESISTANCE = 0x02
+OP_CONTINUITY = 0x03
+OP_DC_VOLTAGE = 0x04
+OP_AC_VOLTAGE = 0x05
+OP_DC_CURRENT = 0x06
+OP_OSCILLOSCOPE_OFF = 0x07
+OP_OSCILLOSCOPE = 0x08
+OP_POWER_SUPPLY = 0x09
+OP_SIGNAL_GENERATOR_REPORT = 0x0A
+OP_TEMPERATURE = 0x0B
+OP_DISTANCE = 0x0C
+OP_GESTURE = 0x0D
+OP_LIGHT = 0x0E
+OP_SIGNAL_GENERATOR = 0x30
+
+# LED编号 -> 操作码
+LED_COMMANDS = {
+    1: 0x10, 2: 0x11, 3: 0x12, 4: 0x13, 5: 0x14,
+    6: 0x15, 7: 0x16, 8: 0x17, 9: 0x18
+}
+
+
+def encode(opcode: int, value: int = 0) -> bytes:
+    """把操作码和16位数值编码为一帧"""
+    return bytes((opcode, (value >> 8) & 0xFF, value & 0xFF, FRAME_END))
+
+
+def encode_bytes(opcode: int, hi: int, lo: int) -> bytes:
+    """把操作码和高低两个独立字节编码为一帧"""
+    return bytes((opcode, hi & 0xFF, lo & 0xFF, FRAME_END))
+
+
+def is_valid_frame(frame: bytes) -> bool:
+    return len(frame) == FRAME_SIZE and frame[3] == FRAME_END
+
+
+def frame_value(frame: bytes) -> int:
+    """取出帧中高低字节组成的16位数值"""
+    return (frame[1] << 8) | frame[2]
+
+
+# --- 预分配的指令帧 ---
+CMD_CLOSE_MULTIMETER = encode(OP_MULTIMETER_OFF, 0)
+CMD_CLOSE_OSCILLOSCOPE = encode(OP_OSCILLOSCOPE_OFF, 0)
+CMD_READ_TEMPERATURE = encode(OP_TEMPERATURE, 1)
+CMD_READ_DISTANCE = encode(OP_DISTANCE, 1)
+CMD_READ_GESTURE = encode(OP_GESTURE, 1)
+CMD_READ_LIGHT = encode(OP_LIGHT, 1)
+
+# 关闭串流设备的指令，串口服务写入后需要清空接收缓冲区
+CLOSE_FRAMES = frozenset((CMD_CLOSE_MULTIMETER, CMD_CLOSE_OSCILLOSCOPE))
+
+LED_ON_FRAMES = {num: encode(opcode, 1) for num, opcode in LED_COMMANDS.items()}
+LED_OFF_FRAMES = {num: encode(opcode, 0) for num, opcode in LED_COMMANDS.items()}
+
+
+def led_frame(led_num: int, on: bool) -> bytes:
+    return (LED_ON_FRAMES if on else LED_OFF_FRAMES)[led_num]
+
+
+# --- 电源电压与信号发生器编码 ---
+# 电压以0.01V为单位写入0x09指令的高低字节
+VOLTAGE_MIN = 0.0
+VOLTAGE_MAX = 10.1
+VOLTAGE_RESOLUTION = 0.01
+# 原有的预设电压表(0.01V计数 -> 写入的数值)。1.0V、10.0V 与0.01V计数一致，
+# 0.1V 和 10.1V 原来写入 0x0001 和 0x03E9，设备协议未确认这两档的单位，保持设备原来收到的值
+VOLTAGE_PRESET_VALUES = {10: 0x0001, 100: 0x0064, 1000: 0x03E8, 1010: 0x03E9}
+
+# 信号发生器: 高字节为波形编码，低字节为频率(Hz)
+WAVEFORM_CODES = {"sine": 0x01, "square": 0x02, "triangle": 0x03}
+FREQUENCY_MIN = 1
+FREQUENCY_MAX = 0xFF
+
+# 单次斜坡/扫频最多生成的指令帧数
+MAX_SEQUENCE_STEPS = 1000
+
+
+def voltage_counts(voltage: float) -> int:
+    """把电压换算为0.01V计数，超出范围时抛出 ValueError"""
+    if not (VOLTAGE_MIN <= voltage <= VOLTAGE_MAX):
+        raise ValueError(f"电压超出范围 ({VOLTAGE_MIN:g}-{VOLTAGE_MAX:g}V)")
+    return int(round(voltage / VOLTAGE_RESOLUTION))
+
+
+def encode_voltage_counts(counts: int) -> bytes:
+    """把0.01V计数编码为电源指令，预设电压沿用原有的数值"""
+    return encode(OP_POWER_SUPPLY, VOLTAGE_PRESET_VALUES.get(counts, counts))
+
+
+def encode_voltage(voltage: float) -> bytes:
+    return encode_voltage_counts(voltage_counts(voltage))
+
+
+def encode_waveform(waveform: str, frequency: int) -> bytes:
+    """编码信号发生器指令，波形或频率无效时抛出 ValueError"""
+    waveform_code = WAVEFORM_CODES.get(waveform.lower())
+    if waveform_code is None:
+        raise ValueError(f"无效的波形，可选值: {', '.join(WAVEFORM_CODES)}")
+    if not (FREQUENCY_MIN <= frequency <= FREQUENCY_MAX):
+        raise ValueError(f"频率超出范围 ({FREQUENCY_MIN}-{FREQUENCY_MAX}Hz)")
+    return encode_bytes(OP_SIGNAL_GENERATOR, waveform_code, frequency)
+
+
+def _sequence_steps(start, stop, step, resolution):
+    """按步进生成从 start 到 stop(含) 的数值序列，step 的符号由方向决定"""
+    if step <= 0:
+        raise ValueError("步进必须大于0")
+    direction = 1 if stop >= start else -1
+    count = int(abs(stop - start) / step + resolution / step / 2) + 1
+    if count > MAX_SEQUENCE_STEPS:
+        raise ValueError(f"步数过多 ({count})，单次最多 {MAX_SEQUENCE_STEPS} 步")
+    values = [start + direction * step * i for i in range(count)]
+    if abs(values[-1] - stop) > resolution / 2:
+        values.append(stop)
+    return values
+
+
+def voltage_ramp(start: float, stop: float, step: float):
+    """生成电压斜坡，返回 [(电压, 指令帧), ...]，任一步无效时整体抛出 ValueError"""
+    voltage_counts(start)
+    voltage_counts(stop)
+    if step < VOLTAGE_RESOLUTION:
+        raise ValueError(f"步进不能小于 {VOLTAGE_RESOLUTION}V")
+    sequence = []
+    for voltage in _sequence_steps(start, stop, step, VOLTAGE_RESOLUTION):
+        counts = voltage_counts(voltage)
+        sequence.append((counts * VOLTAGE_RESOLUTION, encode_voltage_counts(counts)))
+    return sequence
+
+
+def frequency_sweep(waveform: str, start: int, stop: int, step: int):
+    """生成扫频序列，返回 [(频率, 指令帧), ...]，任一步无效时整体抛出 ValueError"""
+    encode_waveform(waveform, start)
+    encode_waveform(waveform, stop)
+    return [(f, encode_waveform(waveform, f)) for f in _sequence_steps(start, stop, step, 1)]
+
+
+# --- 串流档位表 ---
+# key: 档位标识；device: 所属设备；device_type: 对外的设备类型；name: 完整名称；
+# mode_name: 档位名称；device_name: 设备名称；ui_key: 前端万用表按钮键名(示波器为None)；
+# open_frame: 打开指令；close_frame: 关闭指令
+StreamMode = namedtuple('StreamMode', [
+    'key', 'device', 'device_type', 'name', 'mode_name', 'device_name', 'ui_key', 'open_frame', 'close_frame'
+])
+
+STREAM_MODES = {
+    "oscilloscope": StreamMode("oscilloscope", "oscilloscope", "oscilloscope", "示波器", "示波器", "示波器",
+                               None, encode(OP_OSCILLOSCOPE, 1), CMD_CLOSE_OSCILLOSCOPE),
+    "resistance": StreamMode("resistance", "multimeter", "multimeter_resistance", "万用表-电阻档", "电阻档", "万用表",
+                             "resistance", encode(OP_RESISTANCE, 1), CMD_CLOSE_MULTIMETER),
+    "continuity": StreamMode("continuity", "multimeter", "multimeter_continuity", "万用表-通断档", "通断档", "万用表",
+                             "continuity", encode(OP_CONTINUITY, 2), CMD_CLOSE_MULTIMETER),
+    "dc_voltage": StreamMode("dc_voltage", "multimeter", "multimeter_dc_voltage", "万用表-直流电压档", "直流电压档", "万用表",
+                             "dc_voltage", encode(OP_DC_VOLTAGE, 3), CMD_CLOSE_MULTIMETER),
+    "ac_voltage": StreamMode("ac_voltage", "multimeter", "multimeter_ac_voltage", "万用表-交流电压档", "交流电压档", "万用表",
+                             "ac_voltage", encode(OP_AC_VOLTAGE, 4), CMD_CLOSE_MULTIMETER),
+    "dc_current": StreamMode("dc_current", "multimeter", "multimeter_dc_current", "万用表-直流电流档", "直流电流档", "万用表",
+                             "dc_current", encode(OP_DC_CURRENT, 5), CMD_CLOSE_MULTIMETER),
+}
+
+# 万用表各档位在前端的按钮键名，按显示顺序排列
+MULTIMETER_UI_KEYS = tuple(m.ui_key for m in STREAM_MODES.values() if m.ui_key)
+
+# 操作码 -> 串流档位，按操作码直接索引，O(1) 查找
+MODE_BY_OPCODE = [None] * 256
+for _mode in STREAM_MODES.values():
+    MODE_BY_OPCODE[_mode.open_frame[0]] = _mode
+del _mode
+
+
+# 指令操作码 -> 设备应答帧的操作码，未列出的指令以相同操作码应答
+REPLY_OPCODES = {OP_SIGNAL_GENERATOR: OP_SIGNAL_GENERATOR_REPORT}
+
+
+def reply_opcode(command: bytes) -> int:
+    """指令对应的设备应答帧操作码，用于把应答关联回指令"""
+    return REPLY_OPCODES.get(command[0], command[0])
+
+
+def mode_for_frame(frame: bytes):
+    """根据帧的操作码查找对应的串流档位，找不到返回None"""
+    if not frame:
+        return None
+    return MODE_BY_OPCODE[frame[0]]
+
+
+# --- 测量数据通道表 ---
+# 操作码 -> 测量通道列表 (通道名, 取值方式, 缩放系数)
+# 取值方式: word = 高低字节组成的16位值, hi = 高字节, lo = 低字节
+MEASUREMENT_CHANNELS = {
+    OP_RESISTANCE: (("multimeter_resistance", "word", 1),),
+    OP_CONTINUITY: (("multimeter_continuity", "word", 1),),
+    OP_DC_VOLTAGE: (("multimeter_dc_voltage", "word", 0.01),),
+    OP_AC_VOLTAGE: (("multimeter_ac_voltage", "word", 0.01),),
+    OP_DC_CURRENT: (("multimeter_dc_current", "word", 0.01),),
+    OP_OSCILLOSCOPE: (("oscilloscope", "word", 0.01),),
+    OP_POWER_SUPPLY: (("power_supply", "word", 0.01),),
+    OP_TEMPERATURE: (("temperature", "hi", 1), ("humidity", "lo", 1)),
+    OP_DISTANCE: (("distance", "word", 0.1),),
+    OP_LIGHT: (("light", "word", 1),),
+}
+
+# 通道名 -> (操作码, 取值方式, 缩放系数)
+CHANNEL_INDEX = {
+    name: (opcode, kind, scale)
+    for opcode, channels in MEASUREMENT_CHANNELS.items()
+    for name, kind, scale in channels
+}
+
+
+def decode_measurements(frame: bytes):
+    """把单帧解析为 [(通道名, 数值), ...]，非测量帧返回空列表"""
+    if not is_valid_frame(frame):
+        return []
+    result = []
+    for name, kind, scale in MEASUREMENT_CHANNELS.get(frame[0], ()):
+        if kind == "hi":
+            raw = frame[1]
+        elif kind == "lo":
+            raw = frame[2]
+        else:
+            raw = frame_value(frame)
+        result.append((name, raw * scale))
+    return result
@@ -0,0 +1,103 @@
+"""
+设备状态执行器(actor)
+每台设备一个后台任务，独占该设备状态的所有修改。接口把"检查状态-发送指令-更新状态"整段作为一个操作投递到收件箱，
+由执行器逐个执行，UI 和 MCP 智能体的并发请求不会在 await 之间交错，也就不会重复发送关闭/打开指令或保存过期的状态。
+- 一个操作执行期间到达的其他操作排在收件箱里，执行器把已经排队的操作作为一批依次执行，
+  整批只保存和广播一次状态，之后再统一返回各请求的结果
+- 读取方不经过执行器: 每批提交后生成一份新的状态快照(深拷贝，发布后不再修改，只整体替换)，
+  读快照不需要加锁也不会读到修改了一半的状态
+- 没有全局锁，不同设备的执行器互不影响
+- 每个操作在投递它的请求的上下文(contextvars，例如指令追踪用的 request_context)中执行，
+  而不是在第一次启动执行器的那个请求的上下文中
+- 操作被取消或执行器本身退出时，已经取出的操作都会得到结果(异常)，调用方不会一直等待
+"""
+import asyncio
+import contextvars
+import json
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 单批最多合并的操作数
+STATE_BATCH_MAX = 64
+
+
+class StateActor:
+    """
+    串行执行某台设备的状态修改。
+    commit() 在一批操作中至少有一个需要保存时调用一次，返回新的状态数据(dict)，作为读取方的快照；
+    快照只会被整体替换，读取方不要修改它。
+    """
+
+    def __init__(self, device_id: str, commit):
+        self.device_id = device_id
+        self.commit = commit
+        self.inbox = asyncio.Queue()
+        self.snapshot = {}
+        self._task = None
+
+    def publish(self, state_data: dict):
+        """更新读取方看到的快照。深拷贝: led_states 等字段是设备状态对象上会被原地修改的字典"""
+        self.snapshot = json.loads(json.dumps(state_data))
+
+    async def call(self, operation, *args, save: bool = True):
+        """
+        投递一个操作并等待其结果。operation 是不带锁的 async 函数，可以在其中 await 发送指令；
+        save=False 用于只发送指令、不修改状态的操作。
+        """
+        if self._task is None or self._task.done():
+            # 执行器本身不继承任何请求的上下文
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+        future = asyncio.get_running_loop().create_future()
+        self.inbox.put_nowait((operation, args, save, contextvars.copy_context(), future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self.inbox.get()]
+            while len(batch) < STATE_BATCH_MAX and not self.inbox.empty():
+                batch.append(self.inbox.get_nowait())
+            metrics.STATE_ACTOR_BATCH_SIZE.observe(len(batch))
+            try:
+                await self._run_batch(batch)
+            finally:
+                # 执行器被取消(服务关闭)或出现意外异常时，本批还没有结果的操作也要返回，调用方不会一直等待
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError(f"设备 {self.device_id} 的状态执行器已停止"))
+
+    async def _run_batch(self, batch: list):
+        outcomes = []
+        dirty = False
+        for operation, args, save, context, future in batch:
+            # 请求已经断开的操作不再执行
+            if future.cancelled():
+                continue
+            try:
+                result, error = await asyncio.create_task(operation(*args), context=context), None
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # 操作自身被取消，执行器继续执行后面的操作
+                result, error = None, RuntimeError("操作被取消")
+            except Exception as e:
+                result, error = None, e
+            # 操作只在指令发送成功后修改状态，失败前已经生效的部分(例如多个LED中已发送的几个)同样要保存
+            dirty = dirty or save
+            outcomes.append((future, result, error))
+
+        if dirty:
+            try:
+                self.publish(await self.commit())
+            except Exception as e:
+                logger.error(f"[{self.device_id}] 提交设备状态失败: {e}")
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -0,0 +1,90 @@
+"""
+多实例状态同步
+ytj_web_service 可以运行多个 uvicorn worker 或多个副本，设备状态通过 RabbitMQ 在实例之间共享:
+- 每次状态变化，实例把该设备的完整状态快照发布到 topic 交换机 ytj_state_exchange，路由键 state.<设备ID>
+- 每个实例有一个独占、自动删除的队列绑定 state.#，收到其他实例的快照后更新本地状态并广播给自己的 WebSocket 客户端
+- 每台设备还有一个持久的快照队列(x-max-length=1)，始终只保留最新一份状态，新启动的实例从这里读取当前状态
+
+快照带有 updated_at 时间戳，按"最后写入者获胜"合并，较旧的快照会被忽略。
+"""
+import json
+import logging
+import uuid
+
+import aio_pika
+
+logger = logging.getLogger(__name__)
+
+STATE_EXCHANGE = 'ytj_state_exchange'
+STATE_SNAPSHOT_QUEUE = 'ytj_state_snapshot'
+
+# 本实例的唯一标识，用于忽略自己发布的快照
+INSTANCE_ID = uuid.uuid4().hex[:12]
+
+
+def state_routing_key(device_id: str) -> str:
+    return f"state.{device_id}"
+
+
+class StateSync:
+    """通过 RabbitMQ 在多个实例之间同步设备状态"""
+
+    def __init__(self, device_ids):
+        self.device_ids = list(device_ids)
+        self.exchange = None
+        self.snapshot_queues = {}
+        self.instance_queue = None
+
+    async def setup(self, channel: aio_pika.Channel):
+        self.exchange = await channel.declare_exchange(STATE_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+        for device_id in self.device_ids:
+            queue = await channel.declare_queue(
+                f"{STATE_SNAPSHOT_QUEUE}.{device_id}", durable=True,
+                arguments={'x-max-length': 1, 'x-overflow': 'drop-head'}
+            )
+            await queue.bind(self.exchange, routing_key=state_routing_key(device_id))
+            self.snapshot_queues[device_id] = queue
+        self.instance_queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+        await self.instance_queue.bind(self.exchange, routing_key="state.#")
+        logger.info(f"状态同步已就绪，实例ID: {INSTANCE_ID}")
+
+    async def load_snapshot(self, device_id: str):
+        """读取设备的最新状态快照，读完放回队列，供其他实例继续读取"""
+        queue = self.snapshot_queues.get(device_id)
+        if queue is None:
+            return None
+        message = await queue.get(no_ack=False, fail=False)
+        if message is None:
+            return None
+        try:
+            return json.loads(message.body)
+        except ValueError as e:
+            logger.warning(f"无法解析设备 {device_id} 的状态快照: {e}")
+            return None
+        finally:
+            await message.reject(requeue=True)
+
+    async def publish(self, state_data: dict):
+        if self.exchange is None:
+            return
+        message = aio_pika.Message(
+            body=json.dumps(state_data, ensure_ascii=False).encode('utf-8'),
+            content_type='application/json',
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            headers={"origin": INSTANCE_ID},
+        )
+        await self.exchange.publish(message, routing_key=state_routing_key(state_data["device_id"]))
+
+    async def consume(self, on_state):
+        """消费其他实例发布的状态快照，on_state(state_data) 为协程"""
+        async def on_message(message: aio_pika.IncomingMessage):
+            if message.headers and message.headers.get("origin") == INSTANCE_ID:
+                return
+            try:
+                state_data = json.loads(message.body)
+            except ValueError as e:
+                logger.warning(f"无法解析状态快照: {e}")
+                return
+            await on_state(state_data)
+
+        await self.instance_queue.consume(on_message, no_ack=True)
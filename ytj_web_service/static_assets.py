@@ -0,0 +1,266 @@
+"""
+前端静态资源服务
+代替 StaticFiles 提供 app/ 下的前端页面，让实验室平板在弱网下也能快速打开:
+- 文件在第一次被请求时读入内存，同时生成 gzip/brotli 压缩版本，之后直接从内存返回;
+  磁盘上的文件修改后(mtime 或大小变化)自动重新加载
+- 磁盘上已有 .br/.gz 预压缩文件时直接使用，不再现场压缩；超过 STATIC_CACHE_FILE_MAX_BYTES 的大文件不进缓存，
+  也不现场压缩(否则每次请求都要重新压缩)，只使用预压缩文件
+- 文件名带内容哈希的资源(如 main.df71e8ad.js)内容不会变，返回一年的 immutable 缓存头;
+  index.html 等其他文件每次用 ETag 验证
+- 支持 If-None-Match(304)、HEAD 和单段 Range 请求(206)
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # 未安装 brotli 时只提供 gzip
+    brotli = None
+
+# 内存中缓存的静态文件总大小上限(含压缩版本)，超出后淘汰最久未访问的文件
+STATIC_CACHE_MAX_BYTES = int(os.getenv('STATIC_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# 超过该大小的文件每次从磁盘读取，不进内存缓存
+STATIC_CACHE_FILE_MAX_BYTES = int(os.getenv('STATIC_CACHE_FILE_MAX_BYTES', 8 * 1024 * 1024))
+# 小于该大小的文件不压缩
+MIN_COMPRESS_BYTES = 1024
+
+# 构建工具生成的带哈希文件名，例如 main.df71e8ad.js、453.0a36081d.chunk.js
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/javascript', 'application/json', 'application/manifest+json',
+    'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon', 'font/ttf',
+)
+
+# 编码名 -> 预压缩文件后缀，按优先级排列
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+mimetypes.add_type('font/woff2', '.woff2')
+mimetypes.add_type('font/woff', '.woff')
+mimetypes.add_type('font/ttf', '.ttf')
+
+
+def compress(encoding: str, data: bytes) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+class StaticAsset:
+    """一个静态文件在内存中的内容、压缩版本和响应头"""
+
+    def __init__(self, path: str, name: str, stat: os.stat_result, compress_missing: bool = True):
+        self.path = path
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.media_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+        self.cache_control = IMMUTABLE_CACHE if HASHED_NAME.search(os.path.basename(name)) else REVALIDATE_CACHE
+        self.variants = {}  # 编码名 -> 压缩后的内容
+        if self.size >= MIN_COMPRESS_BYTES and self.media_type.startswith(COMPRESSIBLE_TYPES):
+            for encoding, suffix in ENCODINGS:
+                data = self._load_variant(encoding, suffix, compress_missing)
+                # 压缩收益太小的版本不值得多一次解压
+                if data is not None and len(data) < self.size * 0.9:
+                    self.variants[encoding] = data
+
+    def _load_variant(self, encoding: str, suffix: str, compress_missing: bool):
+        precompressed = self.path + suffix
+        try:
+            if os.stat(precompressed).st_mtime >= self.mtime:
+                with open(precompressed, 'rb') as f:
+                    return f.read()
+        except FileNotFoundError:
+            pass
+        if not compress_missing or (encoding == "br" and brotli is None):
+            return None
+        return compress(encoding, self.body)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.body) + sum(len(data) for data in self.variants.values())
+
+    def is_stale(self, stat: os.stat_result) -> bool:
+        return stat.st_mtime != self.mtime or stat.st_size != self.size
+
+
+def accepted_encodings(header: str) -> set:
+    """解析 Accept-Encoding，忽略 q=0 的编码"""
+    accepted = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if name and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.lower())
+    return accepted
+
+
+def parse_range(header: str, size: int):
+    """解析单段 Range 头，返回 (起始, 结束)(含结束字节)；格式不支持时返回 None，范围无效时抛出 ValueError"""
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class StaticAssets:
+    """挂载在 /app 下的静态文件 ASGI 应用，也可以通过 response() 直接返回某个文件"""
+
+    def __init__(self, directory: str, max_bytes: int = STATIC_CACHE_MAX_BYTES):
+        self.directory = os.path.realpath(directory)
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()  # 相对路径 -> StaticAsset
+        self.cached_bytes = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        request = Request(scope, receive)
+        if request.method not in ("GET", "HEAD"):
+            response = Response(status_code=405, headers={"Allow": "GET, HEAD"})
+        else:
+            response = await self.response(request, scope["path"][len(scope.get("root_path", "")):])
+        await response(scope, receive, send)
+
+    def resolve(self, name: str):
+        """把URL路径映射为目录内的文件，越出目录或不存在时返回 None"""
+        path = os.path.realpath(os.path.join(self.directory, name.lstrip('/')))
+        if os.path.commonpath([path, self.directory]) != self.directory:
+            return None
+        return path
+
+    async def load(self, name: str):
+        path = self.resolve(name)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if not os.path.isfile(path):
+            return None
+        key = os.path.relpath(path, self.directory)
+        asset = self.cache.get(key)
+        if asset is not None and not asset.is_stale(stat):
+            self.cache.move_to_end(key)
+            return asset
+        if asset is not None:
+            self._evict(key)
+        # 读取和压缩放到线程池，main.js 这种大文件压缩需要几十毫秒
+        cacheable = stat.st_size <= STATIC_CACHE_FILE_MAX_BYTES
+        asset = await run_in_threadpool(StaticAsset, path, key, stat, cacheable)
+        if cacheable:
+            if key in self.cache:  # 并发的首次请求已经加载过
+                self._evict(key)
+            self.cache[key] = asset
+            self.cached_bytes += asset.nbytes
+            while self.cached_bytes > self.max_bytes and len(self.cache) > 1:
+                self._evict(next(iter(self.cache)))
+        return asset
+
+    def _evict(self, key: str):
+        asset = self.cache.pop(key)
+        self.cached_bytes -= asset.nbytes
+
+    async def response(self, request: Request, name: str) -> Response:
+        asset = await self.load(name)
+        if asset is None:
+            return Response("Not Found", status_code=404, media_type="text/plain")
+
+        headers = {
+            "Cache-Control": asset.cache_control,
+            "Accept-Ranges": "bytes",
+        }
+        if asset.variants:
+            headers["Vary"] = "Accept-Encoding"
+
+        # Range 请求只针对未压缩的原始内容
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range == asset.etag):
+            try:
+                byte_range = parse_range(range_header, asset.size)
+            except ValueError:
+                headers["Content-Range"] = f"bytes */{asset.size}"
+                return Response(status_code=416, headers=headers)
+            if byte_range is not None:
+                start, end = byte_range
+                headers["ETag"] = asset.etag
+                headers["Content-Range"] = f"bytes {start}-{end}/{asset.size}"
+                body = asset.body[start:end + 1]
+                return self._send(request, body, 206, headers, asset.media_type)
+
+        encoding = None
+        if asset.variants:
+            accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+            encoding = next((name for name, _ in ENCODINGS if name in asset.variants and name in accepted), None)
+        # 不同编码的表示各有自己的 ETag
+        etag = asset.etag if encoding is None else asset.etag[:-1] + f'-{encoding}"'
+        headers["ETag"] = etag
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or
+                              etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))):
+            return Response(status_code=304, headers=headers)
+
+        if encoding is None:
+            return self._send(request, asset.body, 200, headers, asset.media_type)
+        headers["Content-Encoding"] = encoding
+        return self._send(request, asset.variants[encoding], 200, headers, asset.media_type)
+
+    @staticmethod
+    def _send(request: Request, body: bytes, status_code: int, headers: dict, media_type: str) -> Response:
+        response = Response(body, status_code=status_code, headers=headers, media_type=media_type)
+        if request.method == "HEAD":
+            response.body = b""
+        return response
+
+
+def precompress(directory: str):
+    """为目录下可压缩的文件生成 .gz/.br 预压缩文件，在构建镜像时运行"""
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if file_name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                continue
+            path = os.path.join(root, file_name)
+            media_type = mimetypes.guess_type(file_name)[0] or ''
+            if os.path.getsize(path) < MIN_COMPRESS_BYTES or not media_type.startswith(COMPRESSIBLE_TYPES):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding, suffix in ENCODINGS:
+                if encoding == "br" and brotli is None:
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(compress(encoding, data))
+
+
+if __name__ == "__main__":
+    import sys
+    precompress(sys.argv[1] if len(sys.argv) > 1 else "app")
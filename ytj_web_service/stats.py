@@ -0,0 +1,141 @@
+"""
+测量数据实时统计
+历史采集任务每解码一批数据就增量更新各通道最近 STATS_WINDOW 个采样的统计，
+/api/measurement/summary 和 MCP 读取工具直接取结果，不需要读采集文件。
+- 均值、方差、RMS 由窗口内的和与平方和得到，每个采样的更新是 O(1)；
+  每滑过一个窗口的采样重新求和一次，消除浮点累加误差
+- 频率用带迟滞的过零检测(以窗口均值为中心)增量估计: 记录上穿的采样序号，
+  按平均采样率换算，不受帧到达时间抖动的影响
+- 通道停止上报超过 STATS_RESET_GAP 秒(关闭档位、切换档位)后重新统计，不混入上一次测量
+"""
+import os
+from collections import deque
+
+import numpy as np
+
+from triggers import HOLD, rising_edges, schmitt_states
+
+# 每个通道参与统计的最近采样数
+STATS_WINDOW = int(os.getenv('STATS_WINDOW', 1024))
+# 通道停止上报超过该时长(秒)后重新开始统计
+STATS_RESET_GAP = float(os.getenv('STATS_RESET_GAP', 2))
+# 过零检测的迟滞量，取窗口标准差的比例，抑制噪声引起的抖动
+STATS_HYSTERESIS = 0.1
+# 保留的上穿位置数量
+MAX_CROSSINGS = 256
+
+
+class RunningStats:
+    """单个通道的滑动窗口统计"""
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.values = np.zeros(self.window)
+        self.ts = np.zeros(self.window)
+        self.total = 0        # 累计采样数，也是下一个采样的序号
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.since_resum = 0
+        self.state = HOLD
+        self.crossings = deque(maxlen=MAX_CROSSINGS)  # 上穿均值的采样序号
+
+    @property
+    def count(self) -> int:
+        return min(self.total, self.window)
+
+    def update(self, ts: np.ndarray, values: np.ndarray):
+        if not len(values):
+            return
+        if self.total and ts[0] - self.ts[(self.total - 1) % self.window] > STATS_RESET_GAP:
+            self.reset()
+        self._detect_crossings(values)
+        if len(values) > self.window:
+            self.total += len(values) - self.window
+            ts = ts[-self.window:]
+            values = values[-self.window:]
+        # 环形缓冲初始为0，被覆盖的空位对和与平方和没有影响
+        index = (self.total + np.arange(len(values))) % self.window
+        evicted = self.values[index]
+        self.sum += float(values.sum() - evicted.sum())
+        self.sumsq += float(np.dot(values, values) - np.dot(evicted, evicted))
+        self.values[index] = values
+        self.ts[index] = ts
+        self.total += len(values)
+        self.since_resum += len(values)
+        if self.since_resum >= self.window:
+            valid = self.values[:self.count]
+            self.sum = float(valid.sum())
+            self.sumsq = float(np.dot(valid, valid))
+            self.since_resum = 0
+
+    def _detect_crossings(self, values: np.ndarray):
+        if self.total:
+            mean = self.sum / self.count
+            std = np.sqrt(max(self.sumsq / self.count - mean * mean, 0.0))
+        else:
+            mean = float(values.mean())
+            std = float(values.std())
+        band = STATS_HYSTERESIS * std
+        if band == 0:
+            # 恒定信号没有过零
+            self.state = HOLD
+            return
+        states = schmitt_states(values > mean + band, values < mean - band, self.state)
+        edges = rising_edges(states, self.state)
+        self.crossings.extend((edges + self.total).tolist())
+        self.state = int(states[-1])
+
+    def summary(self) -> dict:
+        count = self.count
+        if not count:
+            return None
+        order = (self.total - count + np.arange(count)) % self.window
+        ts = self.ts[order]
+        values = self.values[order]
+        mean = self.sum / count
+        variance = max(self.sumsq / count - mean * mean, 0.0)
+        span = float(ts[-1] - ts[0])
+        sample_rate = (count - 1) / span if span > 0 else None
+        result = {
+            "t": float(ts[-1]),
+            "latest": float(values[-1]),
+            "count": count,
+            "span": span,
+            "sample_rate": sample_rate,
+            "mean": mean,
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "std": float(np.sqrt(variance)),
+            "rms": float(np.sqrt(max(self.sumsq / count, 0.0))),
+            "frequency": None,
+        }
+        # 只使用窗口内的上穿位置，至少需要一个完整周期
+        first = self.total - count
+        crossings = [index for index in self.crossings if index >= first]
+        if sample_rate and len(crossings) >= 2:
+            cycles = len(crossings) - 1
+            result["frequency"] = cycles * sample_rate / (crossings[-1] - crossings[0])
+        return result
+
+
+class MeasurementStats:
+    """一台设备所有测量通道的实时统计"""
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self.window = window
+        self.channels = {}  # 通道名 -> RunningStats
+
+    def update(self, decoded: dict):
+        """更新一批解码后的测量数据 {通道名: (时间戳, 数值)}"""
+        for name, (ts, values) in decoded.items():
+            stats = self.channels.get(name)
+            if stats is None:
+                stats = self.channels[name] = RunningStats(self.window)
+            stats.update(ts, values)
+
+    def summary(self, name: str):
+        stats = self.channels.get(name)
+        return stats.summary() if stats is not None else None
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服务模块按脚本目录平铺导入(from protocol import ...)，测试时同样把服务目录放到导入路径最前面
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,88 @@
+import pytest
+
+import admission
+from admission import AdmissionControl, CommandRejected, TokenBucket
+
+
+class Clock:
+    def __init__(self, now: float = 100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=2, capacity=2, now=0)
+    for _ in range(2):
+        assert bucket.wait_time(0) == 0
+        bucket.take()
+    assert bucket.wait_time(0) == pytest.approx(0.5)
+    assert bucket.wait_time(0.5) == 0
+    # 长时间空闲后最多攒到 capacity 个令牌
+    bucket.take()
+    bucket.wait_time(100)
+    assert bucket.tokens == 2
+
+
+def test_rate_limit_is_per_client(clock):
+    control = AdmissionControl(rate=1, burst=2, max_backlog=10)
+    control.admit("agent", "default")
+    control.admit("agent", "default")
+    with pytest.raises(CommandRejected) as rejected:
+        control.admit("agent", "default")
+    assert rejected.value.retry_after == pytest.approx(1)
+    assert rejected.value.retry_after_header == "1"
+    control.admit("browser", "default")
+    clock.now += 1
+    control.admit("agent", "default")
+
+
+def test_backlog_follows_command_pacing_and_dwell(clock):
+    control = AdmissionControl(max_backlog=1, interval=0.05, link_rate=200)
+    assert control.command_seconds() == pytest.approx(0.055)
+    assert control.command_seconds(dwell_ms=500) == pytest.approx(0.505)
+
+    control.record("default", 10)
+    control.record("default", 2, dwell_ms=500)
+    assert control.backlog("default") == pytest.approx(10 * 0.055 + 2 * 0.505)
+    clock.now += 0.5
+    assert control.backlog("default") == pytest.approx(10 * 0.055 + 2 * 0.505 - 0.5)
+    assert control.backlog("ytj2") == 0
+
+
+def test_backlog_rejects_new_commands(clock):
+    control = AdmissionControl(max_backlog=1, interval=0.1, link_rate=1e9)
+    control.record("default", 15)
+    with pytest.raises(CommandRejected) as rejected:
+        control.admit("agent", "default")
+    assert rejected.value.retry_after == pytest.approx(0.5)
+    # 其他设备不受影响
+    control.admit("agent", "ytj2")
+    clock.now += 0.6
+    control.admit("agent", "default")
+
+
+def test_observed_queue_depth_drains_over_time(clock):
+    control = AdmissionControl(interval=0.1, link_rate=1e9)
+    control.observe_queue_depth("default", 30)
+    assert control.backlog("default") == pytest.approx(3)
+    clock.now += 2
+    assert control.backlog("default") == pytest.approx(1)
+    clock.now += 5
+    assert control.backlog("default") == 0
+
+
+def test_tracked_clients_are_bounded(clock, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_TRACKED_CLIENTS", 3)
+    control = AdmissionControl()
+    for client in "abcd":
+        control.admit(client, "default")
+    assert list(control.buckets) == ["b", "c", "d"]
@@ -0,0 +1,36 @@
+import numpy as np
+
+from frames import CAPTURE_DTYPE, IS_MEASUREMENT, capture_view, channel_values, frame_view, valid_mask
+from protocol import FRAME_END, MEASUREMENT_CHANNELS
+
+
+def test_frame_view_is_zero_copy_and_ignores_trailing_bytes():
+    buf = bytes([0x04, 0x01, 0x2C, FRAME_END, 0x0B, 25, 60, 0x00, 0x0B])
+    frames = frame_view(buf)
+    assert len(frames) == 2
+    assert frames['opcode'].tolist() == [0x04, 0x0B]
+    assert frames['value'].tolist() == [300, (25 << 8) | 60]
+    assert valid_mask(frames).tolist() == [True, False]
+    assert not frames.flags.owndata
+
+
+def test_channel_values_by_kind():
+    frames = frame_view(bytes([0x0B, 25, 60, FRAME_END]))
+    assert channel_values(frames, "hi", 1).tolist() == [25]
+    assert channel_values(frames, "lo", 1).tolist() == [60]
+    assert channel_values(frames, "word", 0.5).tolist() == [((25 << 8) | 60) * 0.5]
+
+
+def test_capture_view_round_trip():
+    records = np.zeros(3, dtype=CAPTURE_DTYPE)
+    records['ts'] = [1.5, 2.5, 3.5]
+    records['opcode'] = 0x04
+    records['value'] = [1, 2, 0xFFFF]
+    records['end'] = FRAME_END
+    view = capture_view(records.tobytes() + b'\x00' * 5)
+    assert view['ts'].tolist() == [1.5, 2.5, 3.5]
+    assert view['value'].tolist() == [1, 2, 0xFFFF]
+
+
+def test_measurement_lookup_table():
+    assert np.flatnonzero(IS_MEASUREMENT).tolist() == sorted(MEASUREMENT_CHANNELS)
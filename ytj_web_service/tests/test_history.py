@@ -0,0 +1,151 @@
+import time
+
+import numpy as np
+import pytest
+
+from history import HistoryStore, claim_capture_root
+from protocol import FRAME_END, OP_DC_VOLTAGE
+
+T0 = 1_700_000_000.0
+
+
+def frames(opcode: int, values) -> bytes:
+    return b''.join(bytes([opcode, value >> 8, value & 0xFF, FRAME_END]) for value in values)
+
+
+@pytest.fixture
+def locks():
+    opened = []
+    yield opened
+    for lock in opened:
+        lock.close()
+
+
+def claim(root, locks):
+    path, lock = claim_capture_root(str(root))
+    locks.append(lock)
+    return path
+
+
+def test_claim_capture_root_gives_each_instance_its_own_directory(tmp_path, locks):
+    first = claim(tmp_path, locks)
+    second = claim(tmp_path, locks)
+    assert first == str(tmp_path)
+    assert second == str(tmp_path / "instance-1")
+
+    # 释放后重启的实例重新占用同一个序号和目录
+    locks.pop(0).close()
+    assert claim(tmp_path, locks) == first
+
+
+def test_two_stores_over_one_stream_write_each_record_once(tmp_path, locks):
+    # 同一主机上的两个 worker 各自消费完整的数据流
+    stores = [HistoryStore(claim(tmp_path, locks), levels={1: 100}) for _ in range(2)]
+    values = list(range(100))
+    buf = frames(OP_DC_VOLTAGE, values)
+    ts = T0 + np.arange(len(values)) * 0.01
+    for store in stores:
+        store.ingest_batch(buf[:200], ts[:50])
+    for store in stores:
+        store.ingest_batch(buf[200:], ts[50:])
+        store.flush()
+
+    for store in stores:
+        range_ = store.open_range("multimeter_dc_voltage", T0, T0 + 10)
+        assert range_.count == len(values)
+        out_ts, out_values = map(np.concatenate, zip(*range_.chunks()))
+        assert np.all(np.diff(out_ts) > 0)
+        np.testing.assert_allclose(out_values, np.array(values) * 0.01)
+
+        store.close()
+        store.rebuild()
+        assert sum(point["count"] for point in store.query("multimeter_dc_voltage", T0, T0 + 10, 1)) == len(values)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path), levels={1: 100, 10: 100})
+    yield store
+    store.close()
+
+
+def test_ingest_batch_decodes_valid_measurement_frames(store):
+    buf = frames(OP_DC_VOLTAGE, [100, 200]) + bytes([0x04, 0, 1, 0x00]) + bytes([0x10, 0, 1, FRAME_END])
+    buf += bytes([0x0B, 25, 60, FRAME_END])
+    decoded = store.ingest_batch(buf, [T0, T0 + 0.5, T0 + 0.6, T0 + 0.7, T0 + 1.2])
+
+    # 结束字节错误的帧和非测量帧(LED)被丢弃
+    ts, values = decoded["multimeter_dc_voltage"]
+    np.testing.assert_allclose(ts, [T0, T0 + 0.5])
+    np.testing.assert_allclose(values, [1.0, 2.0])
+    assert decoded["temperature"][1].tolist() == [25]
+    assert decoded["humidity"][1].tolist() == [60]
+    assert store.channels() == ["humidity", "multimeter_dc_voltage", "temperature"]
+
+    [point] = store.query("multimeter_dc_voltage", T0, T0 + 1, 1)
+    assert point == {"t": int(T0), "min": 1.0, "max": 2.0, "mean": 1.5, "count": 2}
+
+
+def test_ingest_batch_keeps_capture_timestamps_monotonic(store):
+    store.ingest_batch(frames(OP_DC_VOLTAGE, [1, 2]), [T0 + 1, T0 + 2])
+    # 时钟回拨: 早于上一条记录的时间戳按上一条记录的时间写入
+    decoded = store.ingest_batch(frames(OP_DC_VOLTAGE, [3, 4]), [T0 + 1.5, T0 + 3])
+    assert decoded["multimeter_dc_voltage"][0].tolist() == [T0 + 2, T0 + 3]
+    store.flush()
+    range_ = store.open_range("multimeter_dc_voltage", T0, T0 + 10)
+    assert np.all(np.diff(np.concatenate([ts for ts, _ in range_.chunks()])) >= 0)
+
+
+def test_rollups_merge_batches_into_buckets(store):
+    for i in range(3):
+        store.ingest_batch(frames(OP_DC_VOLTAGE, [i * 100]), [T0 + i * 4])
+    assert [p["count"] for p in store.query("multimeter_dc_voltage", T0, T0 + 20, 1)] == [1, 1, 1]
+    [point] = store.query("multimeter_dc_voltage", T0, T0 + 9, 10)
+    assert point["count"] == 3 and point["min"] == 0 and point["max"] == 2.0
+
+
+def test_rebuild_reads_rotated_and_current_files(tmp_path, monkeypatch):
+    monkeypatch.setattr("history.CAPTURE_MAX_BYTES", 12 * 10)
+    store = HistoryStore(str(tmp_path), levels={1: 100})
+    for i in range(25):
+        store.ingest_batch(frames(OP_DC_VOLTAGE, [i]), [T0 + i])
+    store.close()
+    assert store.capture_path(OP_DC_VOLTAGE) + ".1" in [str(p) for p in tmp_path.iterdir()]
+
+    restarted = HistoryStore(str(tmp_path), levels={1: 100})
+    restarted.rebuild(chunk_records=4)
+    points = restarted.query("multimeter_dc_voltage", T0, T0 + 100, 1)
+    # 只保留一个轮转文件，最早的一段已被覆盖
+    assert [p["t"] for p in points] == [int(T0) + i for i in range(10, 25)]
+    # 重启后的写入仍然接在已有记录之后
+    decoded = restarted.ingest_batch(frames(OP_DC_VOLTAGE, [99]), [T0])
+    assert decoded["multimeter_dc_voltage"][0].tolist() == [T0 + 24]
+    restarted.close()
+
+
+def test_open_range_selects_records_in_time_window(store):
+    store.ingest_batch(frames(OP_DC_VOLTAGE, list(range(10))), T0 + np.arange(10))
+    store.flush()
+    range_ = store.open_range("multimeter_dc_voltage", T0 + 2, T0 + 5)
+    assert range_.count == 4
+    ts, values = map(np.concatenate, zip(*range_.chunks(chunk_records=3)))
+    assert ts.tolist() == [T0 + i for i in range(2, 6)]
+    np.testing.assert_allclose(values, [0.02, 0.03, 0.04, 0.05])
+    assert store.open_range("multimeter_dc_voltage", T0 + 20, T0 + 30).count == 0
+    assert store.open_range("unknown", T0, T0 + 10).count == 0
+
+
+def test_read_recent_returns_only_the_requested_window(store):
+    now = time.time()
+    store.ingest_batch(frames(OP_DC_VOLTAGE, [1, 2, 3]), [now - 60, now - 2, now - 1])
+    ts, values = store.read_recent("multimeter_dc_voltage", 5)
+    assert ts.tolist() == [now - 2, now - 1]
+    np.testing.assert_allclose(values, [0.02, 0.03])
+    assert len(store.read_recent("light", 5)[0]) == 0
+
+
+def test_pick_resolution_prefers_the_finest_covering_level(store):
+    store.ingest_batch(frames(OP_DC_VOLTAGE, [1]), [T0])
+    assert store.pick_resolution("multimeter_dc_voltage", T0, T0 + 60) == 1
+    # 1秒粒度的点数超过 MAX_QUERY_POINTS 时改用更粗的分辨率
+    assert store.pick_resolution("multimeter_dc_voltage", T0, T0 + 5000) == 10
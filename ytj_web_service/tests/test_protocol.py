@@ -0,0 +1,71 @@
+import pytest
+
+from protocol import (FRAME_END, OP_POWER_SUPPLY, OP_SIGNAL_GENERATOR, STREAM_MODES, WAVEFORM_CODES,
+                      decode_measurements, encode, encode_voltage, encode_waveform, frequency_sweep, mode_for_frame,
+                      reply_opcode, voltage_ramp)
+
+
+def test_encode_frame_layout():
+    assert encode(0x09, 0x1234) == bytes([0x09, 0x12, 0x34, FRAME_END])
+
+
+@pytest.mark.parametrize("voltage, value", [
+    # 原有预设电压表的数值保持不变
+    (0.1, 0x0001), (1.0, 0x0064), (10.0, 0x03E8), (10.1, 0x03E9),
+    # 其他电压按0.01V计数
+    (0.0, 0), (0.11, 11), (3.3, 330), (5, 500), (9.99, 999),
+])
+def test_encode_voltage(voltage, value):
+    assert encode_voltage(voltage) == encode(OP_POWER_SUPPLY, value)
+
+
+@pytest.mark.parametrize("voltage", [-0.01, 10.11, 12])
+def test_encode_voltage_out_of_range(voltage):
+    with pytest.raises(ValueError):
+        encode_voltage(voltage)
+
+
+def test_encode_waveform():
+    assert encode_waveform("Square", 200) == bytes([OP_SIGNAL_GENERATOR, WAVEFORM_CODES["square"], 200, FRAME_END])
+    for waveform, frequency in (("noise", 10), ("sine", 0), ("sine", 256)):
+        with pytest.raises(ValueError):
+            encode_waveform(waveform, frequency)
+
+
+def test_voltage_ramp_includes_stop_and_uses_preset_values():
+    ramp = voltage_ramp(0, 0.25, 0.1)
+    assert [round(v, 2) for v, _ in ramp] == [0.0, 0.1, 0.2, 0.25]
+    assert [frame for _, frame in ramp] == [encode_voltage(v) for v in (0, 0.1, 0.2, 0.25)]
+    assert [round(v, 2) for v, _ in voltage_ramp(1.0, 0.8, 0.1)] == [1.0, 0.9, 0.8]
+
+
+def test_voltage_ramp_rejects_invalid_sequences():
+    with pytest.raises(ValueError):
+        voltage_ramp(0, 11, 1)
+    with pytest.raises(ValueError):
+        voltage_ramp(0, 1, 0.001)
+    with pytest.raises(ValueError):
+        voltage_ramp(0, 10, 0.01)  # 超过 MAX_SEQUENCE_STEPS
+
+
+def test_frequency_sweep():
+    sweep = frequency_sweep("sine", 10, 1, 4)
+    assert [f for f, _ in sweep] == [10, 6, 2, 1]
+    assert sweep[0][1] == encode_waveform("sine", 10)
+    with pytest.raises(ValueError):
+        frequency_sweep("sine", 1, 300, 1)
+
+
+def test_mode_lookup_and_reply_opcode():
+    for mode in STREAM_MODES.values():
+        assert mode_for_frame(mode.open_frame) is mode
+    assert mode_for_frame(b"") is None
+    assert reply_opcode(encode_waveform("sine", 1)) == 0x0A
+    assert reply_opcode(encode(OP_POWER_SUPPLY, 1)) == OP_POWER_SUPPLY
+
+
+def test_decode_measurements():
+    assert decode_measurements(bytes([0x04, 0x01, 0x2C, FRAME_END])) == [("multimeter_dc_voltage", 3.0)]
+    assert decode_measurements(bytes([0x0B, 25, 60, FRAME_END])) == [("temperature", 25), ("humidity", 60)]
+    assert decode_measurements(bytes([0x04, 0x01, 0x2C, 0x00])) == []
+    assert decode_measurements(encode(0x10, 1)) == []
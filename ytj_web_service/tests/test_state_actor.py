@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+
+import pytest
+
+from state_actor import StateActor
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class Device:
+    def __init__(self):
+        self.value = 0
+        self.commits = 0
+
+    async def commit(self):
+        self.commits += 1
+        return {"value": self.value}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_queued_operations_commit_once_per_batch():
+    async def main():
+        device = Device()
+        actor = StateActor("default", device.commit)
+
+        async def increment():
+            await asyncio.sleep(0)
+            device.value += 1
+            return device.value
+
+        results = await asyncio.gather(*(actor.call(increment) for _ in range(5)))
+        assert results == [1, 2, 3, 4, 5]
+        assert device.commits < 5
+        assert actor.snapshot == {"value": 5}
+    run(main())
+
+
+def test_failed_operation_still_commits_and_raises():
+    async def main():
+        device = Device()
+        actor = StateActor("default", device.commit)
+
+        async def partial():
+            device.value = 1
+            raise ValueError("publish failed")
+
+        with pytest.raises(ValueError):
+            await actor.call(partial)
+        assert actor.snapshot == {"value": 1}
+        assert await actor.call(asyncio.sleep, 0, save=False) is None
+        assert device.commits == 1
+    run(main())
+
+
+def test_cancelled_operation_does_not_stop_the_actor():
+    async def main():
+        actor = StateActor("default", Device().commit)
+
+        async def cancelled():
+            raise asyncio.CancelledError()
+
+        with pytest.raises(RuntimeError):
+            await actor.call(cancelled)
+        assert await actor.call(asyncio.sleep, 0, "ok") == "ok"
+    run(main())
+
+
+def test_stopping_the_actor_resolves_the_current_batch():
+    async def main():
+        actor = StateActor("default", Device().commit)
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(10)
+
+        calls = [asyncio.create_task(actor.call(slow)) for _ in range(3)]
+        await started.wait()
+        actor._task.cancel()
+        for call in calls:
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(call, 1)
+    run(main())
+
+
+def test_operations_run_in_the_caller_context():
+    async def main():
+        actor = StateActor("default", Device().commit)
+
+        async def read():
+            return request_id.get()
+
+        async def request(rid):
+            request_id.set(rid)
+            return await actor.call(read, save=False)
+
+        assert await asyncio.gather(request("a"), request("b")) == ["a", "b"]
+        assert await actor.call(read, save=False) is None
+    run(main())
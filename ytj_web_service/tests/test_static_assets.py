@@ -0,0 +1,100 @@
+import gzip
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+import static_assets
+from static_assets import StaticAssets, accepted_encodings, parse_range
+
+SCRIPT = b"console.log('ytj');\n" * 200
+
+
+@pytest.fixture
+def app_dir(tmp_path):
+    (tmp_path / "index.html").write_bytes(b"<html>" + b"x" * 2000 + b"</html>")
+    (tmp_path / "main.df71e8ad.js").write_bytes(SCRIPT)
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG" + b"\x00" * 2000)
+    return tmp_path
+
+
+@pytest.fixture
+def client(app_dir):
+    return TestClient(Starlette(routes=[Mount("/app", StaticAssets(str(app_dir)))]))
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    for header in ("bytes=100-", "bytes=5-2", "bytes=-0"):
+        with pytest.raises(ValueError):
+            parse_range(header, 100)
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate, br;q=0") == {"gzip", "deflate"}
+    assert accepted_encodings("") == set()
+
+
+def test_serves_gzip_with_cache_headers(client):
+    response = client.get("/app/main.df71e8ad.js", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == static_assets.IMMUTABLE_CACHE
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content == SCRIPT
+
+    identity = client.get("/app/index.html", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in identity.headers
+    assert identity.headers["cache-control"] == static_assets.REVALIDATE_CACHE
+    # 二进制图片不压缩
+    assert "content-encoding" not in client.get("/app/logo.png").headers
+
+
+def test_etag_revalidation(client):
+    etag = client.get("/app/index.html", headers={"Accept-Encoding": "gzip"}).headers["etag"]
+    assert etag.endswith('-gzip"')
+    response = client.get("/app/index.html", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+    # 不同编码的表示 ETag 不同
+    response = client.get("/app/index.html", headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_range_requests(client):
+    response = client.get("/app/main.df71e8ad.js", headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.content == SCRIPT[:10]
+    assert response.headers["content-range"] == f"bytes 0-9/{len(SCRIPT)}"
+    response = client.get("/app/main.df71e8ad.js", headers={"Range": f"bytes={len(SCRIPT)}-"})
+    assert response.status_code == 416
+
+
+def test_head_not_found_and_traversal(client):
+    response = client.head("/app/index.html")
+    assert response.status_code == 200 and response.content == b""
+    assert client.get("/app/missing.js").status_code == 404
+    assert client.get("/app/%2e%2e/secret.txt").status_code == 404
+    assert client.post("/app/index.html").status_code == 405
+
+
+def test_reloads_modified_files(client, app_dir):
+    assert client.get("/app/index.html").content.startswith(b"<html>")
+    (app_dir / "index.html").write_bytes(b"<p>updated</p>")
+    assert client.get("/app/index.html").content == b"<p>updated</p>"
+
+
+def test_large_files_use_only_precompressed_variants(client, app_dir, monkeypatch):
+    monkeypatch.setattr(static_assets, "STATIC_CACHE_FILE_MAX_BYTES", 1024)
+    monkeypatch.setattr(static_assets, "compress", lambda encoding, data: pytest.fail("大文件不应现场压缩"))
+    response = client.get("/app/main.df71e8ad.js", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+    (app_dir / "main.df71e8ad.js.gz").write_bytes(gzip.compress(SCRIPT))
+    response = client.get("/app/main.df71e8ad.js", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.content == SCRIPT
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from stats import STATS_RESET_GAP, MeasurementStats, RunningStats
+
+
+def test_summary_of_a_partial_window():
+    stats = RunningStats(window=8)
+    assert stats.summary() is None
+    stats.update(np.array([0.0, 1.0, 2.0]), np.array([1.0, 2.0, 3.0]))
+    summary = stats.summary()
+    assert summary["count"] == 3
+    assert summary["latest"] == 3.0
+    assert summary["mean"] == pytest.approx(2.0)
+    assert summary["std"] == pytest.approx(np.std([1, 2, 3]))
+    assert summary["rms"] == pytest.approx(np.sqrt(np.mean(np.square([1, 2, 3]))))
+    assert summary["sample_rate"] == pytest.approx(1.0)
+
+
+def test_sliding_window_matches_numpy_across_batches():
+    rng = np.random.default_rng(1)
+    values = rng.normal(5, 2, 1000)
+    ts = np.arange(1000) * 0.001
+    stats = RunningStats(window=64)
+    for start in range(0, 1000, 37):
+        stats.update(ts[start:start + 37], values[start:start + 37])
+    window = values[-64:]
+    summary = stats.summary()
+    assert summary["count"] == 64
+    assert summary["mean"] == pytest.approx(window.mean())
+    assert summary["std"] == pytest.approx(window.std())
+    assert summary["min"] == window.min() and summary["max"] == window.max()
+
+
+def test_batch_larger_than_window():
+    stats = RunningStats(window=16)
+    stats.update(np.arange(100, dtype=float), np.arange(100, dtype=float))
+    assert stats.summary()["mean"] == pytest.approx(np.arange(84, 100).mean())
+    assert stats.summary()["t"] == 99
+
+
+def test_frequency_of_a_sine_wave():
+    rate, frequency = 1000, 25
+    ts = np.arange(2000) / rate
+    values = np.sin(2 * np.pi * frequency * ts) + 0.05 * np.random.default_rng(2).normal(size=len(ts))
+    stats = RunningStats(window=1024)
+    for start in range(0, len(ts), 100):
+        stats.update(ts[start:start + 100], values[start:start + 100])
+    assert stats.summary()["frequency"] == pytest.approx(frequency, rel=0.02)
+
+
+def test_constant_signal_has_no_frequency():
+    stats = RunningStats(window=32)
+    stats.update(np.arange(32, dtype=float), np.full(32, 3.0))
+    assert stats.summary()["frequency"] is None
+
+
+def test_gap_resets_statistics():
+    stats = RunningStats(window=32)
+    stats.update(np.array([0.0, 1.0]), np.array([10.0, 10.0]))
+    stats.update(np.array([1.0 + STATS_RESET_GAP + 1]), np.array([1.0]))
+    summary = stats.summary()
+    assert summary["count"] == 1 and summary["mean"] == 1.0
+
+
+def test_measurement_stats_per_channel():
+    stats = MeasurementStats(window=8)
+    stats.update({"light": (np.array([0.0]), np.array([5.0]))})
+    assert stats.summary("light")["latest"] == 5.0
+    assert stats.summary("distance") is None
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+import pytest
+
+from triggers import CAPTURE_GRACE_SECONDS, Trigger, TriggerEngine
+
+
+def test_rising_trigger_rearms_only_below_hysteresis():
+    trigger = Trigger("light", "rising", level=10, hysteresis=2)
+    # 开始时未布防，要先看到低于 level - hysteresis 的数值
+    assert trigger.detect(np.array([12.0, 5, 11, 9, 11])).tolist() == [2]
+    # 跨批次保持状态: 9 在迟滞区间内不会重新布防
+    assert trigger.detect(np.array([9.0, 12])).tolist() == []
+    assert trigger.detect(np.array([7.0, 10])).tolist() == [1]
+
+
+def test_falling_trigger():
+    trigger = Trigger("light", "falling", level=5, hysteresis=1)
+    assert trigger.detect(np.array([8.0, 4, 5.5, 3, 7, 2])).tolist() == [1, 5]
+
+
+def test_range_trigger_is_armed_from_start():
+    trigger = Trigger("light", "range", low=0, high=10, hysteresis=1)
+    assert trigger.detect(np.array([11.0, 9.5, 12, 5, -1])).tolist() == [0, 4]
+
+
+@pytest.mark.parametrize("params", [
+    {"channel": "unknown", "kind": "rising", "level": 1},
+    {"channel": "light", "kind": "edge", "level": 1},
+    {"channel": "light", "kind": "rising"},
+    {"channel": "light", "kind": "range", "low": 5, "high": 5},
+    {"channel": "light", "kind": "rising", "level": 1, "hysteresis": -1},
+])
+def test_invalid_trigger(params):
+    with pytest.raises(ValueError):
+        Trigger(**params)
+
+
+def test_engine_waits_for_post_trigger_samples():
+    engine = TriggerEngine("default")
+    trigger = engine.add(channel="light", kind="rising", level=10, pre_seconds=1, post_seconds=1)
+    ts = time.time() + np.arange(10) * 0.25
+    values = np.array([0.0, 0, 0, 0, 20, 20, 0, 0, 0, 0])
+
+    assert engine.process({"light": (ts[:6], values[:6])}) == []
+    assert len(engine.pending) == 1
+    [event] = engine.process({"light": (ts[6:], values[6:])})
+    assert event["trigger_id"] == trigger.trigger_id
+    assert event["t"] == ts[4] and event["value"] == 20
+    assert [s["t"] for s in event["samples"]] == ts[0:9].tolist()
+    assert engine.recent(5) == [event]
+    assert trigger.fired == 1
+
+
+def test_engine_completes_stalled_events_after_grace():
+    engine = TriggerEngine("default")
+    engine.add(channel="light", kind="rising", level=10, pre_seconds=0, post_seconds=1)
+    now = time.time()
+    assert engine.process({"light": (np.array([now - 1, now]), np.array([0.0, 20.0]))}) == []
+    # 通道停止上报时，最多等到触发后窗口结束再过 CAPTURE_GRACE_SECONDS
+    assert engine.complete(now + 1.5) == []
+    [event] = engine.complete(now + 1 + CAPTURE_GRACE_SECONDS)
+    assert [s["value"] for s in event["samples"]] == [20.0]
+
+
+def test_remove_trigger_drops_pending_events_and_buffers():
+    engine = TriggerEngine("default")
+    trigger = engine.add(channel="light", kind="rising", level=10, post_seconds=5)
+    now = time.time()
+    engine.process({"light": (np.array([now - 1, now]), np.array([0.0, 20.0]))})
+    assert len(engine.pending) == 1
+    assert engine.remove(trigger.trigger_id)
+    assert engine.pending == [] and engine.buffers == {}
+    assert not engine.remove(trigger.trigger_id)
@@ -0,0 +1,91 @@
+"""
+指令链路追踪
+每条发往串口的指令带一个 trace_id，按阶段记录时间戳(Unix时间，秒):
+    t_request  HTTP请求到达
+    t_publish  发布到RabbitMQ
+    t_dequeue  串口服务从队列取出
+    t_write    写入串口
+    t_reply    串口读到设备的应答帧
+串口服务把后三个时间戳作为追踪事件发布到 serial_trace_routing_key，由本服务合并到对应记录。
+各服务运行在同一台主机上，直接比较 time.time() 即可得到跨服务的阶段耗时。
+"""
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+
+# 保留最近多少条指令的追踪记录
+TRACE_BUFFER_SIZE = 1000
+
+# 当前HTTP请求的 (来源, 到达时间)，由中间件设置，send_serial_command 读取
+request_context = ContextVar('request_context', default=None)
+
+# 阶段名 -> (起点字段, 终点字段)
+STAGES = (
+    ("request_to_publish", "t_request", "t_publish"),
+    ("queue_wait", "t_publish", "t_dequeue"),
+    ("dequeue_to_write", "t_dequeue", "t_write"),
+    ("device_reply", "t_write", "t_reply"),
+)
+
+# 追踪事件中允许合并进记录的字段
+EVENT_FIELDS = ("t_dequeue", "t_write", "t_reply", "reply")
+
+
+class TraceBuffer:
+    """最近N条指令的追踪记录，超出容量时丢弃最旧的记录"""
+
+    def __init__(self, maxlen: int = TRACE_BUFFER_SIZE):
+        self.maxlen = maxlen
+        self.traces = OrderedDict()
+
+    def start(self, command: bytes, device_id: str = None) -> dict:
+        """新建一条追踪记录，返回需要放进AMQP头部的字段"""
+        context = request_context.get()
+        source, t_request = context if context else (None, None)
+        trace_id = uuid.uuid4().hex[:16]
+        t_publish = time.time()
+        self.traces[trace_id] = {
+            "trace_id": trace_id,
+            "device_id": device_id,
+            "command": command.hex(),
+            "source": source,
+            "t_request": t_request,
+            "t_publish": t_publish,
+        }
+        while len(self.traces) > self.maxlen:
+            self.traces.popitem(last=False)
+        return {"trace_id": trace_id, "t_publish": t_publish}
+
+    def update(self, event: dict):
+        """合并串口服务发来的追踪事件，记录已被淘汰时忽略"""
+        trace = self.traces.get(event.get("trace_id"))
+        if trace is None:
+            return
+        for key in EVENT_FIELDS:
+            if key in event:
+                trace[key] = event[key]
+
+    def recent(self, limit: int):
+        """最近 limit 条记录(新的在前)及各阶段耗时(毫秒)"""
+        result = []
+        for trace in reversed(self.traces.values()):
+            if len(result) >= limit:
+                break
+            result.append(with_latencies(trace))
+        return result
+
+
+def with_latencies(trace: dict) -> dict:
+    item = dict(trace)
+    stages = {}
+    for name, begin, end in STAGES:
+        if trace.get(begin) is not None and trace.get(end) is not None:
+            stages[name] = round((trace[end] - trace[begin]) * 1000, 3)
+    first = trace.get("t_request") or trace["t_publish"]
+    last = next((trace[k] for k in ("t_reply", "t_write", "t_dequeue") if trace.get(k) is not None), None)
+    if last is not None:
+        stages["total"] = round((last - first) * 1000, 3)
+    item["stages_ms"] = stages
+    item["completed"] = trace.get("t_reply") is not None
+    return item
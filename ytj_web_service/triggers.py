@@ -0,0 +1,197 @@
+"""
+测量数据触发器
+在服务端对解码后的测量帧做边沿和阈值检测，只把命中的事件推送给 WebSocket、SSE 和 MCP，
+客户端不需要下载完整数据流再自己找事件。
+
+触发类型:
+    rising   数值上穿 level，回落到 level - hysteresis 以下后重新布防
+    falling  数值下穿 level，回升到 level + hysteresis 以上后重新布防
+    range    数值离开 [low, high] 时报警，回到 [low + hysteresis, high - hysteresis] 以内后重新布防
+每个事件附带触发前 pre_seconds 到触发后 post_seconds 的采样，触发后的采样凑齐才推送。
+"""
+import time
+import uuid
+from collections import deque
+
+import numpy as np
+
+from protocol import CHANNEL_INDEX
+
+TRIGGER_TYPES = ("rising", "falling", "range")
+# 触发前后采集窗口的上限(秒)
+MAX_CAPTURE_SECONDS = 10
+# 单个事件附带的最大采样数，超出时等间隔抽取
+MAX_CAPTURE_POINTS = 2000
+# 通道停止上报后，最多再等多久(秒)就用已有的采样完成事件
+CAPTURE_GRACE_SECONDS = 1
+# 每台设备保留的最近事件数
+TRIGGER_EVENT_HISTORY = 200
+
+# 检测状态: 已布防(等待触发)、迟滞区间内(保持原状态)、已触发
+ARMED, HOLD, FIRED = -1, 0, 1
+
+
+def schmitt_states(fire: np.ndarray, arm: np.ndarray, initial: int) -> np.ndarray:
+    """施密特触发的逐点状态: 迟滞区间内沿用之前最近一次的明确状态，批次开头沿用 initial"""
+    state = np.where(fire, FIRED, np.where(arm, ARMED, HOLD)).astype(np.int8)
+    last = np.where(state != HOLD, np.arange(len(state)), -1)
+    np.maximum.accumulate(last, out=last)
+    return np.where(last >= 0, state[np.maximum(last, 0)], initial)
+
+
+def rising_edges(states: np.ndarray, initial: int) -> np.ndarray:
+    """状态从布防变为触发的下标"""
+    previous = np.concatenate(([initial], states[:-1]))
+    return np.flatnonzero((states == FIRED) & (previous == ARMED))
+
+
+class Trigger:
+    """单个触发条件，跨批次保存迟滞状态"""
+
+    def __init__(self, channel: str, kind: str, level: float = None, low: float = None, high: float = None,
+                 hysteresis: float = 0.0, pre_seconds: float = 1.0, post_seconds: float = 1.0):
+        if channel not in CHANNEL_INDEX:
+            raise ValueError(f"未知测量通道 {channel}，可选值: {', '.join(CHANNEL_INDEX)}")
+        if kind not in TRIGGER_TYPES:
+            raise ValueError(f"未知触发类型 {kind}，可选值: {', '.join(TRIGGER_TYPES)}")
+        if kind == "range":
+            if low is None or high is None or low >= high:
+                raise ValueError("range 触发需要 low < high")
+        elif level is None:
+            raise ValueError(f"{kind} 触发需要指定 level")
+        if hysteresis < 0:
+            raise ValueError("hysteresis 不能为负数")
+        self.trigger_id = uuid.uuid4().hex[:8]
+        self.channel = channel
+        self.kind = kind
+        self.level = level
+        self.low = low
+        self.high = high
+        self.hysteresis = hysteresis
+        self.pre_seconds = min(max(pre_seconds, 0.0), MAX_CAPTURE_SECONDS)
+        self.post_seconds = min(max(post_seconds, 0.0), MAX_CAPTURE_SECONDS)
+        # 边沿触发要先看到布防区间的数值；范围报警一开始就已布防，启动时超限也会报警
+        self.state = ARMED if kind == "range" else HOLD
+        self.fired = 0
+
+    def zones(self, values: np.ndarray):
+        """返回 (触发区间, 布防区间) 两个布尔数组"""
+        if self.kind == "rising":
+            return values >= self.level, values < self.level - self.hysteresis
+        if self.kind == "falling":
+            return values <= self.level, values > self.level + self.hysteresis
+        outside = (values < self.low) | (values > self.high)
+        inside = (values >= self.low + self.hysteresis) & (values <= self.high - self.hysteresis)
+        return outside, inside
+
+    def detect(self, values: np.ndarray) -> np.ndarray:
+        """施密特触发: 返回从布防状态进入触发区间的采样下标，整批向量化计算"""
+        fire, arm = self.zones(values)
+        states = schmitt_states(fire, arm, self.state)
+        hits = rising_edges(states, self.state)
+        if len(states):
+            self.state = int(states[-1])
+        return hits
+
+    def to_dict(self) -> dict:
+        return {
+            "trigger_id": self.trigger_id,
+            "channel": self.channel,
+            "type": self.kind,
+            "level": self.level,
+            "low": self.low,
+            "high": self.high,
+            "hysteresis": self.hysteresis,
+            "pre_seconds": self.pre_seconds,
+            "post_seconds": self.post_seconds,
+            "armed": self.state == ARMED,
+            "fired": self.fired,
+        }
+
+
+class TriggerEngine:
+    """一台设备的所有触发器，以及用于前后采集窗口的各通道最近采样"""
+
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self.triggers = {}  # trigger_id -> Trigger
+        self.buffers = {}   # 通道名 -> (时间戳数组, 数值数组)
+        self.pending = []   # 等待触发后采样的事件
+        self.events = deque(maxlen=TRIGGER_EVENT_HISTORY)
+
+    def add(self, **params) -> Trigger:
+        trigger = Trigger(**params)
+        self.triggers[trigger.trigger_id] = trigger
+        return trigger
+
+    def remove(self, trigger_id: str) -> bool:
+        if self.triggers.pop(trigger_id, None) is None:
+            return False
+        self.pending = [event for event in self.pending if event["trigger_id"] != trigger_id]
+        channels = self.channels
+        for channel in list(self.buffers):
+            if channel not in channels:
+                del self.buffers[channel]
+        return True
+
+    @property
+    def channels(self) -> set:
+        return {trigger.channel for trigger in self.triggers.values()}
+
+    def process(self, decoded: dict) -> list:
+        """检测一批解码后的测量数据 {通道名: (时间戳, 数值)}，返回已凑齐前后采样的事件"""
+        if not self.triggers:
+            return []
+        for channel in self.channels:
+            if channel not in decoded:
+                continue
+            channel_ts, values = decoded[channel]
+            self._append(channel, channel_ts, values)
+            for trigger in self.triggers.values():
+                if trigger.channel != channel:
+                    continue
+                for i in trigger.detect(values).tolist():
+                    trigger.fired += 1
+                    self.pending.append({
+                        "event_id": uuid.uuid4().hex[:12],
+                        "trigger_id": trigger.trigger_id,
+                        "device_id": self.device_id,
+                        "channel": channel,
+                        "type": trigger.kind,
+                        "t": float(channel_ts[i]),
+                        "value": float(values[i]),
+                        "pre_seconds": trigger.pre_seconds,
+                        "post_seconds": trigger.post_seconds,
+                    })
+        return self.complete(time.time())
+
+    def complete(self, now: float) -> list:
+        """为触发后采样已凑齐(或通道已停止上报)的事件截取采集窗口"""
+        completed, waiting = [], []
+        for event in self.pending:
+            ts, values = self.buffers.get(event["channel"], (np.empty(0), np.empty(0)))
+            end = event["t"] + event["post_seconds"]
+            if (len(ts) and ts[-1] >= end) or now >= end + CAPTURE_GRACE_SECONDS:
+                lo = np.searchsorted(ts, event["t"] - event["pre_seconds"], side='left')
+                hi = np.searchsorted(ts, end, side='right')
+                step = max(1, -(-(hi - lo) // MAX_CAPTURE_POINTS))
+                event["samples"] = [
+                    {"t": t, "value": v}
+                    for t, v in zip(ts[lo:hi:step].tolist(), values[lo:hi:step].tolist())
+                ]
+                completed.append(event)
+                self.events.append(event)
+            else:
+                waiting.append(event)
+        self.pending = waiting
+        return completed
+
+    def recent(self, limit: int) -> list:
+        return list(self.events)[-limit:][::-1]
+
+    def _append(self, channel: str, ts: np.ndarray, values: np.ndarray):
+        old_ts, old_values = self.buffers.get(channel, (np.empty(0), np.empty(0)))
+        ts = np.concatenate((old_ts, ts))
+        values = np.concatenate((old_values, values))
+        keep = np.searchsorted(ts, ts[-1] - 2 * MAX_CAPTURE_SECONDS, side='left')
+        self.buffers[channel] = (ts[keep:], values[keep:])
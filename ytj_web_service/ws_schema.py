@@ -0,0 +1,131 @@
+"""
+WebSocket 消息格式
+连接时通过 /ws?schema=&encoding= 选择，默认 schema 由 WS_DEFAULT_SCHEMA 决定:
+- schema=1  原有的详细格式(前端页面使用): 每次状态变化按设备分别发送 state_update，
+            每条都带 device/device_type/state/device_state/device_name 和完整的 data 副本；数据帧为8个十六进制字符的文本
+- schema=2  精简格式: 连接后先发送一条 hello，包含档位、测量通道、波形的编号字典，之后的消息只用短键和编号:
+            状态 {"t": "s", "m": 档位编号(0为关闭), "l": LED位掩码(bit0为LED1), "p": [输出, 设置电压, 实际电压],
+                  "g": [输出, 波形编号, 频率], "u": 更新时间}，一次状态变化只发一条
+            触发事件 {"t": "e", "id", "g": 触发器ID, "c": 通道编号, "k": 类型, "ts", "v", "s": [[时间...], [数值...]]}
+            数据帧直接以4字节二进制消息发送
+  encoding=json 时状态和事件是 JSON 文本；encoding=msgpack 时是 MessagePack 二进制消息(需要安装 msgpack)，
+  长度恰好为4字节的二进制消息一定是数据帧，其余二进制消息都是 MessagePack
+"""
+import json
+import os
+
+from protocol import CHANNEL_INDEX, FRAME_SIZE, STREAM_MODES, WAVEFORM_CODES, mode_for_frame
+
+try:
+    import msgpack
+except ImportError:  # 未安装 msgpack 时只提供 json 编码
+    msgpack = None
+
+WS_SCHEMA_VERBOSE = 1
+WS_SCHEMA_COMPACT = 2
+WS_SCHEMAS = (WS_SCHEMA_VERBOSE, WS_SCHEMA_COMPACT)
+WS_DEFAULT_SCHEMA = int(os.getenv('WS_DEFAULT_SCHEMA', WS_SCHEMA_VERBOSE))
+WS_ENCODINGS = ("json", "msgpack")
+
+# 档位编号从1开始，0表示所有档位关闭；通道编号按 CHANNEL_INDEX 的顺序
+MODE_IDS = {key: index for index, key in enumerate(STREAM_MODES, 1)}
+CHANNEL_IDS = {name: index for index, name in enumerate(CHANNEL_INDEX)}
+
+
+def available_encodings() -> list:
+    return [encoding for encoding in WS_ENCODINGS if encoding != "msgpack" or msgpack is not None]
+
+
+class WsFormat:
+    """一个 WebSocket 连接协商的消息格式"""
+
+    def __init__(self, schema: int = WS_DEFAULT_SCHEMA, encoding: str = "json"):
+        if schema not in WS_SCHEMAS:
+            raise ValueError(f"不支持的消息格式版本 {schema}，可选值: {', '.join(map(str, WS_SCHEMAS))}")
+        if encoding not in available_encodings():
+            raise ValueError(f"不支持的编码 {encoding}，可选值: {', '.join(available_encodings())}")
+        if encoding != "json" and schema == WS_SCHEMA_VERBOSE:
+            raise ValueError("详细格式只支持 json 编码")
+        self.schema = schema
+        self.encoding = encoding
+
+    @property
+    def compact(self) -> bool:
+        return self.schema == WS_SCHEMA_COMPACT
+
+    @property
+    def key(self) -> tuple:
+        return self.schema, self.encoding
+
+    def encode(self, message: dict):
+        if self.encoding == "msgpack":
+            return msgpack.packb(message)
+        if self.compact:
+            return json.dumps(message, ensure_ascii=False, separators=(',', ':'))
+        return json.dumps(message, ensure_ascii=False)
+
+    async def send(self, websocket, payload):
+        if isinstance(payload, bytes):
+            await websocket.send_bytes(payload)
+        else:
+            await websocket.send_text(payload)
+
+    async def send_frame(self, websocket, frame: bytes):
+        if self.compact:
+            await websocket.send_bytes(frame)
+        else:
+            await websocket.send_text(frame.hex())
+
+
+def hello_message(device_id: str) -> dict:
+    """精简格式连接后的第一条消息: 后续消息中各编号对应的名称"""
+    return {
+        "t": "hello",
+        "v": WS_SCHEMA_COMPACT,
+        "device_id": device_id,
+        "frame_size": FRAME_SIZE,
+        # [编号, 档位, 设备类型, 名称, 前端按钮键名]
+        "modes": [[MODE_IDS[mode.key], mode.key, mode.device_type, mode.name, mode.ui_key]
+                  for mode in STREAM_MODES.values()],
+        "channels": list(CHANNEL_IDS),
+        "waveforms": {code: name for name, code in WAVEFORM_CODES.items()},
+    }
+
+
+def led_mask(led_states: dict) -> int:
+    mask = 0
+    for led_num, is_on in (led_states or {}).items():
+        if is_on:
+            mask |= 1 << (int(led_num) - 1)
+    return mask
+
+
+def compact_state(state_data: dict) -> dict:
+    """把一份完整的状态数据转换为精简格式的状态消息"""
+    command = state_data.get("last_stream_common")
+    mode = mode_for_frame(bytes.fromhex(command)) if command else None
+    power = state_data.get("power_supply_state") or {}
+    signal = state_data.get("signal_generator_state") or {}
+    return {
+        "t": "s",
+        "m": MODE_IDS[mode.key] if mode is not None else 0,
+        "l": led_mask(state_data.get("led_states")),
+        "p": [int(bool(power.get("outputEnabled"))), power.get("setVoltage"), power.get("actualVoltage")],
+        "g": [int(bool(signal.get("outputEnabled"))), WAVEFORM_CODES.get(signal.get("waveform"), 0),
+              signal.get("frequency")],
+        "u": state_data.get("updated_at"),
+    }
+
+
+def compact_trigger_event(event: dict) -> dict:
+    samples = event.get("samples", [])
+    return {
+        "t": "e",
+        "id": event["event_id"],
+        "g": event["trigger_id"],
+        "c": CHANNEL_IDS[event["channel"]],
+        "k": event["type"],
+        "ts": event["t"],
+        "v": event["value"],
+        "s": [[sample["t"] for sample in samples], [sample["value"] for sample in samples]],
+    }